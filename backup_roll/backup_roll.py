@@ -1,13 +1,179 @@
 #!/usr/bin/env python
 
 import argparse
+import array
+import bisect
+import calendar
+import collections
+import contextlib
+import ctypes
+import ctypes.util
 import datetime
+import errno
+import fnmatch
+import functools
+import gzip
+import hashlib
+import json
 import logging
 import os
+import re
+import select
+import shlex
 import shutil
+import stat as stat_
+import struct
 import sys
+import threading
+import time
+import zlib
 
-from os.path import isfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, \
+    wait  # python 2 requires futures package
+
+try:
+    import configparser
+except ImportError:  # python 2
+    import ConfigParser as configparser
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # python 2
+    from collections import Mapping
+
+try:
+    intern = sys.intern
+except AttributeError:  # python 2, builtin
+    pass
+
+try:
+    fsencode, fsdecode = os.fsencode, os.fsdecode
+except AttributeError:  # python 2, file names are bytes already
+    fsencode = fsdecode = lambda name: name
+
+try:
+    from os import scandir
+except ImportError:  # python < 3.5, requires scandir package
+    from scandir import scandir
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except OSError:
+    _libc = None
+# Linux only, os.sync is used instead
+_syncfs = getattr(_libc, 'syncfs', None)
+# Linux only, watching falls back to polling
+_inotify_init1 = getattr(_libc, 'inotify_init1', None)
+_inotify_add_watch = getattr(_libc, 'inotify_add_watch', None)
+
+try:
+    import boto3
+    import boto3.exceptions
+    import botocore.config
+    import botocore.exceptions
+    # errors of object storage, which are reported as IOError
+    S3_ERRORS = (boto3.exceptions.Boto3Error, botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError)
+except ImportError:  # optional, object storage requires boto3 package
+    boto3 = None
+    S3_ERRORS = ()
+
+try:
+    import zstandard
+except ImportError:  # optional, zstd compression requires zstandard package
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:  # optional, lz4 compression requires lz4 package
+    lz4 = None
+
+LINK_MODES = ('copy', 'hardlink', 'reflink', 'auto')
+
+# buffer size of the last resort read/write copy loop and the maximum size of a single copy_file_range/sendfile call
+COPY_BUFSIZE = 8 * 1024 * 1024
+
+# errors meaning that given copy method doesn't work for this pair of files and the next one should be tried
+COPY_FALLBACK_ERRNOS = set(getattr(errno, name) for name in (
+    'EXDEV', 'ENOSYS', 'EINVAL', 'EBADF', 'EOPNOTSUPP', 'ENOTSUP', 'ENOTSOCK',
+) if hasattr(errno, name))
+
+INCREMENTAL_MODES = ('size-mtime', 'checksum')
+# files which modification times differ less are considered to have the same modification time
+MTIME_TOLERANCE = 1
+
+# when collected files are flushed to disk. 'none' leaves it to the OS, 'batch' flushes data of each file in worker
+# threads and syncs each written directory once at the end of a phase, 'syncfs' syncs each written filesystem once at
+# the end of a phase, 'file' flushes each file and its directory right after it is written
+DURABILITY_MODES = ('none', 'batch', 'syncfs', 'file')
+
+EPOCH = datetime.datetime(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+# local time offset changes on quarter hours at most
+UTC_OFFSET_SLOT = 15 * 60
+
+# array type codes of listing columns, python 2 has no 64-bit ones
+try:
+    array.array('q')
+    INT64, UINT64 = 'q', 'Q'
+except ValueError:
+    INT64, UINT64 = 'l', 'L'
+
+# inotify(7) events of files closed after writing or moved into a watched directory
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+# size of chunks of large files compressed in parallel
+COMPRESS_CHUNK_SIZE = 16 * 1024 * 1024
+# level presets of compression formats, retentions use 'fast', 'default' or 'best' unless given a level
+COMPRESS_PRESETS = ('fast', 'default', 'best')
+# leading bytes of files which are already compressed and are collected as they are: gzip, zstd, lz4, bzip2, xz, zip
+COMPRESSED_MAGICS = (b'\x1f\x8b', b'\x28\xb5\x2f\xfd', b'\x04\x22\x4d\x18', b'BZh', b'\xfd7zXZ\x00', b'PK\x03\x04')
+
+ACTIONS = ('mkdir', 'copy', 'link', 'store', 'compress', 'move', 'skip', 'delete', 'gc', 'cleanup')
+# phases of apply_plan and actions executed in them
+APPLY_PHASES = (
+    ('collect', ('mkdir', 'copy', 'link', 'store', 'compress')),
+    ('move', ('move',)),
+    ('cleanup', ('delete',)),
+    ('store_gc', ('gc',)),
+    ('workspace_cleanup', ('cleanup',)),
+)
+PLAN_VERSION = 1
+
+# suffix of files being written, which are renamed to their final names when complete
+TEMP_SUFFIX = '.backup_roll-tmp'
+
+# checksums of files in a retention directory, in sha256sum format
+MANIFEST_FILENAME = '.backup_roll.sha256'
+
+# operations of the current run, kept in workspace directory until the run succeeds
+JOURNAL_FILENAME = '.backup_roll.journal'
+JOURNAL_VERSION = 1
+
+INDEX_FILENAME = '.backup_roll.index'
+INDEX_VERSION = 2
+# directory modification time this close to the time of the scan is not trusted to detect further changes
+INDEX_RACY_SECONDS = 2
+
+# list of directories with links to a blob store, kept inside the store
+STORE_ROOTS_FILENAME = '.backup_roll.roots'
+# lock file inside a blob store, shared by runs adding files to the store and exclusive for collecting garbage
+STORE_LOCK_FILENAME = '.backup_roll.lock'
+
+# from linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# errors meaning that given link method is not possible for this particular file and copying should be used instead
+LINK_FALLBACK_ERRNOS = set(getattr(errno, name) for name in (
+    'EXDEV', 'EPERM', 'EMLINK', 'EINVAL', 'ENOTTY', 'ENOSYS', 'EOPNOTSUPP', 'ENOTSUP', 'EBADF', 'EACCES',
+) if hasattr(errno, name))
 
 
 class LessThanFilter(logging.Filter):
@@ -58,125 +224,1633 @@ def ts2d(timestamp):
     return datetime.date.fromtimestamp(timestamp)
 
 
-class Directory(object):
+def _utc_offset(timestamp):
+    """Returns offset of local time from UTC at the timestamp, in seconds"""
+    timestamp = int(timestamp // 1)
+    return int((datetime.datetime.fromtimestamp(timestamp) - EPOCH).total_seconds()) - timestamp
+
+
+def local_days(timestamps, offset_hours=0):
+    """
+    Returns array of ordinals of local days of timestamps, shifted by offset_hours. Offsets of local time from UTC are
+    looked up once per UTC_OFFSET_SLOT seconds, only timestamps in a slot with a DST change are converted one by one
+    """
+    offsets = {}
+    shift = offset_hours * 3600
+    days = array.array('l')
+    for timestamp in timestamps:
+        slot = int(timestamp // UTC_OFFSET_SLOT)
+        utc_offset = offsets.get(slot)
+        if utc_offset is None:
+            start = _utc_offset(slot * UTC_OFFSET_SLOT)
+            utc_offset = offsets[slot] = start if start == _utc_offset((slot + 1) * UTC_OFFSET_SLOT - 1) else False
+        if utc_offset is False:
+            utc_offset = _utc_offset(timestamp)
+        days.append(int((timestamp + utc_offset + shift) // 86400) + EPOCH_ORDINAL)
+    return days
+
+
+def file_checksum(path, bufsize=1024 * 1024, open_=open):
+    checksum = hashlib.sha256()
+    with open_(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(bufsize), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def is_sparse(stat):
+    """Tells whether the file of the stat result has holes, i.e. fewer blocks allocated than its size needs"""
+    blocks = getattr(stat, 'st_blocks', None)
+    return blocks is not None and blocks * 512 < stat.st_size
+
+
+def _data_extents(fd, size):
+    """Yields (start, end) offsets of data extents of the file up to size, skipping its holes"""
+    end = 0
+    while end < size:
+        try:
+            start = os.lseek(fd, end, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # only a hole is left up to the end of the file
+                return
+            raise
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        yield start, end
+
+
+def _hash_zeros(checksum, size, bufsize):
+    view = memoryview(bytearray(min(size, bufsize)))
+    while size > 0:
+        checksum.update(view[:min(size, bufsize)])
+        size -= bufsize
+
+
+def _copy_sparse(fsrc, fdests, bufsize, checksum=None):
+    """
+    Copies only data extents of fsrc to the same offsets of each of fdests, found by SEEK_DATA and SEEK_HOLE. Holes
+    are neither read nor written, so they stay holes in fdests, which are expected to be empty
+
+    :param checksum: hashlib object updated with the data including zeros of holes
+    :return: Size of the file
+    """
+    size = os.fstat(fsrc.fileno()).st_size
+    # filesystems not supporting SEEK_DATA fail here, before anything is written or hashed
+    extents = list(_data_extents(fsrc.fileno(), size))
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    position = 0
+    for start, end in extents:
+        if checksum is not None and start > position:
+            _hash_zeros(checksum, start - position, bufsize)
+        fsrc.seek(start)
+        for fdest in fdests:
+            fdest.seek(start)
+        position = start
+        while position < end:
+            read = fsrc.readinto(view[:min(end - position, bufsize)])
+            if not read:
+                break
+            for fdest in fdests:
+                fdest.write(view[:read])
+            if checksum is not None:
+                checksum.update(view[:read])
+            position += read
+    if checksum is not None and size > position:
+        _hash_zeros(checksum, size - position, bufsize)
+    for fdest in fdests:
+        # trailing hole
+        fdest.truncate(size)
+        fdest.seek(size)
+    return size
+
+
+def _copy_file_range(fsrc, fdest, bufsize):
+    while os.copy_file_range(fsrc.fileno(), fdest.fileno(), bufsize):
+        pass
+
+
+def _sendfile(fsrc, fdest, bufsize):
+    offset = 0
+    while True:
+        sent = os.sendfile(fdest.fileno(), fsrc.fileno(), offset, bufsize)
+        if not sent:
+            break
+        offset += sent
+
+
+def _readinto(fsrc, fdest, bufsize, checksum=None):
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    while True:
+        size = fsrc.readinto(buf)
+        if not size:
+            break
+        fdest.write(view[:size])
+        if checksum is not None:
+            checksum.update(view[:size])
+
+
+def verify_checksum(path, expected):
+    """Raises IOError if SHA-256 checksum of the file isn't the expected one"""
+    actual = file_checksum(path)
+    if actual != expected:
+        raise IOError(errno.EIO, 'Checksum mismatch, expected {expected}, got {actual}'.format(
+            expected=expected, actual=actual), path)
+
+
+def format_size(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            return '{size:.1f} {unit}'.format(size=size, unit=unit)
+        size /= 1024.0
+    return '{size:.1f} TiB'.format(size=size)
+
+
+def format_rate(size, elapsed):
+    if elapsed <= 0:
+        return 'n/a'
+    return '{rate}/s'.format(rate=format_size(size / elapsed))
+
+
+COPY_METHODS = (
+    ('sparse', lambda fsrc, fdest, bufsize, checksum=None: _copy_sparse(fsrc, [fdest], bufsize, checksum)),
+    ('copy_file_range', _copy_file_range),
+    ('sendfile', _sendfile),
+    ('readinto', _readinto),
+)
+
+
+def copy_file(src, dest, bufsize=COPY_BUFSIZE, checksum=None):
+    """
+    Copies contents and permission bits of src to dest, like shutil.copy does. Only data extents of sparse files are
+    copied, keeping their holes. Other data is copied inside the kernel with copy_file_range or sendfile if the
+    platform and the pair of files allow it, otherwise using a read/write loop
+
+    :param checksum: hashlib object updated with the copied data. Data copied inside the kernel can't be hashed, so the
+    read/write loop is always used then
+    :return: Name of copy method used
+    """
+    start = time.time()
+    with open(src, 'rb') as fsrc:
+        with open(dest, 'wb') as fdest:
+            for method, copy in COPY_METHODS:
+                if method == 'sparse':
+                    if not hasattr(os, 'SEEK_DATA') or not is_sparse(os.fstat(fsrc.fileno())):
+                        continue
+                elif method != 'readinto' and (checksum is not None or not hasattr(os, method)):
+                    continue
+                try:
+                    if checksum is not None:
+                        copy(fsrc, fdest, bufsize, checksum)
+                    else:
+                        copy(fsrc, fdest, bufsize)
+                    break
+                except (IOError, OSError) as e:
+                    if e.errno not in COPY_FALLBACK_ERRNOS or method == 'readinto':
+                        raise
+                    logging.debug("Can't copy {src} -> {dest} using {method}: {error}".format(
+                        src=src, dest=dest, method=method, error=e))
+                    fsrc.seek(0)
+                    fdest.seek(0)
+                    fdest.truncate()
+            size = fdest.tell()
+    shutil.copymode(src, dest)
+    elapsed = time.time() - start
+    logging.debug("Copied {size} bytes {src} -> {dest} using {method} in {elapsed:.3f}s ({rate})".format(
+        size=size, src=src, dest=dest, method=method, elapsed=elapsed, rate=format_rate(size, elapsed)))
+    return method
+
+
+def copy_file_to_many(src, dests, bufsize=COPY_BUFSIZE, checksum=None):
+    """
+    Copies contents and permission bits of src to each of dests, reading src only once. All destinations are open at
+    the same time and each chunk read into the shared buffer is written to all of them. Holes of sparse files are
+    skipped like copy_file does
+
+    :param checksum: hashlib object updated with the copied data
+    """
+    start = time.time()
+    size = 0
+    fdests = []
+    try:
+        with open(src, 'rb') as fsrc:
+            for dest in dests:
+                fdests.append(open(dest, 'wb'))
+            sparse = hasattr(os, 'SEEK_DATA') and is_sparse(os.fstat(fsrc.fileno()))
+            if sparse:
+                try:
+                    size = _copy_sparse(fsrc, fdests, bufsize, checksum)
+                except (IOError, OSError) as e:
+                    if e.errno not in COPY_FALLBACK_ERRNOS:
+                        raise
+                    logging.debug("Can't copy {src} keeping holes: {error}".format(src=src, error=e))
+                    sparse = False
+            if not sparse:
+                buf = bytearray(bufsize)
+                view = memoryview(buf)
+                while True:
+                    read = fsrc.readinto(buf)
+                    if not read:
+                        break
+                    for fdest in fdests:
+                        fdest.write(view[:read])
+                    if checksum is not None:
+                        checksum.update(view[:read])
+                    size += read
+    finally:
+        for fdest in fdests:
+            fdest.close()
+    for dest in dests:
+        shutil.copymode(src, dest)
+    elapsed = time.time() - start
+    logging.debug("Copied {size} bytes {src} -> {count} destinations in {elapsed:.3f}s ({rate})".format(
+        size=size, src=src, count=len(dests), elapsed=elapsed, rate=format_rate(size, elapsed)))
+
+
+def _reflink(src, dest):
+    if fcntl is None:
+        raise OSError(errno.ENOTSUP, 'Reflinks are not supported on this platform', dest)
+    with open(src, 'rb') as fsrc:
+        with open(dest, 'wb') as fdest:
+            fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+    shutil.copymode(src, dest)
+
+
+def _hardlink(src, dest):
+    if os.path.lexists(dest):
+        os.remove(dest)
+    os.link(src, dest)
+
+
+def temp_path(path):
+    """Returns name of temporary file for writing path, hidden and ignored by listings"""
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '.{name}{suffix}'.format(name=name, suffix=TEMP_SUFFIX))
+
+
+def sync_file(path, data_only=False):
+    """Flushes the file to disk, only its data and size if data_only is set"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if data_only and hasattr(os, 'fdatasync'):
+            os.fdatasync(fd)
+        else:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sync_directory(path):
+    """Flushes entries of the directory, so files created, renamed or deleted in it survive a crash"""
+    sync_file(path)
+
+
+def syncfs(path):
+    """Flushes the whole filesystem containing path, or all filesystems where syncfs isn't available"""
+    if _syncfs is None:
+        if not hasattr(os, 'sync'):  # python 2 outside Linux
+            raise OSError(errno.ENOTSUP, 'Syncing filesystems is not supported on this platform', path)
+        os.sync()
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if _syncfs(fd) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+    finally:
+        os.close(fd)
+
+
+def sync_directories(directories, durability):
+    """
+    Makes files written to the directories durable. 'syncfs' durability syncs each filesystem once, other modes sync
+    each directory, the data is expected to be flushed already
+    """
+    if durability == 'syncfs':
+        filesystems = {}
+        for directory in directories:
+            filesystems.setdefault(os.stat(directory).st_dev, directory)
+        for directory in filesystems.values():
+            syncfs(directory)
+        return
+    for directory in directories:
+        sync_directory(directory)
+
+
+@contextlib.contextmanager
+def atomic_write(*paths):
+    """
+    Yields temporary paths to write the paths to. They are renamed to the paths when the block completes, or deleted
+    when it fails, so the paths never exist partially written, not even after a crash
+    """
+    tmps = [temp_path(path) for path in paths]
+    try:
+        yield tmps
+        for tmp, path in zip(tmps, paths):
+            os.rename(tmp, path)
+    except BaseException:
+        for tmp in tmps:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+        raise
+
+
+def move_file(src, dest, stat=None, checksum=None, sync=False):
+    """
+    Moves src to dest. Across filesystems src is copied to a temporary file, which is renamed to dest, and only then
+    src is deleted, so one of them always exists complete
+
+    :param checksum: hashlib object updated with the data if it is copied
+    :param sync: Flush the copy to disk before src is deleted
+    :return: 'rename' or 'copy'
+    """
+    if os.path.lexists(dest) and os.path.samefile(src, dest):
+        # dest is a hardlink to src left by a previous run, rename does nothing then and src would stay
+        os.remove(src)
+        return 'rename'
+    try:
+        os.rename(src, dest)
+        return 'rename'
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    transfer(src, dest, stat=stat, checksum=checksum)
+    if sync:
+        sync_file(dest)
+        sync_directory(os.path.dirname(os.path.abspath(dest)))
+    os.remove(src)
+    return 'copy'
+
+
+class Task(collections.namedtuple('Task', 'message run done')):
+    """
+    Single file operation. run is called without arguments, possibly in a worker thread, or is None if the operation
+    is only to be logged (dry run). done is called with the result of run in the thread which runs tasks
+    """
+    __slots__ = ()
+
+    def __new__(cls, message, run=None, done=None):
+        return super(Task, cls).__new__(cls, message, run, done)
+
+
+def run_tasks(tasks, executor=None):
+    """
+    Runs tasks one by one, or in parallel if executor is given. Messages are logged in order of tasks regardless of
+    order of their completion. A failing task is logged and doesn't stop the others
+
+    :param tasks: Iterable of Task
+    :param executor: concurrent.futures.Executor or None
+    :return: Number of failed tasks
+    """
+    if executor is None:
+        pending = ((task, None) for task in tasks)
+    else:
+        pending = [(task, executor.submit(task.run) if task.run is not None else None) for task in tasks]
+    failures = 0
+    for task, future in pending:
+        logging.info(task.message)
+        if task.run is None:
+            continue
+        try:
+            result = future.result() if future is not None else task.run()
+        except (IOError, OSError) as e:
+            failures += 1
+            logging.error("Failed: {message}: {error}".format(message=task.message, error=e))
+            continue
+        if task.done is not None:
+            task.done(result)
+    return failures
+
+
+def transfer(src, dest, link_mode='copy', stat=None, checksum=None):
+    """
+    Makes dest a copy of src, preserving its permissions, access and modification times. The copy is written to a
+    temporary file which replaces dest when complete
+
+    :param src: Source file path
+    :param dest: Destination file path, overwritten if exists
+    :param link_mode: One of LINK_MODES. 'hardlink' and 'reflink' fall back to copying when the link can't be created
+    (e.g. when files are on different filesystems), 'auto' tries reflink, then hardlink, then copy
+    :param stat: Already known stat result of src, saves a stat call
+    :param checksum: hashlib object updated with the data if it is copied
+    :return: Method actually used: 'copy', 'hardlink' or 'reflink'
+    """
+    if link_mode not in LINK_MODES:
+        raise ValueError('Unknown link mode: {mode}'.format(mode=link_mode))
+    methods = {
+        'copy': (),
+        'hardlink': ('hardlink',),
+        'reflink': ('reflink',),
+        'auto': ('reflink', 'hardlink'),
+    }[link_mode]
+    if 'hardlink' in methods and os.path.lexists(dest) and os.path.samefile(src, dest):
+        return 'hardlink'
+    # dest may be a hardlink left by previous run, it is replaced, so the source isn't overwritten
+    with atomic_write(dest) as (tmp,):
+        for method in methods:
+            try:
+                if method == 'hardlink':
+                    # hardlink shares the inode, so mode and times are already the same
+                    _hardlink(src, tmp)
+                    return method
+                _reflink(src, tmp)
+                break
+            except (OSError, IOError) as e:
+                if e.errno not in LINK_FALLBACK_ERRNOS:
+                    raise
+                logging.debug("Can't {method} {src} -> {dest}: {error}".format(method=method, src=src, dest=dest,
+                                                                                error=e))
+        else:
+            method = 'copy'
+            copy_file(src, tmp, checksum=checksum)
+        if stat is None:
+            stat = os.stat(src)
+        os.utime(tmp, (stat.st_atime, stat.st_mtime))
+    return method
+
+
+def transfer_to_many(src, dests, stat=None, checksum=None):
+    """
+    Makes each of dests a copy of src like transfer in 'copy' mode does, reading src only once
+
+    :return: 'copy'
+    """
+    with atomic_write(*dests) as tmps:
+        copy_file_to_many(src, tmps, checksum=checksum)
+        if stat is None:
+            stat = os.stat(src)
+        for tmp in tmps:
+            os.utime(tmp, (stat.st_atime, stat.st_mtime))
+    return 'copy'
+
+
+def _gzip_compress(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _zstd_compress(data, level):
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def _zstd_open(path, mode='rb'):
+    return zstandard.ZstdDecompressor().stream_reader(open(path, mode), read_across_frames=True)
+
+
+def _lz4_compress(data, level):
+    return lz4.frame.compress(data, compression_level=level)
+
+
+class Codec(collections.namedtuple('Codec', 'extension compress open levels available')):
+    """
+    Compression format. Chunks compressed separately by compress(data, level) are concatenated into a single file
+    (gzip members or zstd/lz4 frames), which open(path, mode) reads as a single stream. levels are levels of
+    COMPRESS_PRESETS
+    """
+    __slots__ = ()
+
+
+CODECS = collections.OrderedDict((
+    ('gzip', Codec('.gz', _gzip_compress, gzip.open, (1, 6, 9), True)),
+    ('zstd', Codec('.zst', _zstd_compress, _zstd_open, (1, 3, 19), zstandard is not None)),
+    ('lz4', Codec('.lz4', _lz4_compress, lz4.frame.open if lz4 is not None else None, (0, 3, 12), lz4 is not None)),
+))
+
+
+def is_compressed(path):
+    """Tells whether the file is already compressed, by its leading bytes"""
+    with open(path, 'rb') as f:
+        head = f.read(max(len(magic) for magic in COMPRESSED_MAGICS))
+    return any(head.startswith(magic) for magic in COMPRESSED_MAGICS)
+
+
+def compress_file(src, dest, compression, level, threads=1, chunk_size=COMPRESS_CHUNK_SIZE, checksum=None):
+    """
+    Writes src compressed to dest and copies its permission bits. Files larger than a chunk are compressed in
+    parallel by threads, chunk by chunk
+
+    :param compression: Name of one of CODECS
+    :param checksum: hashlib object updated with the compressed data
+    :return: Size of dest
+    """
+    start = time.time()
+    compress = functools.partial(CODECS[compression].compress, level=level)
+    with open(src, 'rb') as fsrc:
+        with open(dest, 'wb') as fdest:
+
+            def write(data):
+                fdest.write(data)
+                if checksum is not None:
+                    checksum.update(data)
+
+            chunks = iter(functools.partial(fsrc.read, chunk_size), b'')
+            if threads > 1 and os.fstat(fsrc.fileno()).st_size > chunk_size:
+                executor = ThreadPoolExecutor(max_workers=threads)
+                try:
+                    pending = collections.deque()
+                    for chunk in chunks:
+                        pending.append(executor.submit(compress, chunk))
+                        # bounds memory used by chunks waiting to be written
+                        if len(pending) > threads:
+                            write(pending.popleft().result())
+                    for future in pending:
+                        write(future.result())
+                finally:
+                    executor.shutdown()
+            else:
+                for chunk in chunks:
+                    write(compress(chunk))
+            if not fdest.tell():
+                # empty file still needs a header to be valid
+                write(compress(b''))
+            size = fsrc.tell()
+            compressed_size = fdest.tell()
+    shutil.copymode(src, dest)
+    elapsed = time.time() - start
+    logging.debug("Compressed {size} bytes {src} -> {dest} to {compressed_size} bytes using {compression} level "
+                  "{level} in {elapsed:.3f}s ({rate})".format(
+                      size=size, src=src, dest=dest, compressed_size=compressed_size, compression=compression,
+                      level=level, elapsed=elapsed, rate=format_rate(size, elapsed)))
+    return compressed_size
+
+
+def transfer_compressed(src, dest, compression, level, stat=None, threads=1, checksum=None):
+    """
+    Makes dest a compressed copy of src, preserving its permissions, access and modification times. The copy is
+    written to a temporary file which replaces dest when complete
+
+    :param checksum: hashlib object updated with the compressed data
+    :return: Size of dest
+    """
+    with atomic_write(dest) as (tmp,):
+        size = compress_file(src, tmp, compression, level, threads, checksum=checksum)
+        if stat is None:
+            stat = os.stat(src)
+        os.utime(tmp, (stat.st_atime, stat.st_mtime))
+    return size
+
+
+class FileStat(collections.namedtuple('FileStat', 'st_ino st_size st_atime st_mtime')):
+    """Subset of os.stat_result kept in listing index"""
+    __slots__ = ()
+
+
+# stat of a file listed without stat'ing it, which day was taken from its name
+UNKNOWN_STAT = FileStat(None, None, None, None)
+
+
+class NameDate(object):
+    """
+    Takes dates of backups from their file names. The pattern is either a regular expression with named groups year,
+    month, day and optionally hour, minute and second, or a strptime format using %Y, %m, %d, %H, %M and %S, e.g.
+    'db-%Y%m%d-%H%M'. The pattern is searched for anywhere in the name
+    """
+    DIRECTIVES = {
+        '%Y': r'(?P<year>\d{4})',
+        '%m': r'(?P<month>\d{2})',
+        '%d': r'(?P<day>\d{2})',
+        '%H': r'(?P<hour>\d{2})',
+        '%M': r'(?P<minute>\d{2})',
+        '%S': r'(?P<second>\d{2})',
+        '%%': '%',
+    }
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        if '(?P<' not in pattern:
+            parts = []
+            for part in re.split('(%.)', pattern):
+                if part.startswith('%') and part not in self.DIRECTIVES:
+                    raise ValueError('Unsupported directive {part} in {pattern}'.format(part=part, pattern=pattern))
+                parts.append(self.DIRECTIVES.get(part, re.escape(part)))
+            pattern = ''.join(parts)
+        self.regex = re.compile(pattern)
+        if not set(('year', 'month', 'day')) <= set(self.regex.groupindex):
+            raise ValueError('Date pattern {pattern} has to contain year, month and day'.format(pattern=self.pattern))
+
+    def datetime(self, name):
+        """Returns date and time from the name, None if it doesn't have them"""
+        match = self.regex.search(name)
+        if match is None:
+            return None
+        fields = match.groupdict()
+        try:
+            return datetime.datetime(*(int(fields.get(field) or 0)
+                                       for field in ('year', 'month', 'day', 'hour', 'minute', 'second')))
+        except ValueError:
+            return None
+
+
+class Storage(object):
+    """
+    Backend keeping files of directories. Paths of storages other than the local filesystem are URLs, which scheme
+    selects the storage, see storage_for
+    """
+
+    def list(self, directory, stat=True):
+        """Yields (path, stat) of files in the directory, stat is None unless asked for"""
+        raise NotImplementedError()
+
+    def stat(self, path):
+        raise NotImplementedError()
+
+    def isdir(self, directory):
+        raise NotImplementedError()
+
+    def makedirs(self, directory):
+        raise NotImplementedError()
+
+    def copy(self, src, dest, stat):
+        """Copies src to dest inside the storage, without transferring the data through this host where possible"""
+        raise NotImplementedError()
+
+    def upload(self, src, dest, stat):
+        """Copies local file src to dest in the storage"""
+        raise NotImplementedError()
+
+    def download(self, src, dest, stat):
+        """Copies src from the storage to local file dest"""
+        raise NotImplementedError()
+
+    def delete(self, path):
+        raise NotImplementedError()
+
+    def set_mtime(self, path, atime, mtime):
+        raise NotImplementedError()
+
+
+class LocalStorage(Storage):
+    """
+    Local filesystem. It lists remote-style directories and is the local end of transfers to and from other storages.
+    Operations between local files use transfer, move_file and os directly, as they support link modes, compression
+    and the store, which other storages don't
+    """
+
+    def list(self, directory, stat=True):
+        for entry in scandir(directory):
+            if entry.is_file() and not entry.name.endswith(TEMP_SUFFIX):
+                yield entry.path, entry.stat() if stat else None
+
+    def stat(self, path):
+        return os.stat(path)
+
+    def isdir(self, directory):
+        return os.path.isdir(directory)
+
+    def makedirs(self, directory):
+        make_directory(directory)
+
+    def copy(self, src, dest, stat):
+        return transfer(src, dest, 'auto', stat)
+
+    def upload(self, src, dest, stat):
+        return transfer(src, dest, stat=stat)
+
+    def download(self, src, dest, stat):
+        return transfer(src, dest, stat=stat)
+
+    def delete(self, path):
+        os.remove(path)
+
+    def set_mtime(self, path, atime, mtime):
+        os.utime(path, (atime, mtime))
+
+
+class S3Storage(Storage):
+    """
+    S3 compatible object storage, paths are s3://bucket/key URLs and directories are key prefixes. Objects' own
+    modification times can't be set, so modification times of files are kept in 'mtime' metadata of objects. Files
+    are copied between prefixes by the storage itself, without downloading them
+
+    :param client: boto3 S3 client, or an object with the same interface. Created from endpoint_url if not given
+    :param endpoint_url: URL of S3 compatible storage other than AWS
+    :param max_pool_connections: Number of pooled connections, which is also the number of objects stat'ed in parallel
+    by list
+    """
+    scheme = 's3'
+    # error codes of responses by errno
+    ERRNOS = {
+        '404': errno.ENOENT,
+        'NoSuchKey': errno.ENOENT,
+        'NoSuchBucket': errno.ENOENT,
+        '403': errno.EACCES,
+        'AccessDenied': errno.EACCES,
+    }
+
+    def __init__(self, client=None, endpoint_url=None, max_pool_connections=10):
+        if client is None:
+            if boto3 is None:
+                raise ValueError('Object storage requires boto3 package')
+            client = boto3.client('s3', endpoint_url=endpoint_url,
+                                  config=botocore.config.Config(max_pool_connections=max_pool_connections))
+        self.client = client
+        self.max_pool_connections = max_pool_connections
+
+    @staticmethod
+    def _split(path):
+        bucket, _, key = path.split('://', 1)[1].partition('/')
+        return bucket, key
+
+    def _url(self, bucket, key):
+        return '{scheme}://{bucket}/{key}'.format(scheme=self.scheme, bucket=bucket, key=key)
+
+    def _metadata(self, stat):
+        return {'Metadata': {'mtime': repr(float(stat.st_mtime))}, 'MetadataDirective': 'REPLACE'}
+
+    @contextlib.contextmanager
+    def _errors(self, path):
+        """Reraises errors of the client as IOError of the path, so they are reported like errors of local files"""
+        try:
+            yield
+        except S3_ERRORS as e:
+            code = str(getattr(e, 'response', {}).get('Error', {}).get('Code'))
+            raise IOError(self.ERRNOS.get(code, errno.EIO), str(e), path)
+
+    def list(self, directory, stat=True):
+        bucket, prefix = self._split(directory.rstrip('/') + '/')
+        paths = []
+        with self._errors(directory):
+            for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix,
+                                                                              Delimiter='/'):
+                for item in page.get('Contents', ()):
+                    name = item['Key'][len(prefix):]
+                    if name and not name.endswith(TEMP_SUFFIX):
+                        paths.append(self._url(bucket, item['Key']))
+        if not stat:
+            for path in paths:
+                yield path, None
+            return
+        # modification times are only in metadata of each object
+        executor = ThreadPoolExecutor(max_workers=self.max_pool_connections)
+        try:
+            for path, stat in zip(paths, executor.map(self.stat, paths)):
+                yield path, stat
+        finally:
+            executor.shutdown()
+
+    def stat(self, path):
+        bucket, key = self._split(path)
+        with self._errors(path):
+            head = self.client.head_object(Bucket=bucket, Key=key)
+        mtime = head.get('Metadata', {}).get('mtime')
+        mtime = float(mtime) if mtime is not None else calendar.timegm(head['LastModified'].utctimetuple())
+        return FileStat(None, head['ContentLength'], mtime, mtime)
+
+    def _bucket_exists(self, bucket, path):
+        try:
+            with self._errors(path):
+                self.client.head_bucket(Bucket=bucket)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        return True
+
+    def isdir(self, directory):
+        """Tells whether the bucket exists and has objects under the prefix, which exist only implicitly"""
+        bucket, prefix = self._split(directory.rstrip('/') + '/')
+        if not self._bucket_exists(bucket, directory):
+            return False
+        with self._errors(directory):
+            return bool(self.client.list_objects_v2(Bucket=bucket, Prefix=prefix, MaxKeys=1).get('Contents'))
+
+    def makedirs(self, directory):
+        # prefixes are created with their first objects, but buckets have to exist
+        bucket, _ = self._split(directory)
+        if not self._bucket_exists(bucket, directory):
+            raise IOError(errno.ENOENT, 'No such bucket', directory)
+
+    def copy(self, src, dest, stat):
+        src_bucket, src_key = self._split(src)
+        bucket, key = self._split(dest)
+        with self._errors(src):
+            self.client.copy({'Bucket': src_bucket, 'Key': src_key}, bucket, key, ExtraArgs=self._metadata(stat))
+        return 'server-side'
+
+    def upload(self, src, dest, stat):
+        bucket, key = self._split(dest)
+        with self._errors(dest):
+            self.client.upload_file(src, bucket, key, ExtraArgs={'Metadata': self._metadata(stat)['Metadata']})
+        return 'upload'
+
+    def download(self, src, dest, stat):
+        bucket, key = self._split(src)
+        with atomic_write(dest) as (tmp,):
+            with self._errors(src):
+                self.client.download_file(bucket, key, tmp)
+            os.utime(tmp, (stat.st_atime, stat.st_mtime))
+        return 'download'
+
+    def delete(self, path):
+        bucket, key = self._split(path)
+        with self._errors(path):
+            self.client.delete_object(Bucket=bucket, Key=key)
+
+    def set_mtime(self, path, atime, mtime):
+        self.copy(path, path, FileStat(None, None, atime, mtime))
+
+
+LOCAL_STORAGE = LocalStorage()
+# storages by URL scheme of their paths, created when first used unless they are configured before
+STORAGES = {}
+
+
+def is_local(path):
+    return '://' not in path
+
+
+def absolute_path(path):
+    """Returns absolute path of a local file, or the URL of a file in another storage"""
+    return os.path.abspath(path) if is_local(path) else path.rstrip('/')
+
+
+def storage_for(path):
+    """Returns Storage of the path"""
+    if is_local(path):
+        return LOCAL_STORAGE
+    scheme = path.split('://', 1)[0]
+    if scheme not in STORAGES:
+        if scheme != S3Storage.scheme:
+            raise ValueError('Unsupported storage: {path}'.format(path=path))
+        STORAGES[scheme] = S3Storage()
+    return STORAGES[scheme]
+
+
+def storage_transfer(src, dest, stat=None):
+    """
+    Makes dest a copy of src when either of them isn't on the local filesystem. Files in the same storage are copied
+    by the storage itself
+
+    :return: Method used: 'server-side', 'upload' or 'download'
+    """
+    src_storage = storage_for(src)
+    dest_storage = storage_for(dest)
+    if stat is None:
+        stat = src_storage.stat(src)
+    if src_storage is dest_storage:
+        return src_storage.copy(src, dest, stat)
+    if src_storage is LOCAL_STORAGE:
+        return dest_storage.upload(src, dest, stat)
+    if dest_storage is LOCAL_STORAGE:
+        return src_storage.download(src, dest, stat)
+    raise IOError(errno.EXDEV, "Can't copy to {dest} from a different storage".format(dest=dest), src)
+
+
+def storage_move(src, dest, stat=None):
+    """Moves src to dest when either of them isn't on the local filesystem, by copying and deleting src"""
+    method = storage_transfer(src, dest, stat)
+    storage_for(src).delete(src)
+    return method
+
+
+def _entry_stat(entry, follow_symlinks=True):
+    return entry.stat(follow_symlinks=follow_symlinks)
+
+
+class Listing(Mapping):
+    """
+    Files of a directory by day of their modification time: maps dates to lists of paths. The directory path is kept
+    once, file names are interned and their stats and days are kept in array columns, one row per file. Rows of files
+    which were removed or replaced are only unlinked by name, days are sorted again when they are looked up after a
+    change. Sorted days are iterated in order and queried by ranges
+    """
+
+    # array columns of stats and days and their type codes, in order of columns of the index
+    COLUMNS = ('_inodes', '_sizes', '_atimes', '_mtimes', '_days')
+    TYPECODES = (UINT64, INT64, 'd', 'd', 'l')
+
+    def __init__(self, directory, offset_hours=0):
+        self.directory = directory
+        self.offset_hours = offset_hours
+        self._prefix = os.path.join(directory, '')
+        self._names = []
+        # inode 0 is unknown
+        for column, typecode in zip(self.COLUMNS, self.TYPECODES):
+            setattr(self, column, array.array(typecode))
+        self._rows = {}
+        self._by_day = None
+        self._sorted_days = None
+
+    def extend(self, files):
+        """
+        Adds or replaces files
+
+        :param files: Iterable of (name, stat, day), day is None to take it from modification time
+        """
+        start = len(self._names)
+        unknown = []
+        for name, stat, day in files:
+            name = intern(name)
+            row = len(self._names)
+            self._names.append(name)
+            self._append_stat(stat)
+            if day is None:
+                unknown.append(row)
+                day = 0
+            self._days.append(day.toordinal() if isinstance(day, datetime.date) else day)
+            self._rows[name] = row
+        # days are bucketed in a single pass over the new rows
+        for row, day in zip(unknown, local_days([self._mtimes[row] for row in unknown], self.offset_hours)):
+            self._days[row] = day
+        if len(self._names) > start:
+            self._by_day = None
+
+    def _append_stat(self, stat):
+        if stat.st_size is None:
+            # not stat'ed yet, see UNKNOWN_STAT
+            stat = FileStat(0, -1, 0, 0)
+        self._inodes.append(stat.st_ino or 0)
+        self._sizes.append(stat.st_size)
+        self._atimes.append(stat.st_atime)
+        self._mtimes.append(stat.st_mtime)
+
+    def add(self, name, stat, day=None):
+        self.extend([(name, stat, day)])
+
+    def columns(self):
+        """Returns names and array COLUMNS of listed files, rows of removed and replaced files are left out"""
+        rows = sorted(self._rows.values())
+        columns = [getattr(self, column) for column in self.COLUMNS]
+        if len(rows) == len(self._names):
+            return self._names, columns
+        return [self._names[row] for row in rows], [array.array(values.typecode, (values[row] for row in rows))
+                                                    for values in columns]
+
+    @classmethod
+    def from_columns(cls, directory, offset_hours, names, columns):
+        """Creates listing of names and array COLUMNS as returned by columns(), without building rows one by one"""
+        listing = cls(directory, offset_hours)
+        listing._names = names
+        for column, values in zip(cls.COLUMNS, columns):
+            setattr(listing, column, values)
+        listing._rows = dict(zip(names, range(len(names))))
+        return listing
+
+    def set_stat(self, name, stat):
+        """Sets stat result of a file listed without it"""
+        row = self._rows[name]
+        self._inodes[row] = stat.st_ino or 0
+        self._sizes[row] = stat.st_size
+        self._atimes[row] = stat.st_atime
+        self._mtimes[row] = stat.st_mtime
+
+    def remove(self, name):
+        """Removes the file, returns whether it was listed"""
+        if self._rows.pop(name, None) is None:
+            return False
+        self._by_day = None
+        return True
+
+    def stat(self, name, default=None):
+        row = self._rows.get(name)
+        if row is None:
+            return default
+        if self._sizes[row] < 0:
+            return UNKNOWN_STAT
+        return FileStat(self._inodes[row] or None, self._sizes[row], self._atimes[row], self._mtimes[row])
+
+    def day(self, name):
+        """Returns day ordinal of the file, None if it isn't listed"""
+        row = self._rows.get(name)
+        return self._days[row] if row is not None else None
+
+    def _index(self):
+        if self._by_day is None:
+            by_day = {}
+            # rows are in order of listing, which is kept within days
+            for row in sorted(self._rows.values()):
+                by_day.setdefault(self._days[row], array.array('l')).append(row)
+            self._by_day = by_day
+            self._sorted_days = array.array('l', sorted(by_day))
+        return self._by_day
+
+    def range(self, start=None, end=None):
+        """Yields days which have files from start to end inclusive in order, None for an open end"""
+        self._index()
+        days = self._sorted_days
+        first = bisect.bisect_left(days, start.toordinal()) if start is not None else 0
+        last = bisect.bisect_right(days, end.toordinal()) if end is not None else len(days)
+        for i in range(first, last):
+            yield datetime.date.fromordinal(days[i])
+
+    def __getitem__(self, date):
+        names = self._names
+        return [self._prefix + names[row] for row in self._index()[date.toordinal()]]
+
+    def __iter__(self):
+        return self.range()
+
+    def __len__(self):
+        return len(self._index())
+
+    def __contains__(self, date):
+        return isinstance(date, datetime.date) and date.toordinal() in self._index()
+
+
+class Directory(object):
+
+    def __init__(self, directory, offset_hours=0, use_index=False, include=(), exclude=(), name_date=None):
+        """
+        :param directory: Path of the directory, or URL of a directory in a Storage other than the local filesystem
+        :param offset_hours: Hours added to files' modification times before determining their days
+        :param use_index: Keep listing in INDEX_FILENAME file inside the directory. The directory is then rescanned
+        only if its modification time changed, and only files which are new or were replaced are stat'ed. Files are
+        expected not to be modified in place
+        :param include: Glob patterns of names of listed files, all files are listed if empty
+        :param exclude: Glob patterns of names of files which aren't listed. Patterns are matched before files are
+        stat'ed
+        :param name_date: NameDate pattern taking days of files from their names instead of modification times. Such
+        files are listed without stat'ing them, they are stat'ed only when their stats are needed
+        """
+        logging.debug('Initializing {class_} at {workspace_dir}'.format(class_=self.__class__.__name__,
+                                                                        workspace_dir=directory))
+        if use_index and not is_local(directory):
+            raise ValueError("Index can't be used with {directory}".format(directory=directory))
+        self.directory = directory
+        self.offset_hours = offset_hours
+        self.use_index = use_index
+        self.include = list(include)
+        self.exclude = list(exclude)
+        self._include = self._patterns(include)
+        self._exclude = self._patterns(exclude)
+        self.name_date = NameDate(name_date) if name_date is not None else None
+        # listed files are symbolic links which days are taken from their own modification times
+        self.follow_symlinks = True
+        self._listing = None
+        # temporary files left by an interrupted run, found by the last scan
+        self.temp_files = []
+        self._index_dirty = False
+        self._index_mtime = None
+
+    def listing(self, executor=None):
+        """
+        :param executor: concurrent.futures.Executor stat'ing files in parallel when the listing is created, or None to
+        stat them one by one
+        """
+        if self._listing is None:
+            self._listing = self._create_listing(executor)
+        return self._listing
+
+    def _create_listing(self, executor=None):
+        """
+        Groups regular files by day of their modification time. Uses one directory scan and a single stat per file,
+        file type is taken from the directory entry itself where the platform provides it
+        """
+        listing = Listing(self.directory, self.offset_hours)
+        if not is_local(self.directory):
+            if not storage_for(self.directory).isdir(self.directory):
+                return listing
+            for path, stat in storage_for(self.directory).list(self.directory, stat=self.name_date is None):
+                name = os.path.basename(path)
+                if name not in (INDEX_FILENAME, MANIFEST_FILENAME, JOURNAL_FILENAME) and self._is_listed(name):
+                    day = self._name_day(name)
+                    if stat is None and day is None:
+                        stat = self._stat_now(path)
+                    listing.add(name, stat or UNKNOWN_STAT, day)
+            return listing
+        if not os.path.isdir(self.directory):
+            return listing
+        if self.use_index:
+            return self._indexed_listing(executor)
+        listing.extend(self._entry_files(self._scan(), executor))
+        return listing
+
+    @staticmethod
+    def _patterns(globs):
+        if not globs:
+            return None
+        return re.compile('|'.join('(?:{regex})'.format(regex=fnmatch.translate(glob)) for glob in globs))
+
+    def _is_listed(self, name):
+        """Tells whether a file of the name passes include and exclude patterns"""
+        if self._include is not None and not self._include.match(name):
+            return False
+        return self._exclude is None or not self._exclude.match(name)
+
+    def _name_day(self, name):
+        """Returns ordinal of day of a file taken from its name, None if it has to be taken from modification time"""
+        if self.name_date is None:
+            return None
+        dt = self.name_date.datetime(name)
+        if dt is None:
+            return None
+        try:
+            return (dt + datetime.timedelta(hours=self.offset_hours)).date().toordinal()
+        except OverflowError:  # offset moves the date out of supported range
+            return None
+
+    def _entry_files(self, entries, executor=None):
+        """Yields (name, stat, day) of directory entries, only entries which days aren't in their names are stat'ed"""
+        unnamed = []
+        for entry in entries:
+            day = self._name_day(entry.name)
+            if day is None:
+                unnamed.append(entry)
+            else:
+                yield entry.name, UNKNOWN_STAT, day
+        for entry, stat in self._stat_entries(unnamed, executor):
+            yield entry.name, stat, None
+
+    def _stat_now(self, path):
+        if not is_local(path):
+            return storage_for(path).stat(path)
+        return os.stat(path) if self.follow_symlinks else os.lstat(path)
+
+    def _scan(self):
+        self.temp_files = []
+        for entry in scandir(self.directory):
+            if entry.name.endswith(TEMP_SUFFIX):
+                self.temp_files.append(entry.path)
+                continue
+            if entry.name in (INDEX_FILENAME, MANIFEST_FILENAME, JOURNAL_FILENAME) or not self._is_listed(entry.name):
+                continue
+            if not entry.is_file() and (self.follow_symlinks or not entry.is_symlink()):
+                continue
+            yield entry
+
+    def _stat_entries(self, entries, executor=None):
+        """Yields (entry, stat) of directory entries"""
+        if executor is None:
+            for entry in entries:
+                yield entry, entry.stat(follow_symlinks=self.follow_symlinks)
+            return
+        entries = list(entries)
+        for entry, stat in zip(entries, executor.map(
+                functools.partial(_entry_stat, follow_symlinks=self.follow_symlinks), entries)):
+            yield entry, stat
+
+    def all_days(self):
+        return self.listing().keys()
+
+    def refresh(self):
+        """Drops the listing, so it is created again when needed"""
+        self._listing = None
+
+    def list(self, date):
+        return self.listing().get(date, [])
+
+    def stat(self, path):
+        """Returns stat result of listed file, taken when the listing was created"""
+        stat = self.listed_stat(path)
+        if stat is None:
+            raise KeyError(path)
+        return stat
+
+    def listed_stat(self, path):
+        """
+        Returns stat result of the file taken when the listing was created, None if it isn't listed. Files listed
+        without stat'ing them are stat'ed now
+        """
+        name = os.path.basename(path)
+        stat = self.listing().stat(name)
+        if stat is UNKNOWN_STAT:
+            stat = self._stat_now(path)
+            self.listing().set_stat(name, stat)
+        return stat
+
+    def _record(self, path, stat):
+        """Adds or replaces a file in the listing after it was written to the directory"""
+        if self._listing is None and not self.use_index:
+            # nothing to keep up to date, the listing will be created from scratch when needed
+            return
+        self._forget(path)
+        # inode is unknown without stat'ing the file, so it will be stat'ed during the next refresh of the index
+        self.listing().add(os.path.basename(path), FileStat(None, stat.st_size, stat.st_atime, stat.st_mtime))
+        self._index_dirty = True
+
+    def _forget(self, path):
+        """Removes a file from the listing after it was deleted from the directory"""
+        if self._listing is None and not self.use_index:
+            return
+        if self.listing().remove(os.path.basename(path)):
+            self._index_dirty = True
+
+    def _index_path(self):
+        return os.path.join(self.directory, INDEX_FILENAME)
+
+    def _index_header(self):
+        return {
+            'version': INDEX_VERSION,
+            'offset_hours': self.offset_hours,
+            'timezone': [time.timezone, time.altzone],
+            'include': self.include,
+            'exclude': self.exclude,
+            'name_date': self.name_date.pattern if self.name_date is not None else None,
+            'byteorder': sys.byteorder,
+            'columns': [[typecode, array.array(typecode).itemsize] for typecode in Listing.TYPECODES],
+        }
+
+    def _load_index(self):
+        """
+        Reads the index: a line of JSON header followed by NUL separated file names and array columns of the listing,
+        see Listing.columns
+
+        :return: (directory modification time, Listing), or (None, None) if the index is missing or outdated
+        """
+        try:
+            with open(self._index_path(), 'rb') as f:
+                index = json.loads(f.readline().decode('utf-8'))
+                header = self._index_header()
+                if not isinstance(index, dict) or any(index.get(key) != value for key, value in header.items()):
+                    logging.debug("Index of {directory} is outdated".format(directory=self.directory))
+                    return None, None
+                count = index['count']
+                names = fsdecode(f.read(index['names_size'])).split('\0') if count else []
+                columns = []
+                for typecode, _ in header['columns']:
+                    values = array.array(typecode)
+                    values.fromfile(f, count)
+                    columns.append(values)
+        except (IOError, OSError, ValueError, KeyError, EOFError) as e:
+            logging.debug("Can't load index of {directory}: {error}".format(directory=self.directory, error=e))
+            return None, None
+        if len(names) != count:
+            logging.debug("Index of {directory} is corrupted".format(directory=self.directory))
+            return None, None
+        return index.get('directory_mtime'), Listing.from_columns(self.directory, self.offset_hours, names, columns)
+
+    def _indexed_listing(self, executor=None):
+        """Returns listing kept in the index if the directory didn't change since, otherwise refreshes it"""
+        self._index_mtime = os.stat(self.directory).st_mtime
+        directory_mtime, cached = self._load_index()
+        if cached is not None and directory_mtime == self._index_mtime:
+            logging.debug("Using index of {directory}".format(directory=self.directory))
+            return cached
+        logging.debug("Refreshing index of {directory}".format(directory=self.directory))
+        self._index_dirty = True
+        listing = Listing(self.directory, self.offset_hours)
+        listing.extend(self._refreshed_files(cached, executor))
+        return listing
+
+    def _refreshed_files(self, cached, executor=None):
+        """Yields (name, stat, day) of scanned files, stat'ing only those which aren't in the cached listing"""
+        changed = []
+        for entry in self._scan():
+            stat = cached.stat(entry.name) if cached is not None else None
+            if stat is not None and stat.st_ino is not None and stat.st_ino == entry.inode():
+                yield entry.name, stat, cached.day(entry.name)
+            else:
+                changed.append(entry)
+        for name, stat, day in self._entry_files(changed, executor):
+            yield name, stat, day
+
+    def save_index(self):
+        """
+        Writes the listing to the index file if it was changed. It is only written after plans are applied, never by
+        dry runs
+        """
+        if not self.use_index or not self._index_dirty or self._listing is None or not os.path.isdir(self.directory):
+            return
+        names, columns = self._listing.columns()
+        names = fsencode('\0'.join(names))
+        index = self._index_header()
+        # modification time from before the scan, so changes made since then are picked up by the next refresh.
+        # Directory mtime has limited granularity, so if it is very recent further changes may leave it the same
+        directory_mtime = self._index_mtime
+        if directory_mtime is not None and time.time() - directory_mtime < INDEX_RACY_SECONDS:
+            directory_mtime = None
+        index['directory_mtime'] = directory_mtime
+        index['count'] = len(columns[0])
+        index['names_size'] = len(names)
+        # an existing file is rewritten in place, so the directory modification time doesn't change
+        index_path = self._index_path()
+        with open(index_path, 'r+b' if os.path.exists(index_path) else 'wb') as f:
+            f.write(json.dumps(index, separators=(',', ':')).encode('utf-8') + b'\n')
+            f.write(names)
+            for values in columns:
+                values.tofile(f)
+            f.truncate()
+        self._index_dirty = False
+
+
+class Workspace(Directory):
+
+    def __init__(self, *args, **kwargs):
+        super(Workspace, self).__init__(*args, **kwargs)
+        self._compressed = {}
+
+    def is_compressed(self, path):
+        """Tells whether the listed file is already compressed, reads it only once for all retentions"""
+        if path not in self._compressed:
+            # files in other storages aren't read, they are collected as they are
+            self._compressed[path] = is_compressed(path) if is_local(path) else True
+        return self._compressed[path]
+
+    def subset(self, paths):
+        """Returns Workspace listing only the given files of this directory, stat'ed now"""
+        workspace = self.__class__(self.directory, self.offset_hours, include=self.include, exclude=self.exclude,
+                                   name_date=self.name_date.pattern if self.name_date is not None else None)
+        workspace._listing = Listing(self.directory, self.offset_hours)
+        workspace._listing.extend((os.path.basename(path), os.stat(path), workspace._name_day(os.path.basename(path)))
+                                  for path in paths if workspace._is_listed(os.path.basename(path)))
+        return workspace
+
+    def cleanup_operations(self):
+        """Returns Operations deleting listed files from workspace"""
+        return [Operation('cleanup', path, size=self.stat(path).st_size)
+                for day in sorted(self.all_days()) for path in self.list(day)]
+
+    def cleanup(self, dry_run=False, executor=None):
+        """
+        Deletes listed files from workspace. Files which appeared after the listing was created are kept
+
+        :return: Number of files which couldn't be deleted
+        """
+        return apply_plan(Plan(self.cleanup_operations()), dry_run=dry_run, executor=executor, directories=[self])
+
+
+class Retention(Directory):
+    # compression level preset used unless compress_level is given
+    compress_preset = 'default'
+
+    def __init__(self, retention_dir, offset_hours=0, link_mode='copy', incremental=None, store=None,
+                 compression=None, compress_level=None, checksums=False, keep_last=None, **kwargs):
+        """
+        Base class for retentions
+
+        :param retention_dir: Directory to store backups
+        :param link_mode: How files are collected from workspace, one of LINK_MODES. 'copy' always copies data,
+        'hardlink' and 'reflink' link files when possible and copy otherwise, 'auto' chooses the best possible way
+        :param incremental: Skip files already present in the retention directory, one of INCREMENTAL_MODES or None to
+        always collect files. 'size-mtime' compares size and modification time, 'checksum' compares size and contents
+        :param store: BlobStore keeping contents of collected files, the retention directory then holds symbolic links
+        to it. None to keep files in the retention directory itself
+        :param compression: Compress collected files with one of CODECS, adding its extension to their names. Files
+        which are already compressed are collected as they are. None to collect files uncompressed
+        :param compress_level: Compression level, None for level of compress_preset of the codec
+        :param checksums: Keep SHA-256 checksums of collected files in MANIFEST_FILENAME inside the retention
+        directory. Files are hashed while they are written and verified after that
+        :param keep_last: Keep files of this number of most recent days matching the retention's rule, instead of
+        the days within its age. None to keep files by age
+        :param kwargs: Passed to Directory
+
+        Retention directories in storages other than the local filesystem can't be used with store, compression or
+        checksums
+        """
+        super(Retention, self).__init__(retention_dir, offset_hours, **kwargs)
+        if not is_local(retention_dir) and (store is not None or compression is not None or checksums):
+            raise ValueError("Store, compression and checksums can't be used with {directory}".format(
+                directory=retention_dir))
+        if link_mode not in LINK_MODES:
+            raise ValueError('Unknown link mode: {mode}'.format(mode=link_mode))
+        if incremental is not None and incremental not in INCREMENTAL_MODES:
+            raise ValueError('Unknown incremental mode: {mode}'.format(mode=incremental))
+        self.link_mode = link_mode
+        self.incremental = incremental
+        if compression is not None:
+            if compression not in CODECS:
+                raise ValueError('Unknown compression: {compression}'.format(compression=compression))
+            if not CODECS[compression].available:
+                raise ValueError('{compression} compression requires {package} package'.format(
+                    compression=compression, package={'zstd': 'zstandard'}.get(compression, compression)))
+            if store is not None:
+                raise ValueError("Compression can't be used together with a store")
+            if compress_level is None:
+                compress_level = CODECS[compression].levels[COMPRESS_PRESETS.index(self.compress_preset)]
+        self.store = store
+        self.follow_symlinks = store is None
+        self.compression = compression
+        self.compress_level = compress_level
+        self.checksums = checksums
+        self.keep_last = keep_last
+        self._manifest = None
+        self._manifest_dirty = False
+        self._calendar = None
+
+    def kept_days(self, start, end):
+        """Yields days from start to end inclusive which files are kept by the retention's rule, regardless of age"""
+        raise NotImplementedError()
+
+    def min_date(self, today):
+        """Returns the newest day which files are too old to be kept"""
+        raise NotImplementedError()
+
+    def calendar(self, start, end):
+        """
+        Returns bitmap of days from start to end inclusive which files are kept by the retention's rule, indexed by
+        their ordinals minus ordinal of start. The last one is kept for further lookups
+        """
+        if self._calendar is None or self._calendar[:2] != (start, end):
+            bitmap = bytearray(end.toordinal() - start.toordinal() + 1)
+            for day in self.kept_days(start, end):
+                bitmap[day.toordinal() - start.toordinal()] = 1
+            self._calendar = (start, end, bitmap)
+        return self._calendar[2]
+
+    def filter_for_collect(self, dates):
+        """Returns those of dates which files are kept by the retention"""
+        dates = set(dates)
+        if not dates:
+            return []
+        if self.keep_last is not None:
+            start, end = min(dates), max(dates)
+            bitmap = self.calendar(start, end)
+            matching = sorted(date for date in dates if bitmap[date.toordinal() - start.toordinal()])
+            return matching[-self.keep_last:] if self.keep_last else []
+        start = self.min_date(datetime.datetime.now().date()) + datetime.timedelta(days=1)
+        end = max(max(dates), start)
+        bitmap = self.calendar(start, end)
+        return [date for date in dates if date >= start and bitmap[date.toordinal() - start.toordinal()]]
+
+    def filter_for_cleanup(self, dates):
+        return set(dates) - set(self.filter_for_collect(dates))
+
+    def expired_days(self):
+        """
+        Yields days of listed files which aren't kept by the retention, in order. Days older than the retention's age
+        are a range of the listing taken as they are, only days within the age are looked up in the calendar
+        """
+        listing = self.listing()
+        if self.keep_last is not None:
+            kept = set(self.filter_for_collect(listing.range()))
+            for day in listing.range():
+                if day not in kept:
+                    yield day
+            return
+        start = self.min_date(datetime.datetime.now().date()) + datetime.timedelta(days=1)
+        for day in listing.range(end=start - datetime.timedelta(days=1)):
+            yield day
+        recent = list(listing.range(start=start))
+        kept = set(self.filter_for_collect(recent))
+        for day in recent:
+            if day not in kept:
+                yield day
+
+    def collect(self, workspace, dry_run=False, executor=None):
+        """
+        Copies files from workspace to the retention directory
 
-    def __init__(self, directory, offset_hours=0):
-        logging.debug('Initializing {class_} at {workspace_dir}'.format(class_=self.__class__.__name__,
-                                                                        workspace_dir=directory))
-        self.directory = directory
-        self.offset_hours = offset_hours
-        self._listing = None
+        :return: Number of files which couldn't be collected
+        """
+        plan = create_plan(workspace, [self], cleanup_retentions=False)
+        return apply_plan(plan, dry_run=dry_run, executor=executor, directories=[workspace, self])
 
-    def listing(self):
-        if self._listing is None:
-            self._listing = self._create_listing()
-        return self._listing
+    def collect_operation(self, workspace, src, link_mode):
+        """
+        Returns Operation collecting src file from workspace, 'skip' if the retention directory already has its up to
+        date copy
+        """
+        dest = os.path.join(self.directory, os.path.basename(src))
+        stat = workspace.stat(src)
+        compression = self.compression
+        if compression is not None and workspace.is_compressed(src):
+            compression = None
+        if compression is not None:
+            dest += CODECS[compression].extension
+        if self._is_up_to_date(workspace, src, dest, compression):
+            return Operation('skip', src, dest, stat.st_size, stat.st_atime, stat.st_mtime)
+        if not is_local(src) or not is_local(dest):
+            # copied by storage_transfer, link mode and store only apply to the local filesystem
+            return Operation('copy', src, dest, stat.st_size, stat.st_atime, stat.st_mtime)
+        if compression is not None:
+            return Operation('compress', src, dest, stat.st_size, stat.st_atime, stat.st_mtime,
+                             compression=compression, level=self.compress_level)
+        if self.store is not None:
+            return Operation('store', src, dest, stat.st_size, stat.st_atime, stat.st_mtime, link_mode,
+                             self.store.directory)
+        if link_mode == 'copy':
+            return Operation('copy', src, dest, stat.st_size, stat.st_atime, stat.st_mtime)
+        return Operation('link', src, dest, stat.st_size, stat.st_atime, stat.st_mtime, link_mode)
 
-    def _create_listing(self):
-        if not os.path.isdir(self.directory):
-            return {}
-        paths = map(lambda filename: os.path.join(self.directory, filename),
-                    os.listdir(self.directory))
-        listing = {}
-        for path in paths:
-            if not isfile(path):
-                continue
-            stat = os.stat(path)
-            dt = ts2dt(stat.st_mtime) + datetime.timedelta(hours=self.offset_hours)
-            d = dt.date()
-            if d not in listing.keys():
-                listing[d] = []
-            listing[d].append(path)
-        return listing
+    def _is_up_to_date(self, workspace, src, dest, compression=None):
+        if self.incremental is None:
+            return False
+        dest_stat = self.listed_stat(dest)
+        if dest_stat is None:
+            return False
+        src_stat = workspace.stat(src)
+        if compression is not None:
+            # sizes of compressed files differ, contents are compared decompressed
+            if self.incremental == 'checksum':
+                return file_checksum(src) == file_checksum(dest, open_=CODECS[compression].open)
+            return abs(src_stat.st_mtime - dest_stat.st_mtime) < MTIME_TOLERANCE
+        dest_size = dest_stat.st_size
+        if self.store is not None:
+            # listing has stat of the link, the size is the blob's
+            try:
+                dest_size = os.stat(dest).st_size
+            except OSError:
+                return False
+        if src_stat.st_size != dest_size:
+            return False
+        if self.incremental == 'checksum' and is_local(src) and is_local(dest):
+            return file_checksum(src) == file_checksum(dest)
+        return abs(src_stat.st_mtime - dest_stat.st_mtime) < MTIME_TOLERANCE
 
-    def all_days(self):
-        return self.listing().keys()
+    def link_mode_for(self, workspace):
+        """Returns link mode to be used for collecting files from workspace"""
+        directory = self.directory if self.store is None else self.store.directory
+        if not is_local(workspace.directory) or not is_local(directory):
+            return 'copy'
+        if self.link_mode == 'copy' or self._same_device(workspace, directory):
+            return self.link_mode
+        logging.debug("{src} and {dest} are on different filesystems, files will be copied".format(
+            src=workspace.directory, dest=directory))
+        return 'copy'
 
-    def list(self, date):
-        return self.listing().get(date, [])
+    @staticmethod
+    def _same_device(workspace, directory):
+        return os.stat(workspace.directory).st_dev == device_of(directory)
 
+    def _forget(self, path):
+        super(Retention, self)._forget(path)
+        if self.checksums and self.manifest().pop(os.path.basename(path), None) is not None:
+            self._manifest_dirty = True
 
-class Workspace(Directory):
+    def _manifest_path(self):
+        return os.path.join(self.directory, MANIFEST_FILENAME)
 
-    def cleanup(self, dry_run=False):
-        if not os.path.isdir(self.directory):
-            return
-        paths = map(lambda filename: os.path.join(self.directory, filename),
-                    os.listdir(self.directory))
-        for path in paths:
-            if not isfile(path):
-                continue
-            logging.info("Deleting workspace file: {file}".format(file=path))
-            if not dry_run:
-                os.remove(path)
+    def manifest(self):
+        """Returns checksums of files by their names"""
+        if self._manifest is None:
+            self._manifest = {}
+            try:
+                with open(self._manifest_path()) as f:
+                    for line in f:
+                        checksum, name = line.rstrip('\n').split('  ', 1)
+                        self._manifest[name] = checksum
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return self._manifest
 
+    def record_checksum(self, path, checksum):
+        """Sets checksum of a file written to the directory"""
+        self.manifest()[os.path.basename(path)] = checksum
+        self._manifest_dirty = True
 
-class Retention(Directory):
+    def save_manifest(self):
+        """Writes the manifest if it was changed"""
+        if not self._manifest_dirty or not os.path.isdir(self.directory):
+            return
+        tmp = temp_path(self._manifest_path())
+        with open(tmp, 'w') as f:
+            for name, checksum in sorted(self.manifest().items()):
+                f.write('{checksum}  {name}\n'.format(checksum=checksum, name=name))
+        os.rename(tmp, self._manifest_path())
+        self._manifest_dirty = False
 
-    def __init__(self, retention_dir, offset_hours=0):
-        super(Retention, self).__init__(retention_dir, offset_hours)
+    def verify_tasks(self):
+        """Returns Tasks checking files of the retention directory against their checksums from the manifest"""
+        manifest = self.manifest()
+        for day in sorted(self.all_days()):
+            for path in self.list(day):
+                if os.path.basename(path) not in manifest:
+                    logging.warning("No checksum of {path}".format(path=path))
+        # files missing from the directory fail to be read
+        return [Task("Verifying {path}".format(path=os.path.join(self.directory, name)),
+                     functools.partial(verify_checksum, os.path.join(self.directory, name), checksum))
+                for name, checksum in sorted(manifest.items())]
 
-    def filter_for_collect(self, dates):
-        raise NotImplementedError()
+    def cleanup_operations(self, keep=()):
+        """
+        Returns Operations deleting old files from the retention directory, except files in keep, and temporary files
+        left by an interrupted run
+        """
+        operations = []
+        for day in self.expired_days():
+            for path in self.list(day):
+                if path not in keep:
+                    operations.append(Operation('delete', path, size=self.stat(path).st_size))
+        return operations + [Operation('delete', path) for path in self.temp_files]
 
-    def filter_for_cleanup(self, dates):
-        return set(dates) - set(self.filter_for_collect(dates))
+    def cleanup(self, dry_run=False, executor=None):
+        """
+        Deletes old files from the retention directory
 
-    def collect(self, workspace, dry_run=False):
-        """Copies files from workspace to the retention directory"""
-        if not os.path.isdir(self.directory):
-            logging.info("Creating directory {directory}".format(directory=self.directory))
-            if not dry_run:
-                mask = os.umask(0)
-                os.umask(mask)
-                perms = mask ^ 0o0777 # looks like os.mkdir ignores umask, so handle it manually
-                os.mkdir(self.directory, perms)
-        all_days = workspace.all_days()
-        collect_days = self.filter_for_collect(all_days)
-        for day in collect_days:
-            files = workspace.list(day)
-            for src in files:
-                basename = os.path.basename(src)
-                dest = os.path.join(self.directory, basename)
-                logging.info("Copying {src} -> {dest}".format(src=src, dest=dest))
-                if not dry_run:
-                    shutil.copy(src, dest)
-                    stat = os.stat(src)
-                    os.utime(dest, (stat.st_atime, stat.st_mtime))
-
-    def cleanup(self, dry_run=False):
-        """Deletes old files from the retention directory"""
-        all_days = self.all_days()
-        cleanup_days = self.filter_for_cleanup(all_days)
-        for day in cleanup_days:
-            old_files = self.list(day)
-            for old_file in old_files:
-                logging.info("Deleting old file: {old_file}".format(old_file=old_file))
-                if not dry_run:
-                    os.remove(old_file)
+        :return: Number of files which couldn't be deleted
+        """
+        plan = create_plan(None, [self])
+        return apply_plan(plan, dry_run=dry_run, executor=executor, directories=[self])
 
 
 class DailyRetention(Retention):
+    compress_preset = 'fast'
 
-    def __init__(self, retention_dir, offset_hours=0, keep_days=30):
+    def __init__(self, retention_dir, offset_hours=0, keep_days=30, **kwargs):
         """
         Daily retention
 
         :param retention_dir: Directory to store daily backups
         :param keep_days: How long in days files will be kept
         """
-        super(DailyRetention, self).__init__(retention_dir, offset_hours)
+        super(DailyRetention, self).__init__(retention_dir, offset_hours, **kwargs)
         self.keep_days = keep_days
 
-    def filter_for_collect(self, dates):
-        min_date = datetime.datetime.now().date() - datetime.timedelta(days=self.keep_days)
+    def kept_days(self, start, end):
+        for ordinal in range(start.toordinal(), end.toordinal() + 1):
+            yield datetime.date.fromordinal(ordinal)
+
+    def min_date(self, today):
+        min_date = today - datetime.timedelta(days=self.keep_days)
         logging.debug("Minimal day for collecting daily files: {day}".format(day=min_date))
-        return filter(lambda date: date > min_date, dates)
+        return min_date
 
 
 class WeeklyRetention(Retention):
 
-    def __init__(self, retention_dir, offset_hours=0, keep_weeks=12, weekdays=(6,)):
+    def __init__(self, retention_dir, offset_hours=0, keep_weeks=12, weekdays=(6,), **kwargs):
         """
         Weekly retention
 
@@ -184,19 +1858,27 @@ class WeeklyRetention(Retention):
         :param keep_weeks: How long in weeks files will be kept
         :param weekdays: Iterable of weekdays to keep files. 0=monday..6=sunday
         """
-        super(WeeklyRetention, self).__init__(retention_dir, offset_hours)
+        super(WeeklyRetention, self).__init__(retention_dir, offset_hours, **kwargs)
         self.keep_weeks = keep_weeks
         self.weekdays = weekdays
 
-    def filter_for_collect(self, dates):
-        min_date = datetime.datetime.now().date() - datetime.timedelta(days=self.keep_weeks * 7)
+    def kept_days(self, start, end):
+        for weekday in set(self.weekdays) & set(range(7)):
+            day = start + datetime.timedelta(days=(weekday - start.weekday()) % 7)
+            while day <= end:
+                yield day
+                day += datetime.timedelta(days=7)
+
+    def min_date(self, today):
+        min_date = today - datetime.timedelta(days=self.keep_weeks * 7)
         logging.debug("Minimal day for collecting weekly files: {day}".format(day=min_date))
-        return filter(lambda date: date > min_date and date.weekday() in self.weekdays, dates)
+        return min_date
 
 
 class MonthlyRetention(Retention):
+    compress_preset = 'best'
 
-    def __init__(self, retention_dir, offset_hours=0, keep_months=12, monthdays=(1,)):
+    def __init__(self, retention_dir, offset_hours=0, keep_months=12, monthdays=(1,), **kwargs):
         """
         Monthly retention
 
@@ -205,7 +1887,7 @@ class MonthlyRetention(Retention):
         :param monthdays: Iterable of month days to collect backups from. Negative values indicates
         days number from the end of the month (-1 means 31 of Jan, 28 or 29 of Feb etc.)
         """
-        super(MonthlyRetention, self).__init__(retention_dir, offset_hours)
+        super(MonthlyRetention, self).__init__(retention_dir, offset_hours, **kwargs)
         self.keep_months = keep_months
         self.monthdays = monthdays
 
@@ -213,18 +1895,963 @@ class MonthlyRetention(Retention):
         return ((date.replace(day=28) + datetime.timedelta(days=4)).replace(
             day=1) - datetime.timedelta(days=1)).day
 
-    def filter_for_collect(self, dates):
-        today = datetime.datetime.now().date()
+    def kept_days(self, start, end):
+        month = start.replace(day=1)
+        while month <= end:
+            # length of each month is computed once
+            length = self._month_length(month)
+            for monthday in sorted(set(self.monthdays)):
+                day = monthday if monthday > 0 else length + monthday + 1
+                if 1 <= day <= length and start <= month.replace(day=day) <= end:
+                    yield month.replace(day=day)
+            month = (month + datetime.timedelta(days=32)).replace(day=1)
+
+    def min_date(self, today):
         first = today.replace(day=1)
-        n_months_ago = first.replace(year=first.year - ((self.keep_months + 12 - first.month) / 12),
+        n_months_ago = first.replace(year=first.year - ((self.keep_months + 12 - first.month) // 12),
                                      month=(first.month - self.keep_months - 1) % 12 + 1)
-        diff = first - n_months_ago
-        min_date = today - diff
-        return filter(lambda date: date > min_date and (
-                date.day in self.monthdays or (date.day - self._month_length(date)) - 1 in self.monthdays), dates)
+        return today - (first - n_months_ago)
 
 
-def main(args_):
+class YearlyRetention(Retention):
+    compress_preset = 'best'
+
+    def __init__(self, retention_dir, offset_hours=0, keep_years=5, yeardays=((1, 1),), **kwargs):
+        """
+        Yearly retention
+
+        :param retention_dir: Directory to store yearly backups
+        :param keep_years: How long in years files will be kept
+        :param yeardays: Iterable of (month, day) of days of year to collect backups from
+        """
+        super(YearlyRetention, self).__init__(retention_dir, offset_hours, **kwargs)
+        self.keep_years = keep_years
+        self.yeardays = yeardays
+
+    def kept_days(self, start, end):
+        for year in range(start.year, end.year + 1):
+            for month, day in set(self.yeardays):
+                try:
+                    date = datetime.date(year, month, day)
+                except ValueError:
+                    # 29th of February in common years
+                    continue
+                if start <= date <= end:
+                    yield date
+
+    def min_date(self, today):
+        if today.month == 2 and today.day == 29:
+            today = today.replace(day=28)
+        return today.replace(year=today.year - self.keep_years)
+
+
+class BlobStore(object):
+    """
+    Content-addressed store shared by retentions. Contents of each distinct file are kept once, as a read-only blob
+    named by its SHA-256 checksum, and retention directories hold symbolic links to the blobs. Links have their own
+    modification times, so identical files collected on different days are still listed under their own days.
+    Directories with links are registered in STORE_ROOTS_FILENAME, so blobs referenced from any of them are kept by
+    collect_garbage, even by runs with other retentions
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._checksums = {}
+        self._roots = None
+
+    def blob_path(self, checksum):
+        return os.path.join(self.directory, checksum[:2], checksum[2:])
+
+    def checksum(self, path, stat):
+        """Returns checksum of the file, computed once per run for each file which wasn't modified"""
+        key = (path, stat.st_size, stat.st_mtime)
+        with self._lock:
+            checksum = self._checksums.get(key)
+        if checksum is None:
+            checksum = file_checksum(path)
+            with self._lock:
+                self._checksums[key] = checksum
+        return checksum
+
+    def add(self, src, dest, link_mode='copy', stat=None):
+        """
+        Stores contents of src unless the store already has them, and makes dest a symbolic link to the blob with
+        modification time of src
+
+        :param link_mode: How a new blob is created from src, see transfer
+        :return: 'store' if a new blob was written, 'dedup' if the contents were already stored
+        """
+        if stat is None:
+            stat = os.stat(src)
+        blob = self.blob_path(self.checksum(src, stat))
+        # garbage collection mustn't delete the blob before the link to it exists
+        with self._locked(fcntl.LOCK_SH if fcntl is not None else None):
+            method = 'dedup'
+            if not os.path.exists(blob):
+                method = 'store'
+                self._write_blob(src, blob, link_mode, stat)
+            self._register(os.path.dirname(os.path.abspath(dest)))
+            tmp = temp_path(dest)
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            os.symlink(os.path.relpath(os.path.abspath(blob), os.path.dirname(os.path.abspath(dest))), tmp)
+            if os.utime in getattr(os, 'supports_follow_symlinks', ()):
+                os.utime(tmp, (stat.st_atime, stat.st_mtime), follow_symlinks=False)
+            os.rename(tmp, dest)
+        return method
+
+    @contextlib.contextmanager
+    def _locked(self, operation):
+        """
+        Holds STORE_LOCK_FILENAME locked by flock operation, LOCK_SH while adding files and LOCK_EX while collecting
+        garbage, so runs sharing the store don't interfere. Nothing is locked on platforms without fcntl
+        """
+        if fcntl is None:
+            yield
+            return
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        with open(os.path.join(self.directory, STORE_LOCK_FILENAME), 'a') as f:
+            fcntl.flock(f.fileno(), operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _write_blob(self, src, blob, link_mode, stat):
+        try:
+            os.makedirs(os.path.dirname(blob))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # the same contents may be stored by another thread at the same time
+        tmp = temp_path('{blob}.{thread}'.format(blob=blob, thread=threading.current_thread().ident))
+        try:
+            method = transfer(src, tmp, link_mode, stat)
+            if method != 'hardlink':
+                # blobs are shared by all their links, so modifying one would modify them all
+                os.chmod(tmp, stat_.S_IMODE(os.stat(tmp).st_mode) & ~0o222)
+            os.rename(tmp, blob)
+        except BaseException:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            raise
+
+    def _roots_path(self):
+        return os.path.join(self.directory, STORE_ROOTS_FILENAME)
+
+    def roots(self):
+        """Returns registered directories which may contain links to the store"""
+        with self._lock:
+            return list(self._load_roots())
+
+    def _load_roots(self):
+        if self._roots is None:
+            try:
+                with open(self._roots_path()) as f:
+                    self._roots = json.load(f)
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                self._roots = []
+        return self._roots
+
+    def _register(self, directory):
+        with self._lock:
+            roots = self._load_roots()
+            if directory not in roots:
+                roots.append(directory)
+                _write_atomically(self._roots_path(), json.dumps(roots, indent=1))
+
+    def reference_counts(self):
+        """
+        Returns numbers of links to each blob from registered directories. Raises IOError if any of them is missing,
+        e.g. not mounted, as blobs referenced only from it would seem unreferenced
+        """
+        store = os.path.realpath(self.directory)
+        counts = collections.Counter()
+        for root in self.roots():
+            if not os.path.isdir(root):
+                raise IOError(errno.ENOENT, 'Directory registered in {roots} is missing, remove it from there if it '
+                                            'was deleted'.format(roots=self._roots_path()), root)
+            for entry in scandir(root):
+                if entry.is_symlink():
+                    target = os.path.realpath(entry.path)
+                    if os.path.dirname(os.path.dirname(target)) == store:
+                        counts[target] += 1
+        return counts
+
+    def blobs(self):
+        """Yields (path, size) of stored blobs"""
+        if not os.path.isdir(self.directory):
+            return
+        for prefix in scandir(self.directory):
+            if not prefix.is_dir(follow_symlinks=False):
+                continue
+            for entry in scandir(prefix.path):
+                if not entry.name.endswith(TEMP_SUFFIX) and entry.is_file(follow_symlinks=False):
+                    yield entry.path, entry.stat(follow_symlinks=False).st_size
+
+    def collect_garbage(self):
+        """
+        Deletes blobs which aren't referenced by any link
+
+        :return: List of (path, size) of deleted blobs
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        with self._locked(fcntl.LOCK_EX if fcntl is not None else None):
+            counts = self.reference_counts()
+            store = os.path.realpath(self.directory)
+            deleted = []
+            for path, size in self.blobs():
+                if counts[os.path.join(store, os.path.relpath(path, self.directory))]:
+                    continue
+                logging.debug("Deleting unreferenced blob {path}".format(path=path))
+                os.remove(path)
+                deleted.append((path, size))
+        return deleted
+
+
+class Metrics(object):
+    """
+    Durations of phases of a run, and numbers of files and bytes processed by each action in each directory
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.phases = collections.OrderedDict()
+        self.actions = collections.OrderedDict()
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.time() - start
+
+    def count(self, directory, action, size, seconds=0):
+        """Counts a file processed by the action, can be called from worker threads"""
+        with self._lock:
+            counts = self.actions.setdefault((directory, action), {'files': 0, 'bytes': 0, 'seconds': 0})
+            counts['files'] += 1
+            counts['bytes'] += size
+            counts['seconds'] += seconds
+
+    def totals(self):
+        """Returns counts summed over directories, per action"""
+        totals = collections.OrderedDict((action, {'files': 0, 'bytes': 0, 'seconds': 0}) for action in ACTIONS)
+        for (_, action), counts in self.actions.items():
+            for key, value in counts.items():
+                totals[action][key] += value
+        return totals
+
+    def summary(self):
+        totals = self.totals()
+        collected = dict((key, sum(totals[action][key] for action in ('copy', 'link', 'store', 'compress',
+                                                                      'move'))) for key in ('files', 'bytes'))
+        return ('Finished in {elapsed:.1f}s ({phases}). Collected {collected[files]} file(s), {collected_size} '
+                '({rate}), skipped {skip[files]}, deleted {delete[files]} old file(s), {delete_size}, deleted '
+                '{cleanup[files]} workspace file(s), {failures} failure(s)').format(
+            elapsed=time.time() - self.start,
+            phases=', '.join('{phase} {seconds:.1f}s'.format(phase=phase, seconds=seconds)
+                             for phase, seconds in self.phases.items()),
+            collected=collected, collected_size=format_size(collected['bytes']),
+            rate=format_rate(collected['bytes'], self.phases.get('collect', 0)),
+            delete_size=format_size(totals['delete']['bytes']), failures=self.failures, **totals)
+
+    def to_dict(self):
+        directories = collections.OrderedDict()
+        for (directory, action), counts in self.actions.items():
+            directories.setdefault(directory, collections.OrderedDict())[action] = counts
+        return {
+            'start': self.start,
+            'seconds': time.time() - self.start,
+            'phases': self.phases,
+            'totals': self.totals(),
+            'directories': directories,
+            'failures': self.failures,
+        }
+
+    def to_prometheus(self):
+        """Returns metrics in Prometheus text format, as read by node_exporter textfile collector"""
+        lines = []
+
+        def metric(name, help_, samples):
+            lines.append('# HELP backup_roll_{name} {help}'.format(name=name, help=help_))
+            lines.append('# TYPE backup_roll_{name} gauge'.format(name=name))
+            for labels, value in samples:
+                labels = ','.join('{key}="{value}"'.format(
+                    key=key, value=str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                    for key, value in labels)
+                lines.append('backup_roll_{name}{labels} {value}'.format(
+                    name=name, labels='{' + labels + '}' if labels else '', value=repr(float(value))))
+
+        metric('last_run_timestamp_seconds', 'Start time of the last run', [((), self.start)])
+        metric('duration_seconds', 'Duration of the last run', [((), time.time() - self.start)])
+        metric('phase_duration_seconds', 'Duration of phases of the last run',
+               [((('phase', phase),), seconds) for phase, seconds in self.phases.items()])
+        for key, help_ in (('files', 'Files processed by the last run'),
+                           ('bytes', 'Bytes processed by the last run'),
+                           ('seconds', 'Time spent on processing files by the last run, summed over parallel jobs')):
+            metric(key if key != 'seconds' else 'operation_seconds', help_,
+                   [((('directory', directory), ('action', action)), counts[key])
+                    for (directory, action), counts in self.actions.items()])
+        metric('failures', 'Failed operations of the last run', [((), self.failures)])
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path):
+        _write_atomically(path, json.dumps(self.to_dict(), indent=1))
+
+    def write_prometheus(self, path):
+        _write_atomically(path, self.to_prometheus())
+
+
+def _write_atomically(path, contents):
+    tmp_path = '{path}.{pid}.tmp'.format(path=path, pid=os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(contents)
+    os.rename(tmp_path, path)
+
+
+class Operation(collections.namedtuple('Operation',
+                                       'action path dest size atime mtime link_mode store compression level')):
+    """
+    Single step of a Plan. path is the source file of 'copy', 'link', 'store', 'compress' and 'move', the store
+    directory of 'gc', or the file or directory which is created or deleted by other actions. store is the store
+    directory of 'store', compression and level are the codec and its level of 'compress'
+    """
+    __slots__ = ()
+
+    def __new__(cls, action, path, dest=None, size=0, atime=None, mtime=None, link_mode=None, store=None,
+                compression=None, level=None):
+        if action not in ACTIONS:
+            raise ValueError('Unknown action: {action}'.format(action=action))
+        return super(Operation, cls).__new__(cls, action, path, dest, size, atime, mtime, link_mode, store,
+                                             compression, level)
+
+    def describe(self):
+        return {
+            'mkdir': "Creating directory {path}",
+            'copy': "Copying {path} -> {dest}",
+            'link': "Linking ({link_mode}) {path} -> {dest}",
+            'store': "Storing {path} -> {dest}",
+            'compress': "Compressing ({compression} level {level}) {path} -> {dest}",
+            'move': "Moving {path} -> {dest}",
+            'skip': "Skipping {path}, {dest} is up to date",
+            'delete': "Deleting old file: {path}",
+            'gc': "Deleting unreferenced files from store {path}",
+            'cleanup': "Deleting workspace file: {path}",
+        }[self.action].format(**self._asdict())
+
+
+class Plan(object):
+    """Immutable list of operations rolling the backups, which can be saved and applied later"""
+
+    def __init__(self, operations):
+        self.operations = tuple(operations)
+
+    def __iter__(self):
+        return iter(self.operations)
+
+    def __len__(self):
+        return len(self.operations)
+
+    def select(self, *actions):
+        return [operation for operation in self.operations if operation.action in actions]
+
+    def totals(self):
+        """Returns number of files and bytes per action"""
+        totals = collections.OrderedDict((action, {'files': 0, 'bytes': 0}) for action in ACTIONS)
+        for operation in self.operations:
+            totals[operation.action]['files'] += 1
+            totals[operation.action]['bytes'] += operation.size
+        return totals
+
+    def summary(self):
+        return ', '.join('{action}: {files} file(s), {bytes} bytes'.format(action=action, **total)
+                         for action, total in self.totals().items() if total['files'])
+
+    def to_dict(self):
+        return {
+            'version': PLAN_VERSION,
+            'totals': self.totals(),
+            'operations': [dict(operation._asdict()) for operation in self.operations],
+        }
+
+    @classmethod
+    def from_dict(cls, plan):
+        if plan.get('version') != PLAN_VERSION:
+            raise ValueError('Unsupported plan version: {version}'.format(version=plan.get('version')))
+        return cls(Operation(**operation) for operation in plan['operations'])
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+class Journal(object):
+    """
+    Write-ahead log of a run. The plan is written before any of its operations is executed, then operations are
+    appended as they complete, so a run interrupted by a crash can be resumed with the remaining operations. Lines
+    are JSON objects, a line cut by the crash is ignored
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def start(self, plan):
+        """Writes the plan, replacing journal of any previous run"""
+        with atomic_write(self.path) as (tmp,):
+            with open(tmp, 'w') as f:
+                f.write(json.dumps({'version': JOURNAL_VERSION, 'plan': plan.to_dict()}) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        self._file = open(self.path, 'a')
+
+    @staticmethod
+    def key(operation):
+        return [operation.action, operation.path, operation.dest]
+
+    def record(self, operations):
+        """Appends completed operations"""
+        self._file.write(json.dumps({'done': [self.key(operation) for operation in operations]}) + '\n')
+        self._file.flush()
+
+    def load(self):
+        """
+        Returns operations of the journaled plan which didn't complete, or None if there is no journal. The journal
+        is then appended to
+        """
+        try:
+            with open(self.path) as f:
+                lines = f.read().splitlines()
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        header = json.loads(lines[0])
+        if header.get('version') != JOURNAL_VERSION:
+            raise ValueError('Unsupported journal version: {version}'.format(version=header.get('version')))
+        plan = Plan.from_dict(header['plan'])
+        done = set()
+        for line in lines[1:]:
+            try:
+                done.update(tuple(key) for key in json.loads(line)['done'])
+            except ValueError:
+                logging.debug("Ignoring incomplete line of journal {path}".format(path=self.path))
+        self._file = open(self.path, 'a')
+        return Plan(operation for operation in plan
+                    if tuple(self.key(operation)) not in done and not self._completed(operation))
+
+    @staticmethod
+    def _completed(operation):
+        """Tells whether the operation completed, although the crash came before it was journaled"""
+        if operation.action == 'mkdir':
+            return os.path.isdir(operation.path)
+        if operation.action in ('move', 'delete', 'cleanup'):
+            return not os.path.lexists(operation.path)
+        return False
+
+    def finish(self, remove):
+        """Closes the journal, removing it if the run doesn't have to be resumed"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if remove and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _is_backup_name(name):
+    return not name.endswith(TEMP_SUFFIX) and name not in (INDEX_FILENAME, MANIFEST_FILENAME, JOURNAL_FILENAME)
+
+
+class InotifyWatcher(object):
+    """Reports files closed after writing or moved into a directory, using Linux inotify"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._fd = _inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        path = directory if isinstance(directory, bytes) else directory.encode(sys.getfilesystemencoding())
+        if _inotify_add_watch(self._fd, path, IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            error = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(error, os.strerror(error), directory)
+
+    def wait(self, timeout):
+        """Returns paths of files which landed in the directory, waiting for them up to timeout seconds"""
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self._fd, 64 * 1024)
+        paths = []
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0').decode(sys.getfilesystemencoding())
+            offset += length
+            if name and _is_backup_name(name):
+                path = os.path.join(self.directory, name)
+                if path not in paths:
+                    paths.append(path)
+        return paths
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher(object):
+    """
+    Reports files which appeared in a directory, once their size and modification time didn't change since the
+    previous scan. Files present when the watcher is created aren't reported
+    """
+
+    def __init__(self, directory, interval=10):
+        self.directory = directory
+        self.interval = interval
+        self._known = self._scan()
+        self._growing = {}
+
+    def _scan(self):
+        files = {}
+        for entry in scandir(self.directory):
+            if _is_backup_name(entry.name) and entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                files[entry.path] = (stat.st_size, stat.st_mtime)
+        return files
+
+    def wait(self, timeout):
+        """Returns paths of files which landed in the directory, scanning it after up to timeout seconds"""
+        time.sleep(min(self.interval, timeout))
+        files = self._scan()
+        paths = []
+        growing = {}
+        for path, stat in sorted(files.items()):
+            if self._known.get(path) == stat:
+                continue
+            if self._growing.get(path) == stat:
+                paths.append(path)
+            else:
+                growing[path] = stat
+        self._growing = growing
+        # files which are still being written are reported by one of the next scans
+        self._known = dict((path, stat) for path, stat in files.items() if path not in growing)
+        return paths
+
+    def close(self):
+        pass
+
+
+def tiers_by_day(retentions, days):
+    """Returns indexes of retentions collecting files of each of the days, looked up from their calendars at once"""
+    tiers = {}
+    for i, retention in enumerate(retentions):
+        for day in retention.filter_for_collect(days):
+            tiers.setdefault(day, []).append(i)
+    return tiers
+
+
+def create_plan(workspace, retentions, cleanup_retentions=True, cleanup_workspace=False):
+    """
+    Decides which files have to be collected and deleted, in a single pass over the workspace listing
+
+    :param workspace: Workspace to collect files from, or None to only clean up retentions
+    :param retentions: Retentions to collect files to and clean up
+    :param cleanup_retentions: Delete old files from retentions
+    :param cleanup_workspace: Delete all listed files from workspace. Each file is moved instead of copied to the
+    last retention collecting it, so the workspace is cleaned up by the move
+    :return: Plan
+    """
+    mkdirs = []
+    collects = [[] for _ in retentions]
+    # sources of destinations, files collected to a destination another file is collected to are left in workspace
+    destinations = {}
+    collisions = set()
+    if workspace is not None:
+        all_days = workspace.all_days()
+        link_modes = []
+        for retention in retentions:
+            if not storage_for(retention.directory).isdir(retention.directory):
+                mkdirs.append(Operation('mkdir', retention.directory))
+            link_modes.append(retention.link_mode_for(workspace))
+        tiers = tiers_by_day(retentions, all_days)
+        for day in sorted(tiers):
+            for src in workspace.list(day):
+                for i in tiers[day]:
+                    retention, link_mode, operations = retentions[i], link_modes[i], collects[i]
+                    operation = retention.collect_operation(workspace, src, link_mode)
+                    if operation.dest in destinations:
+                        if destinations[operation.dest] != src and src not in collisions:
+                            logging.error("Not collecting {src}, {other} is collected to {dest} already, leaving it "
+                                          "in workspace".format(src=src, other=destinations[operation.dest],
+                                                                dest=operation.dest))
+                            collisions.add(src)
+                        continue
+                    destinations[operation.dest] = src
+                    operations.append(operation)
+    deletes = []
+    if cleanup_retentions:
+        for retention in retentions:
+            # collected file may replace an old one of the same name
+            deletes.extend(retention.cleanup_operations(keep=destinations))
+        stores = []
+        for retention in retentions:
+            if retention.store is not None and retention.store.directory not in stores:
+                stores.append(retention.store.directory)
+        deletes.extend(Operation('gc', store) for store in stores)
+    cleanups = []
+    if cleanup_workspace and workspace is not None:
+        moved = set()
+        for operations in reversed(collects):
+            for i, operation in enumerate(operations):
+                if operation.action in ('copy', 'link') and operation.path not in moved:
+                    moved.add(operation.path)
+                    operations[i] = operation._replace(action='move', link_mode=None)
+        cleanups = [operation for operation in workspace.cleanup_operations()
+                    if operation.path not in moved and operation.path not in collisions]
+    return Plan(mkdirs + [operation for operations in collects for operation in operations] + deletes + cleanups)
+
+
+def device_of(directory):
+    """Returns device of the filesystem which has the directory or will have it once it is created"""
+    directory = os.path.abspath(directory)
+    while not os.path.isdir(directory):
+        # the directory will be created inside its nearest existing parent
+        directory = os.path.dirname(directory)
+    return os.stat(directory).st_dev
+
+
+def make_directory(directory):
+    mask = os.umask(0)
+    os.umask(mask)
+    perms = mask ^ 0o0777 # looks like os.mkdir ignores umask, so handle it manually
+    os.mkdir(directory, perms)
+
+
+def apply_plan(plan, dry_run=False, executor=None, directories=(), metrics=None, compress_threads=1, journal=None,
+               durability='none'):
+    """
+    Executes the plan. Directories are created first, then files are copied, then moved, then old files are deleted.
+    Files are moved and workspace files are deleted only if all the files were copied successfully, otherwise moves
+    are replaced with copies. Copies of the same file to several directories are made together, reading it once
+
+    :param plan: Plan to execute
+    :param dry_run: Only log the operations
+    :param executor: concurrent.futures.Executor running file operations, or None to run them one by one
+    :param directories: Directory objects which listings and indexes are kept up to date with the changes
+    :param metrics: Metrics counting processed files and durations of phases
+    :param compress_threads: Number of threads compressing chunks of a single large file
+    :param journal: Journal started with the plan, to which completed operations are appended
+    :param durability: When written files are flushed to disk, one of DURABILITY_MODES. Unless it is 'none', files
+    collected in a phase are durable before the next phase starts, so before any workspace file is deleted
+    :return: Number of failed operations
+    """
+    stores = dict((os.path.abspath(directory.store.directory), directory.store) for directory in directories
+                  if getattr(directory, 'store', None) is not None)
+    directories = dict((absolute_path(directory.directory), directory) for directory in directories)
+
+    def store_for(directory):
+        directory = os.path.abspath(directory)
+        if directory not in stores:
+            stores[directory] = BlobStore(directory)
+        return stores[directory]
+
+    # checksums of collected source files, shared by all retentions they are collected to
+    checksums = {}
+
+    def checksummed(task_, operations):
+        """
+        Wraps task collecting files to retentions which keep checksums. Data is hashed while it is written and the
+        written files are read back to verify it. Linked or renamed files are hashed by reading them, unless checksum
+        of the same source file is known already
+        """
+        dests = [operation.dest for operation in operations]
+        retentions = [directories.get(os.path.dirname(absolute_path(dest))) for dest in dests]
+        if not is_local(operations[0].path):
+            # files downloaded from other storages aren't hashed
+            return task_
+        if task_.run is None or not any(getattr(retention, 'checksums', False) for retention in retentions):
+            return task_
+        operation = operations[0]
+
+        def run():
+            if operation.action == 'store':
+                result = task_.run()
+                checksum = store_for(operation.store).checksum(
+                    operation.path, FileStat(None, operation.size, operation.atime, operation.mtime))
+            else:
+                hashed = hashlib.sha256()
+                result = task_.run(checksum=hashed)
+                if operation.action == 'compress' or result == 'copy':
+                    checksum = hashed.hexdigest()
+                    for dest in dests:
+                        verify_checksum(dest, checksum)
+                else:
+                    checksum = checksums.get(operation.path) or file_checksum(dests[0])
+            if operation.action != 'compress':
+                checksums[operation.path] = checksum
+            return result, checksum
+
+        def done(result):
+            result, checksum = result
+            if task_.done is not None:
+                task_.done(result)
+            for retention, dest in zip(retentions, dests):
+                if getattr(retention, 'checksums', False):
+                    retention.record_checksum(dest, checksum)
+
+        return task_._replace(run=run, done=done)
+
+    def journaled(task_, operations):
+        if journal is None or task_.run is None:
+            return task_
+
+        def done(result):
+            if task_.done is not None:
+                task_.done(result)
+            journal.record(operations)
+
+        return task_._replace(done=done)
+
+    # directories written in the current phase and not synced yet
+    unsynced = set()
+
+    def synced(task_, operations):
+        if durability == 'none' or task_.run is None:
+            return task_
+        paths = [operation.path if operation.action == 'mkdir' else operation.dest for operation in operations]
+        # other storages keep their files durable themselves
+        paths = [path for path in paths if is_local(path)]
+        written = set(os.path.dirname(os.path.abspath(path)) for path in paths)
+        for operation in operations:
+            if operation.action == 'move' and is_local(operation.path):
+                written.add(os.path.dirname(os.path.abspath(operation.path)))
+        # directories of blobs, known only once their links exist. The blob and its directory may be new
+        blob_directories = set()
+
+        def run(**kwargs):
+            result = task_.run(**kwargs)
+            for operation in operations:
+                if operation.action == 'store':
+                    blob_directory = os.path.dirname(os.path.realpath(operation.dest))
+                    blob_directories.update((blob_directory, os.path.dirname(blob_directory)))
+            if durability in ('batch', 'file'):
+                for path in paths:
+                    sync_file(path, data_only=durability == 'batch')
+            if durability == 'file':
+                # blobs have to be durable before links to them
+                for directory in sorted(blob_directories, reverse=True) + sorted(written - blob_directories):
+                    sync_directory(directory)
+            return result
+
+        def done(result):
+            if durability != 'file':
+                unsynced.update(written, blob_directories)
+            if task_.done is not None:
+                task_.done(result)
+
+        return task_._replace(run=run, done=done)
+
+    def task(operation):
+        task_ = journaled(_operation_task(operation), [operation])
+        if operation.action in ('mkdir', 'copy', 'link', 'store', 'compress', 'move'):
+            task_ = synced(task_, [operation])
+        if operation.action in ('copy', 'link', 'store', 'compress', 'move'):
+            task_ = checksummed(task_, [operation])
+        if metrics is None or task_.run is None or operation.action in ('mkdir', 'gc'):
+            return task_
+        directory = os.path.dirname(operation.dest or operation.path)
+
+        def measured():
+            start = time.time()
+            result = task_.run()
+            metrics.count(directory, operation.action, operation.size, time.time() - start)
+            return result
+
+        return task_._replace(run=measured)
+
+    def _operation_task(operation):
+        message = operation.describe()
+        if dry_run:
+            return Task(message)
+        directory = directories.get(os.path.dirname(absolute_path(operation.dest or operation.path)))
+        # files in storages other than the local filesystem are copied by storage_transfer
+        remote = not is_local(operation.path) or (operation.dest is not None and not is_local(operation.dest))
+        if operation.action == 'mkdir':
+            return Task(message, functools.partial(storage_for(operation.path).makedirs, operation.path))
+        if operation.action == 'move':
+            stat = FileStat(None, operation.size, operation.atime, operation.mtime)
+            src_directory = directories.get(os.path.dirname(absolute_path(operation.path)))
+
+            def moved(_):
+                if directory is not None:
+                    directory._record(operation.dest, stat)
+                if src_directory is not None:
+                    src_directory._forget(operation.path)
+
+            if remote:
+                return Task(message, functools.partial(storage_move, operation.path, operation.dest, stat), moved)
+            return Task(message, functools.partial(move_file, operation.path, operation.dest, stat,
+                                                   sync=durability != 'none'), moved)
+        if operation.action in ('copy', 'link'):
+            stat = FileStat(None, operation.size, operation.atime, operation.mtime)
+
+            def collected(method):
+                if operation.action == 'link' and method == 'copy':
+                    logging.debug("Copied {src} instead of linking".format(src=operation.path))
+                if directory is not None:
+                    directory._record(operation.dest, stat)
+
+            if remote:
+                return Task(message, functools.partial(storage_transfer, operation.path, operation.dest, stat),
+                            collected)
+            return Task(message, functools.partial(transfer, operation.path, operation.dest,
+                                                   operation.link_mode or 'copy', stat), collected)
+        if operation.action == 'store':
+            stat = FileStat(None, operation.size, operation.atime, operation.mtime)
+
+            def stored(method):
+                if method == 'dedup':
+                    logging.debug("{dest} has the same contents as a stored file".format(dest=operation.dest))
+                if directory is not None:
+                    directory._record(operation.dest, stat)
+
+            return Task(message, functools.partial(store_for(operation.store).add, operation.path, operation.dest,
+                                                   operation.link_mode or 'copy', stat), stored)
+        if operation.action == 'compress':
+            def compressed(size):
+                if directory is not None:
+                    directory._record(operation.dest, FileStat(None, size, operation.atime, operation.mtime))
+
+            return Task(message, functools.partial(
+                transfer_compressed, operation.path, operation.dest, operation.compression, operation.level,
+                FileStat(None, operation.size, operation.atime, operation.mtime), compress_threads), compressed)
+        if operation.action == 'gc':
+            def collected_garbage(deleted):
+                logging.info("Deleted {count} unreferenced file(s) from store, {size}".format(
+                    count=len(deleted), size=format_size(sum(size for _, size in deleted))))
+                for _, size in deleted:
+                    metrics.count(operation.path, 'gc', size)
+
+            return Task(message, store_for(operation.path).collect_garbage, collected_garbage)
+
+        def deleted(_):
+            if directory is not None:
+                directory._forget(operation.path)
+
+        return Task(message, functools.partial(storage_for(operation.path).delete, operation.path), deleted)
+
+    def fan_out_task(operations):
+        src = operations[0].path
+        dests = [operation.dest for operation in operations]
+        message = "Copying {path} -> {dests}".format(path=src, dests=', '.join(dests))
+        if dry_run:
+            return Task(message)
+        stat = FileStat(None, operations[0].size, operations[0].atime, operations[0].mtime)
+
+        def run(checksum=None):
+            start = time.time()
+            method = transfer_to_many(src, dests, stat, checksum)
+            seconds = (time.time() - start) / len(operations)
+            for operation in operations:
+                metrics.count(os.path.dirname(operation.dest), operation.action, operation.size, seconds)
+            return method
+
+        def copied(_):
+            for dest in dests:
+                directory = directories.get(os.path.dirname(absolute_path(dest)))
+                if directory is not None:
+                    directory._record(dest, stat)
+
+        return checksummed(synced(journaled(Task(message, run, copied), operations), operations), operations)
+
+    def tasks(operations):
+        """Returns tasks executing operations, copies of the same file are grouped into a single task"""
+        copies = collections.OrderedDict()
+        for operation in operations:
+            if operation.action == 'copy' and is_local(operation.path) and is_local(operation.dest):
+                copies.setdefault(operation.path, []).append(operation)
+        result = []
+        for operation in operations:
+            if operation.action != 'copy' or not is_local(operation.path) or not is_local(operation.dest):
+                result.append(task(operation))
+                continue
+            group = copies.pop(operation.path, None)
+            if group is not None:
+                result.append(task(group[0]) if len(group) == 1 else fan_out_task(group))
+        return result
+
+    if metrics is None:
+        metrics = Metrics()
+    for operation in plan.select('skip'):
+        logging.debug(operation.describe())
+        metrics.count(os.path.dirname(operation.dest), operation.action, operation.size)
+    failures = collections.OrderedDict((phase, 0) for phase, _ in APPLY_PHASES)
+    for phase, actions in APPLY_PHASES:
+        operations = plan.select(*actions)
+        if phase == 'move' and failures['collect'] and operations:
+            logging.warning("{count} file(s) couldn't be collected, files are copied instead of moved".format(
+                count=failures['collect']))
+            operations = [operation._replace(action='copy') for operation in operations]
+        if phase == 'workspace_cleanup' and (failures['collect'] or failures['move']) and operations:
+            logging.error("{count} file(s) couldn't be collected, workspace is left untouched".format(
+                count=failures['collect'] + failures['move']))
+            break
+        with metrics.phase(phase):
+            # directories have to be created before anything is copied to them
+            failures[phase] += run_tasks([task(operation) for operation in operations if operation.action == 'mkdir'])
+            failures[phase] += run_tasks(tasks([operation for operation in operations if operation.action != 'mkdir']),
+                                         executor)
+        if unsynced:
+            with metrics.phase('sync'):
+                sync_directories(sorted(unsynced), durability)
+            unsynced.clear()
+    failures = sum(failures.values())
+    if not dry_run:
+        for directory in directories.values():
+            directory.save_index()
+            if isinstance(directory, Retention):
+                directory.save_manifest()
+    metrics.failures += failures
+    return failures
+
+
+def _positive(value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError('invalid positive number: {value}'.format(value=value))
+    return number
+
+
+def _yearday(value):
+    try:
+        month, day = (int(part) for part in value.split('-'))
+        datetime.date(2000, month, day)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid day of year: {value}'.format(value=value))
+    return month, day
+
+
+def create_parser():
+    """Returns parser of command line arguments"""
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-s', '--workspace-dir', type=str,
                         help='Directory where backups are available initially. Files will be copied from this directory '
@@ -235,6 +2862,8 @@ def main(args_):
                         help='Directory where weekly backups will be copied to. Defaults to WORKSPACE_DIR/weekly.')
     parser.add_argument('-m', '--monthly-dir', type=str,
                         help='Directory where monthly backups will be copied to. Defaults to WORKSPACE_DIR/monthly.')
+    parser.add_argument('-y', '--yearly-dir', type=str,
+                        help='Directory where yearly backups will be copied to. Defaults to WORKSPACE_DIR/yearly.')
     parser.add_argument('-D', '--daily-retention', default=30, type=int,
                         help='How many days daily backups will be kept before being deleted',
                         metavar='DAYS')
@@ -244,6 +2873,9 @@ def main(args_):
     parser.add_argument('-M', '--monthly-retention', default=12, type=int,
                         help='How many months monthly backups will be kept before being deleted',
                         metavar='MONTHS')
+    parser.add_argument('-Y', '--yearly-retention', default=5, type=int,
+                        help='How many years yearly backups will be kept before being deleted',
+                        metavar='YEARS')
     parser.add_argument('--weekdays', default=[6], nargs='*', type=int,
                         help='Weekdays to store weekly backups. 0 is monday .. 6 is sunday. '
                              'Empty value disables weekly backups',
@@ -253,10 +2885,129 @@ def main(args_):
                              'negative values means n-th day from the end of the month (-1 is 31st of Jan, but 28th '
                              'or 29th of Feb etc.). Empty value disables monthly backups',
                         metavar='MONTHDAY')
+    parser.add_argument('--yeardays', default=[], nargs='*', type=_yearday,
+                        help='Days of year to store yearly backups, as MM-DD. Empty value disables yearly backups',
+                        metavar='MM-DD')
+    for retention, unit in (('daily', 'DAYS'), ('weekly', 'WEEKS'), ('monthly', 'MONTHS'), ('yearly', 'YEARS')):
+        parser.add_argument('--{retention}-keep-last'.format(retention=retention), type=int,
+                            help='Keep {retention} backups of N most recent days instead of those younger than '
+                                 '{unit}'.format(retention=retention, unit=unit),
+                            metavar='N')
     parser.add_argument('-k', '--keep-old-backups', action='store_true',
                         help='Do not delete any old backups from retentions\' directories')
     parser.add_argument('-K', '--keep-workspace', action='store_true',
                         help='Do not delete files from workspace directory')
+    parser.add_argument('--link-mode', default='copy', choices=LINK_MODES,
+                        help='How files are placed in retentions\' directories. "hardlink" and "reflink" link files '
+                             'instead of copying them if workspace and retention directories are on the same '
+                             'filesystem and fall back to copying otherwise. "auto" tries reflink, then hardlink, '
+                             'then copy')
+    parser.add_argument('--incremental', choices=INCREMENTAL_MODES,
+                        help='Do not collect files already present in retentions\' directories. "size-mtime" '
+                             'compares size and modification time, "checksum" compares size and contents')
+    parser.add_argument('--index', action='store_true',
+                        help='Keep listing index file ({index}) in workspace and retentions\' directories, so only '
+                             'new files are stat\'ed on subsequent runs and unchanged directories aren\'t scanned at '
+                             'all. Files mustn\'t be modified in place'.format(index=INDEX_FILENAME))
+    parser.add_argument('--include', default=[], nargs='+', type=str,
+                        help='Only collect files of names matching any of the glob patterns from the workspace. '
+                             'Names are matched before files are stat\'ed. Retentions always list all their files, so '
+                             'files collected earlier are cleaned up regardless of the patterns',
+                        metavar='GLOB')
+    parser.add_argument('--exclude', default=[], nargs='+', type=str,
+                        help='Ignore files of names matching any of the glob patterns in the workspace. Like '
+                             '--include, it doesn\'t apply to retentions',
+                        metavar='GLOB')
+    parser.add_argument('--name-date', type=str,
+                        help='Take dates of backups from their file names instead of modification times, so they '
+                             'don\'t need to be stat\'ed. Either strptime format using %%Y, %%m, %%d, %%H, %%M and '
+                             '%%S, e.g. "db-%%Y%%m%%d", or regular expression with named groups year, month, day, and '
+                             'optionally hour, minute and second. Files of names without the date fall back to '
+                             'modification times',
+                        metavar='PATTERN')
+    parser.add_argument('--store', type=str,
+                        help='Keep contents of collected files in content-addressed store in STORE_DIR, shared by all '
+                             'retentions, and only symbolic links to it in retentions\' directories. Identical files '
+                             'are stored once. Files no longer linked from any retention are deleted from the store '
+                             'together with old backups',
+                        metavar='STORE_DIR')
+    parser.add_argument('--s3-endpoint-url', type=str,
+                        help='Endpoint of S3 compatible object storage other than AWS. Any of the directories may be '
+                             'given as s3://BUCKET/PREFIX URL, files are then copied between prefixes by the storage '
+                             'itself, and uploaded or downloaded from local directories. Requires boto3 package',
+                        metavar='URL')
+    parser.add_argument('--compress', choices=[name for name, codec in CODECS.items() if codec.available],
+                        help='Compress files collected to retentions\' directories, adding extension of the format '
+                             'to their names. Files which are already compressed are collected as they are')
+    for retention, preset in (('daily', 'fast'), ('weekly', 'default'), ('monthly', 'best'), ('yearly', 'best')):
+        parser.add_argument('--{retention}-compress-level'.format(retention=retention), type=int,
+                            help='Compression level of {retention} backups. Defaults to {preset} level of the '
+                                 'format'.format(retention=retention, preset=preset),
+                            metavar='LEVEL')
+    parser.add_argument('--compress-threads', default=1, type=int,
+                        help='Number of threads compressing a single large file, chunk by chunk',
+                        metavar='N')
+    parser.add_argument('--checksums', action='store_true',
+                        help='Keep SHA-256 checksums of collected files in {manifest} file in retentions\' '
+                             'directories, in sha256sum format. Files are hashed while they are copied and verified '
+                             'after that'.format(manifest=MANIFEST_FILENAME))
+    parser.add_argument('--verify', action='store_true',
+                        help='Only check files in retentions\' directories against their checksums kept by '
+                             '--checksums, in parallel with -j')
+    parser.add_argument('--durability', default='none', choices=DURABILITY_MODES,
+                        help='When collected files are flushed to disk. "none" leaves it to the operating system, '
+                             '"batch" flushes each file in parallel jobs and each directory once, "syncfs" flushes '
+                             'each filesystem once, "file" flushes each file and its directory right away. Unless it '
+                             'is "none", collected files are on disk before workspace files are deleted')
+    parser.add_argument('-j', '--jobs', default=1, type=_positive,
+                        help='Number of files stat\'ed, copied or deleted in parallel. Values above 1 also process '
+                             'retentions in parallel. On high-latency storage like NFS or FUSE mounts raise it well '
+                             'above the number of CPUs, so round trips overlap instead of adding up',
+                        metavar='N')
+    parser.add_argument('--plan-out', type=str,
+                        help='Only decide which files would be copied and deleted and save this plan as JSON to '
+                             'PLAN_OUT, to be reviewed and applied later with --apply',
+                        metavar='PLAN_OUT')
+    parser.add_argument('--apply', type=str,
+                        help='Execute plan saved earlier with --plan-out instead of scanning directories. Retention '
+                             'options and -k/-K are taken from the plan',
+                        metavar='PLAN')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue a run interrupted by a crash, executing only operations which didn\'t '
+                             'complete, as recorded in its journal ({journal}) in workspace directory. Runs normally '
+                             'if there is no journal'.format(journal=JOURNAL_FILENAME))
+    parser.add_argument('--metrics-file', type=str,
+                        help='Write durations of phases and numbers of processed files and bytes to this file in '
+                             'Prometheus text format, e.g. for node_exporter textfile collector',
+                        metavar='PATH')
+    parser.add_argument('--metrics-json', type=str,
+                        help='Write durations of phases and numbers of processed files and bytes to this file as JSON',
+                        metavar='PATH')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running after the roll and collect each file as soon as it is written to the '
+                             'workspace, watching it with inotify or by polling where inotify isn\'t available. Old '
+                             'backups are deleted every --cleanup-interval. Stop with Ctrl-C or SIGINT')
+    parser.add_argument('--watch-interval', default=10, type=float,
+                        help='Seconds between scans of the workspace when it is polled by --watch',
+                        metavar='SECONDS')
+    parser.add_argument('--cleanup-interval', default=3600, type=float,
+                        help='Seconds between deletions of old backups by --watch',
+                        metavar='SECONDS')
+    parser.add_argument('--config', type=str,
+                        help='Run jobs listed in this file instead of a single workspace, in one process pool. JSON '
+                             'file (.json) has "jobs" object with options of each job by its name, and "defaults" '
+                             'object with options of all jobs. INI file has a section with options of each job, and '
+                             'options of all jobs in [DEFAULT] section. Options are long names of command line '
+                             'arguments, e.g. workspace-dir, values in INI file are split like shell arguments. '
+                             'Arguments given on command line are defaults of all jobs',
+                        metavar='PATH')
+    parser.add_argument('--processes', default=4, type=_positive,
+                        help='Number of jobs from --config run at once, each in a worker process',
+                        metavar='N')
+    parser.add_argument('--per-device', default=1, type=_positive,
+                        help='Number of jobs from --config run at once with any of their directories on the same '
+                             'filesystem',
+                        metavar='N')
     parser.add_argument('-n', '--dry-run', action='store_true',
                         help='Do not copy or delete files, only print what would be done')
     parser.add_argument('-o', '--offset-hours', default=6, type=int,
@@ -268,14 +3019,19 @@ def main(args_):
     parser.add_argument('-v', '--verbose', action='store_true', help='Verbose output')
     parser.add_argument('-q', '--quiet', action='store_true', default=False,
                         help='Do not print anything to stdout')
-    args = parser.parse_args(args_)
+    return parser
+
 
+def setup_logging(args):
     LoggerSetup(logging.INFO)
     if args.quiet:
         LoggerSetup(logging.WARNING)
     if args.verbose:
         LoggerSetup(logging.DEBUG)
 
+
+def resolve_directories(args):
+    """Fills in default directories of parsed command line arguments"""
     if args.workspace_dir is None:
         args.workspace_dir = os.getcwd()
     if args.daily_dir is None:
@@ -284,32 +3040,349 @@ def main(args_):
         args.weekly_dir = os.path.join(args.workspace_dir, 'weekly')
     if args.monthly_dir is None:
         args.monthly_dir = os.path.join(args.workspace_dir, 'monthly')
+    if args.yearly_dir is None:
+        args.yearly_dir = os.path.join(args.workspace_dir, 'yearly')
 
-    if os.path.realpath(args.workspace_dir) == os.path.realpath(os.path.dirname(__file__)):
-        logging.error("Executing this script for itself directory isn't a good idea")
-        sys.exit(1)
 
-    workspace = Workspace(args.workspace_dir, args.offset_hours)
+def create_directories(args):
+    """Returns workspace and retentions of parsed command line arguments"""
+    if S3Storage.scheme not in STORAGES and any(not is_local(directory) for directory in (
+            args.workspace_dir, args.daily_dir, args.weekly_dir, args.monthly_dir, args.yearly_dir)):
+        STORAGES[S3Storage.scheme] = S3Storage(endpoint_url=args.s3_endpoint_url,
+                                               max_pool_connections=max(10, args.jobs))
+    workspace = Workspace(args.workspace_dir, args.offset_hours, use_index=args.index, include=args.include,
+                          exclude=args.exclude, name_date=args.name_date)
+    store = BlobStore(args.store) if args.store else None
     retentions = []
+    if args.yeardays:
+        retentions.append(YearlyRetention(retention_dir=args.yearly_dir,
+                                          offset_hours=args.offset_hours,
+                                          keep_years=args.yearly_retention,
+                                          yeardays=args.yeardays,
+                                          keep_last=args.yearly_keep_last,
+                                          link_mode=args.link_mode,
+                                          incremental=args.incremental,
+                                          store=store,
+                                          compression=args.compress,
+                                          compress_level=args.yearly_compress_level,
+                                          checksums=args.checksums,
+                                          use_index=args.index,
+                                          name_date=args.name_date))
     if args.monthdays:
         retentions.append(MonthlyRetention(retention_dir=args.monthly_dir,
                                            offset_hours=args.offset_hours,
                                            keep_months=args.monthly_retention,
-                                           monthdays=args.monthdays))
+                                           monthdays=args.monthdays,
+                                           keep_last=args.monthly_keep_last,
+                                           link_mode=args.link_mode,
+                                           incremental=args.incremental,
+                                           store=store,
+                                           compression=args.compress,
+                                           compress_level=args.monthly_compress_level,
+                                           checksums=args.checksums,
+                                           use_index=args.index,
+                                           name_date=args.name_date))
     if args.weekdays:
         retentions.append(WeeklyRetention(retention_dir=args.weekly_dir,
                                           offset_hours=args.offset_hours,
                                           keep_weeks=args.weekly_retention,
-                                          weekdays=args.weekdays))
+                                          weekdays=args.weekdays,
+                                          keep_last=args.weekly_keep_last,
+                                          link_mode=args.link_mode,
+                                          incremental=args.incremental,
+                                          store=store,
+                                          compression=args.compress,
+                                          compress_level=args.weekly_compress_level,
+                                          checksums=args.checksums,
+                                          use_index=args.index,
+                                          name_date=args.name_date))
     retentions.append(DailyRetention(retention_dir=args.daily_dir,
                                      offset_hours=args.offset_hours,
-                                     keep_days=args.daily_retention))
-    for retention in retentions:
-        retention.collect(workspace, dry_run=args.dry_run)
-        if not args.keep_old_backups:
-            retention.cleanup(dry_run=args.dry_run)
-    if not args.keep_workspace:
-        workspace.cleanup(dry_run=args.dry_run)
+                                     keep_days=args.daily_retention,
+                                     keep_last=args.daily_keep_last,
+                                     link_mode=args.link_mode,
+                                     incremental=args.incremental,
+                                     store=store,
+                                     compression=args.compress,
+                                     compress_level=args.daily_compress_level,
+                                     checksums=args.checksums,
+                                     use_index=args.index,
+                                     name_date=args.name_date))
+    return workspace, retentions
+
+
+def create_watcher(args):
+    """
+    Starts watching the workspace, with inotify where it's available
+
+    :param args: argparse.Namespace from create_parser
+    :return: InotifyWatcher or PollingWatcher
+    """
+    resolve_directories(args)
+    if _inotify_init1 is not None and _inotify_add_watch is not None:
+        return InotifyWatcher(args.workspace_dir)
+    logging.debug("inotify isn't available, polling {workspace}".format(workspace=args.workspace_dir))
+    return PollingWatcher(args.workspace_dir, args.watch_interval)
+
+
+def watch(args, watcher=None):
+    """
+    Collects files to retentions as soon as they land in the workspace, until interrupted. Old files are deleted from
+    retentions every args.cleanup_interval seconds
+
+    :param args: argparse.Namespace from create_parser
+    :param watcher: InotifyWatcher or PollingWatcher of the workspace, created by create_watcher if not given
+    :return: Number of failures
+    """
+    resolve_directories(args)
+    workspace, retentions = create_directories(args)
+    if watcher is None:
+        watcher = create_watcher(args)
+    executor = ThreadPoolExecutor(max_workers=args.jobs) if args.jobs > 1 else None
+    logging.info("Watching {workspace}".format(workspace=args.workspace_dir))
+    failures = 0
+    next_cleanup = time.time() + args.cleanup_interval
+    try:
+        while True:
+            paths = [path for path in watcher.wait(max(0, next_cleanup - time.time())) if os.path.isfile(path)]
+            if paths:
+                landed = workspace.subset(paths)
+                plan = create_plan(landed, retentions, cleanup_retentions=False,
+                                   cleanup_workspace=not args.keep_workspace)
+                metrics = Metrics()
+                failures += apply_plan(plan, dry_run=args.dry_run, executor=executor, directories=[landed] + retentions,
+                                       metrics=metrics, compress_threads=args.compress_threads,
+                                       durability=args.durability)
+                logging.info(metrics.summary())
+            if time.time() >= next_cleanup:
+                if not args.keep_old_backups:
+                    for retention in retentions:
+                        # files may have been changed by others since they were listed
+                        retention.refresh()
+                    failures += apply_plan(create_plan(None, retentions), dry_run=args.dry_run, executor=executor,
+                                           directories=retentions, durability=args.durability)
+                next_cleanup = time.time() + args.cleanup_interval
+    except KeyboardInterrupt:
+        logging.info("Stopped watching {workspace}".format(workspace=args.workspace_dir))
+    finally:
+        watcher.close()
+        if executor is not None:
+            executor.shutdown()
+    return failures
+
+
+def roll(args, metrics=None):
+    """
+    Rolls backups of a single workspace as requested by parsed command line arguments
+
+    :param args: argparse.Namespace from create_parser
+    :param metrics: Metrics of the run
+    :return: Number of failures
+    """
+    resolve_directories(args)
+    if os.path.realpath(args.workspace_dir) == os.path.realpath(os.path.dirname(__file__)):
+        logging.error("Executing this script for itself directory isn't a good idea")
+        return 1
+    workspace, retentions = create_directories(args)
+    # runs with workspace in another storage aren't journaled
+    journal = Journal(os.path.join(args.workspace_dir, JOURNAL_FILENAME)) if is_local(args.workspace_dir) else None
+    if args.resume and journal is None:
+        logging.error("Runs with workspace {workspace} can't be resumed".format(workspace=args.workspace_dir))
+        return 1
+    executor = ThreadPoolExecutor(max_workers=args.jobs) if args.jobs > 1 else None
+    if args.verify:
+        tasks = [task for retention in retentions for task in retention.verify_tasks()]
+        failures = run_tasks(tasks, executor)
+        if executor is not None:
+            executor.shutdown()
+        logging.info("Verified {count} file(s), {failures} failure(s)".format(count=len(tasks), failures=failures))
+        return failures
+    if metrics is None:
+        metrics = Metrics()
+    plan = None
+    if args.resume:
+        plan = journal.load()
+        if plan is None:
+            logging.info("No interrupted run to resume")
+        else:
+            logging.info("Resuming interrupted run: {summary}".format(summary=plan.summary() or 'empty'))
+    elif journal is not None and os.path.exists(journal.path):
+        logging.warning("Previous run was interrupted, it is planned again. Use --resume to continue it instead")
+    if plan is not None:
+        resumed = True
+    elif args.apply:
+        resumed = False
+        plan = Plan.load(args.apply)
+    else:
+        resumed = False
+        with metrics.phase('listing'):
+            if not storage_for(workspace.directory).isdir(workspace.directory):
+                logging.warning("Workspace {directory} doesn't exist".format(directory=workspace.directory))
+            for directory in [workspace] + retentions:
+                directory.listing(executor)
+        with metrics.phase('planning'):
+            plan = create_plan(workspace, retentions, cleanup_retentions=not args.keep_old_backups,
+                               cleanup_workspace=not args.keep_workspace)
+    if args.plan_out:
+        if executor is not None:
+            executor.shutdown()
+        plan.save(args.plan_out)
+        logging.info("Plan saved to {path}: {summary}".format(path=args.plan_out, summary=plan.summary() or 'empty'))
+        return 0
+    logging.debug("Plan: {summary}".format(summary=plan.summary() or 'empty'))
+    if args.dry_run:
+        journal = None
+    if journal is not None and not resumed:
+        journal.start(plan)
+    failures = apply_plan(plan, dry_run=args.dry_run, executor=executor, directories=[workspace] + retentions,
+                          metrics=metrics, compress_threads=args.compress_threads,
+                          journal=journal, durability=args.durability)
+    if executor is not None:
+        executor.shutdown()
+    # failed operations are left in the journal to be retried by --resume
+    if journal is not None:
+        journal.finish(remove=not failures)
+    if args.dry_run:
+        logging.info("Dry run. Plan: {summary}".format(summary=plan.summary() or 'empty'))
+    else:
+        logging.info(metrics.summary())
+    if args.metrics_json:
+        metrics.write_json(args.metrics_json)
+    if args.metrics_file:
+        metrics.write_prometheus(args.metrics_file)
+    return failures
+
+
+def _config_args(options, split=False):
+    """Returns command line arguments of a job from its options in a configuration file"""
+    args = []
+    for name, value in options.items():
+        if split and value.lower() in ('true', 'yes', 'on', 'false', 'no', 'off'):
+            value = value.lower() in ('true', 'yes', 'on')
+        elif split:
+            value = shlex.split(value)
+        if value is False or value is None:
+            continue
+        args.append('--' + name.replace('_', '-'))
+        if isinstance(value, list):
+            args.extend(str(item) for item in value)
+        elif value is not True:
+            args.append(str(value))
+    return args
+
+
+def load_config(path):
+    """
+    Reads jobs from a configuration file, see --config
+
+    :return: OrderedDict of command line arguments of jobs by their names
+    """
+    if path.endswith('.json'):
+        with open(path) as f:
+            config = json.load(f, object_pairs_hook=collections.OrderedDict)
+        jobs = collections.OrderedDict()
+        for name, options in config.get('jobs', {}).items():
+            job_options = collections.OrderedDict(config.get('defaults', {}))
+            job_options.update(options)
+            jobs[name] = _config_args(job_options)
+        return jobs
+    config = configparser.RawConfigParser()
+    with open(path) as f:
+        (config.read_file if hasattr(config, 'read_file') else config.readfp)(f)
+    return collections.OrderedDict((name, _config_args(collections.OrderedDict(config.items(name)), split=True))
+                                   for name in config.sections())
+
+
+def _run_job(args_, defaults):
+    """Runs a job from a configuration file in a worker process, returns number of its failures and its summary"""
+    parser = create_parser()
+    parser.set_defaults(**defaults)
+    args = parser.parse_args(args_)
+    setup_logging(args)
+    metrics = Metrics()
+    failures = roll(args, metrics)
+    return failures, metrics.summary()
+
+
+def _job_devices(args_, defaults):
+    """Returns devices of filesystems with local directories of a job"""
+    parser = create_parser()
+    parser.set_defaults(**defaults)
+    args = parser.parse_args(args_)
+    resolve_directories(args)
+    return set(device_of(directory) for directory in (args.workspace_dir, args.daily_dir, args.weekly_dir,
+                                                       args.monthly_dir, args.yearly_dir, args.store)
+               if directory is not None and is_local(directory))
+
+
+def run_config(path, args, processes=4, per_device=1):
+    """
+    Runs jobs from a configuration file in a pool of worker processes. A job is started only when fewer than
+    per_device jobs are running with directories on any of the same filesystems
+
+    :param path: Path of the configuration file, see --config
+    :param args: Parsed command line arguments, defaults of all jobs
+    :param processes: Number of worker processes
+    :param per_device: Number of jobs running at once on the same filesystem
+    :return: Number of failed jobs
+    """
+    defaults = dict(vars(args), config=None)
+    jobs = load_config(path)
+    devices = dict((name, _job_devices(job_args, defaults)) for name, job_args in jobs.items())
+    results = collections.OrderedDict()
+    pending = list(jobs)
+    running = {}
+    busy = collections.Counter()
+    pool = ProcessPoolExecutor(max_workers=processes)
+    try:
+        while pending or running:
+            for name in list(pending):
+                if len(running) < processes and all(busy[device] < per_device for device in devices[name]):
+                    pending.remove(name)
+                    busy.update(devices[name])
+                    logging.debug("Starting job {name}".format(name=name))
+                    running[pool.submit(_run_job, jobs[name], defaults)] = name
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                busy.subtract(devices[name])
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    logging.error("Job {name} failed: {error}".format(name=name, error=e))
+                    results[name] = (1, None)
+    finally:
+        pool.shutdown()
+    failed = 0
+    for name in jobs:
+        failures, summary = results[name]
+        if failures:
+            failed += 1
+            logging.error("Job {name}: {failures} failure(s)".format(name=name, failures=failures))
+        if summary is not None:
+            logging.info("Job {name}: {summary}".format(name=name, summary=summary))
+    logging.info("Ran {count} job(s), {failed} failed".format(count=len(jobs), failed=failed))
+    return failed
+
+
+def main(args_):
+    args = create_parser().parse_args(args_)
+    setup_logging(args)
+    if args.config:
+        failures = run_config(args.config, args, args.processes, args.per_device)
+    else:
+        # armed before the first roll lists the workspace, so files landing while it runs are collected too
+        watcher = create_watcher(args) if args.watch else None
+        try:
+            failures = roll(args)
+        except BaseException:
+            if watcher is not None:
+                watcher.close()
+            raise
+        if watcher is not None:
+            failures += watch(args, watcher)
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
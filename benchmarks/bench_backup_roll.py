@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+"""
+Benchmarks of listing, planning, collecting and cleaning up synthetic workspaces
+
+Generates a workspace and a daily retention with files spread over a calendar, then times every phase of a roll and
+counts syscalls made by it. Results are printed as a table and optionally written as JSON, so they can be compared
+between releases::
+
+    python benchmarks/bench_backup_roll.py --files 10000 100000 --calendar dense sparse --output bench.json
+
+Costs of durability modes are compared by collecting with each of them::
+
+    python benchmarks/bench_backup_roll.py --sizes mixed --durability none batch syncfs file
+
+Bytes read and written while copying sparse disk images are compared with their apparent size, with and without
+skipping holes::
+
+    python benchmarks/bench_backup_roll.py --files 100 --sizes sparse --copy sparse dense
+"""
+
+import argparse
+import contextlib
+import datetime
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from backup_roll import backup_roll  # noqa: E402
+
+# os functions counted as syscalls, DirEntry.stat is counted separately
+COUNTED_CALLS = ('stat', 'lstat', 'fstat', 'open', 'remove', 'unlink', 'rename', 'replace', 'link', 'utime',
+                 'mkdir', 'listdir', 'copy_file_range', 'sendfile', 'fsync', 'fdatasync', 'sync', 'lseek')
+
+SIZES = {
+    'empty': lambda rnd: 0,
+    'small': lambda rnd: rnd.randint(1, 4096),
+    'mixed': lambda rnd: int(rnd.paretovariate(1.2) * 4096),
+    # apparent sizes of sparse files, see SPARSE_EXTENTS
+    'sparse': lambda rnd: rnd.randint(1, 64) * 1024 * 1024,
+}
+
+# number and size of data extents written to sparse files, the rest of them are holes
+SPARSE_EXTENTS = (4, 64 * 1024)
+
+# 'dense' copies sparse files as if they had no holes
+COPY_MODES = ('sparse', 'dense')
+
+# (days the files are spread over, fraction of days which have files)
+CALENDARS = {
+    'dense': (60, 1.0),
+    'sparse': (3 * 365, 0.1),
+}
+
+MTIME_DISTRIBUTIONS = ('uniform', 'nightly')
+
+PHASES = ('listing', 'retention_listing', 'planning', 'collect', 'cleanup')
+
+# bytes passed to read and write calls by the process, counted by Linux
+PROC_IO = '/proc/self/io'
+
+
+class SyscallCounter(object):
+
+    def __init__(self):
+        self.counts = {}
+
+    def _count(self, name):
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    @contextlib.contextmanager
+    def patch(self):
+        counter = self
+        originals = dict((name, getattr(os, name)) for name in COUNTED_CALLS if hasattr(os, name))
+        scandir = backup_roll.scandir
+
+        def counting(name, function):
+            def wrapper(*args, **kwargs):
+                counter._count(name)
+                return function(*args, **kwargs)
+            return wrapper
+
+        class CountingEntry(object):
+            def __init__(self, entry):
+                self._entry = entry
+                self.name = entry.name
+                self.path = entry.path
+
+            def __getattr__(self, item):
+                return getattr(self._entry, item)
+
+            def stat(self, *args, **kwargs):
+                counter._count('stat')
+                return self._entry.stat(*args, **kwargs)
+
+        def counting_scandir(*args, **kwargs):
+            counter._count('scandir')
+            return (CountingEntry(entry) for entry in scandir(*args, **kwargs))
+
+        for name, function in originals.items():
+            setattr(os, name, counting(name, function))
+        backup_roll.scandir = counting_scandir
+        try:
+            yield self
+        finally:
+            for name, function in originals.items():
+                setattr(os, name, function)
+            backup_roll.scandir = scandir
+
+
+def io_counters():
+    """Returns bytes read and written by the process so far, (None, None) if not available"""
+    try:
+        with open(PROC_IO) as f:
+            counters = dict(line.split(':') for line in f)
+    except (IOError, OSError):
+        return None, None
+    return int(counters['rchar']), int(counters['wchar'])
+
+
+def allocated_bytes(paths):
+    """Returns bytes of disk space allocated to the files"""
+    return sum(os.lstat(path).st_blocks * 512 for path in paths)
+
+
+def generate(directory, files, calendar, sizes, distribution, seed):
+    """Creates files with modification times spread over the calendar ending today"""
+    rnd = random.Random(seed)
+    days, density = CALENDARS[calendar]
+    today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    # calendar always ends with today's backup
+    calendar_days = [today - datetime.timedelta(days=day) for day in range(days) if not day or rnd.random() < density]
+    size = SIZES[sizes]
+    total_bytes = 0
+    for i in range(files):
+        day = rnd.choice(calendar_days)
+        if distribution == 'nightly':
+            # backups finishing around midnight, exercising the offset
+            mtime = day + datetime.timedelta(minutes=rnd.gauss(0, 90))
+        else:
+            mtime = day + datetime.timedelta(seconds=rnd.randint(0, 86399))
+        path = os.path.join(directory, 'backup_{i:07d}.dump'.format(i=i))
+        file_size = size(rnd)
+        with open(path, 'wb') as f:
+            if sizes == 'sparse':
+                f.truncate(file_size)
+                count, extent_size = SPARSE_EXTENTS
+                for _ in range(count):
+                    f.seek(rnd.randrange(0, file_size - extent_size, 4096))
+                    f.write(b'\1' * extent_size)
+            elif file_size:
+                f.write(b'\0' * file_size)
+        timestamp = time.mktime(mtime.timetuple())
+        os.utime(path, (timestamp, timestamp))
+        total_bytes += file_size
+    return total_bytes
+
+
+def measure(results, phase, function):
+    counter = SyscallCounter()
+    read_start, written_start = io_counters()
+    start = time.time()
+    with counter.patch():
+        result = function()
+    read_end, written_end = io_counters()
+    results[phase] = {
+        'seconds': time.time() - start,
+        'syscalls': sum(counter.counts.values()),
+        'calls': counter.counts,
+        'read_bytes': read_end - read_start if read_start is not None else None,
+        'written_bytes': written_end - written_start if written_start is not None else None,
+    }
+    return result
+
+
+@contextlib.contextmanager
+def copy_mode(mode):
+    """Disables skipping holes of sparse files in 'dense' mode"""
+    is_sparse = backup_roll.is_sparse
+    if mode == 'dense':
+        backup_roll.is_sparse = lambda stat: False
+    try:
+        yield
+    finally:
+        backup_roll.is_sparse = is_sparse
+
+
+def run(base_dir, files, calendar, sizes, distribution, jobs, keep_days, seed, durability='none', copy='sparse'):
+    workspace_dir = os.path.join(base_dir, 'workspace')
+    retention_dir = os.path.join(base_dir, 'daily')
+    os.mkdir(workspace_dir)
+    os.mkdir(retention_dir)
+    workspace_bytes = generate(workspace_dir, files, calendar, sizes, distribution, seed)
+    # old backups for cleanup phase
+    generate(retention_dir, files, calendar, sizes, distribution, seed + 1)
+    executor = backup_roll.ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    phases = {}
+    try:
+        workspace = backup_roll.Workspace(workspace_dir)
+        daily = backup_roll.DailyRetention(retention_dir, keep_days=keep_days)
+        measure(phases, 'listing', workspace.listing)
+        measure(phases, 'retention_listing', daily.listing)
+        plan = measure(phases, 'planning', lambda: backup_roll.create_plan(workspace, [daily]))
+        with copy_mode(copy):
+            measure(phases, 'collect', lambda: backup_roll.apply_plan(
+                backup_roll.Plan(plan.select('mkdir', 'copy', 'link')), executor=executor, durability=durability))
+        collected_bytes = allocated_bytes(operation.dest for operation in plan.select('copy', 'link'))
+        measure(phases, 'cleanup', lambda: backup_roll.apply_plan(
+            backup_roll.Plan(plan.select('delete')), executor=executor))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    for phase in phases.values():
+        phase['files_per_second'] = files / phase['seconds'] if phase['seconds'] else None
+        phase['syscalls_per_file'] = float(phase['syscalls']) / files
+    return {
+        'files': files,
+        'calendar': calendar,
+        'sizes': sizes,
+        'distribution': distribution,
+        'jobs': jobs,
+        'durability': durability,
+        'copy': copy,
+        'workspace_bytes': workspace_bytes,
+        'workspace_allocated_bytes': allocated_bytes(os.path.join(workspace_dir, name)
+                                                     for name in os.listdir(workspace_dir)),
+        'collected_allocated_bytes': collected_bytes,
+        'totals': plan.totals(),
+        'phases': phases,
+    }
+
+
+def main(args_):
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', default=[10000], nargs='+', type=int, help='Numbers of files to benchmark with')
+    parser.add_argument('--calendar', default=['dense'], nargs='+', choices=sorted(CALENDARS),
+                        help='"dense" has files every day of two months, "sparse" on every tenth day of three years')
+    parser.add_argument('--sizes', default=['empty'], nargs='+', choices=sorted(SIZES),
+                        help='Distributions of file sizes')
+    parser.add_argument('--distribution', default=['uniform'], nargs='+', choices=MTIME_DISTRIBUTIONS,
+                        help='Distributions of modification times within a day')
+    parser.add_argument('-j', '--jobs', default=[1], nargs='+', type=int, help='Numbers of parallel jobs')
+    parser.add_argument('--durability', default=['none'], nargs='+', choices=backup_roll.DURABILITY_MODES,
+                        help='Durability modes of collecting')
+    parser.add_argument('--copy', default=['sparse'], nargs='+', choices=COPY_MODES,
+                        help='"sparse" skips holes of sparse files, "dense" reads and writes them')
+    parser.add_argument('--keep-days', default=30, type=int, help='Daily retention')
+    parser.add_argument('--seed', default=0, type=int, help='Random seed of generated files')
+    parser.add_argument('--dir', type=str, help='Directory to generate files in, defaults to system temp directory')
+    parser.add_argument('--output', type=str, help='Write results as JSON to this file')
+    args = parser.parse_args(args_)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = []
+    for files, calendar, sizes, distribution, jobs, durability, copy in itertools.product(
+            args.files, args.calendar, args.sizes, args.distribution, args.jobs, args.durability, args.copy):
+        base_dir = tempfile.mkdtemp(prefix='bench_backup_roll_', dir=args.dir)
+        try:
+            result = run(base_dir, files, calendar, sizes, distribution, jobs, args.keep_days, args.seed, durability,
+                         copy)
+        finally:
+            shutil.rmtree(base_dir)
+        results.append(result)
+        for phase in PHASES:
+            measured = result['phases'][phase]
+            io = ''
+            if measured['read_bytes'] is not None:
+                io = ' {read:>10} read {written:>10} written'.format(
+                    read=backup_roll.format_size(measured['read_bytes']),
+                    written=backup_roll.format_size(measured['written_bytes']))
+            print('{files:>8} {calendar:<6} {sizes:<6} {distribution:<7} j={jobs:<2} {durability:<6} {copy:<6} '
+                  '{phase:<17} {seconds:9.3f}s {syscalls_per_file:6.2f} syscalls/file{io}'.format(
+                      phase=phase, io=io, **dict(result, **measured)))
+        print('{files:>8} files of {apparent} apparent size, {allocated} allocated in workspace, {collected} in '
+              'collected copies'.format(files=files, apparent=backup_roll.format_size(result['workspace_bytes']),
+                                        allocated=backup_roll.format_size(result['workspace_allocated_bytes']),
+                                        collected=backup_roll.format_size(result['collected_allocated_bytes'])))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'results': results,
+            }, f, indent=1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,15 +1,29 @@
 # -*- coding: utf-8 -*-
+import contextlib
 import datetime
+import errno
+import functools
+import gzip
+import hashlib
+import json
 import logging
 import os
 import random
 import shutil
 import string
 import tempfile
+import threading
 import time
 import unittest
 
-from backup_roll.backup_roll import Workspace, DailyRetention, LoggerSetup, WeeklyRetention, MonthlyRetention
+try:
+    from unittest import mock
+except ImportError:  # python 2
+    import mock
+
+from backup_roll import backup_roll
+from backup_roll.backup_roll import Workspace, DailyRetention, LoggerSetup, WeeklyRetention, MonthlyRetention, main, \
+    transfer
 
 
 class TestBackupRoll(unittest.TestCase):
@@ -223,6 +237,638 @@ class TestWorkspace(TestBackupRoll):
         ]), set(result))
         self.assertEqual(2, len(result))
 
+    def test_workspace_listing_stats_each_file_once(self):
+        dt = datetime.datetime(2000, 12, 31)
+        files_count = 20
+        for i in range(files_count):
+            self._file('test{i}'.format(i=i), dt)
+        self._dir('testdir', dt)
+        counter = _StatCounter()
+
+        with counter.patch():
+            workspace = Workspace(self.test_dir)
+            workspace.all_days()
+            workspace.list(TestBackupRoll._dt2d(dt))
+            workspace.cleanup(dry_run=True)
+
+        self.assertLessEqual(counter.file_stats, files_count, 'each file should be stat\'ed at most once')
+        self.assertLessEqual(counter.os_stats, 1, 'only the directory itself should be stat\'ed by os.stat')
+
+    def test_workspace_cleanup_deletes_listed_files_only(self):
+        dt = datetime.datetime(2000, 12, 31)
+        self._file('listed', dt)
+        self._dir('testdir', dt)
+        workspace = Workspace(self.test_dir)
+        workspace.all_days()
+        self._file('new', dt)
+
+        workspace.cleanup()
+
+        self.assertFalse(os.path.exists(os.path.join(self.test_dir, 'listed')), '"listed" file should be deleted')
+        self.assertTrue(os.path.isfile(os.path.join(self.test_dir, 'new')), '"new" file should be kept')
+        self.assertTrue(os.path.isdir(os.path.join(self.test_dir, 'testdir')), 'directories should be kept')
+
+
+class TestIndex(TestBackupRoll):
+
+    def _age_directory(self):
+        past = TestBackupRoll._now() - 3600
+        os.utime(self.test_dir, (past, past))
+
+    def _save_index(self):
+        workspace = Workspace(self.test_dir, use_index=True)
+        workspace.listing()
+        workspace.save_index()
+
+    def test_index_is_created_and_not_listed(self):
+        dt = datetime.datetime(2000, 12, 31)
+        self._file('test', dt)
+
+        workspace = Workspace(self.test_dir, use_index=True)
+        result = workspace.list(TestBackupRoll._dt2d(dt))
+        workspace.save_index()
+
+        self.assertEqual([os.path.join(self.test_dir, 'test')], result)
+        self.assertTrue(os.path.isfile(os.path.join(self.test_dir, backup_roll.INDEX_FILENAME)))
+
+    def test_index_unchanged_directory_isnt_scanned(self):
+        dt = datetime.datetime(2000, 12, 31)
+        for i in range(5):
+            self._file('test{i}'.format(i=i), dt)
+        self._save_index()
+        self._age_directory()
+        self._save_index()
+        counter = _StatCounter()
+
+        with counter.patch():
+            with mock.patch.object(backup_roll, 'scandir', side_effect=AssertionError('directory was scanned')):
+                workspace = Workspace(self.test_dir, use_index=True)
+                result = workspace.list(TestBackupRoll._dt2d(dt))
+
+        self.assertEqual(5, len(result))
+        self.assertEqual(0, counter.file_stats)
+        self.assertEqual(dt, datetime.datetime.fromtimestamp(workspace.stat(result[0]).st_mtime))
+
+    def test_index_stats_only_new_files(self):
+        dt1 = datetime.datetime(2000, 12, 30)
+        dt2 = datetime.datetime(2000, 12, 31)
+        for i in range(5):
+            self._file('test{i}'.format(i=i), dt1)
+        self._save_index()
+        self._file('new', dt2)
+        counter = _StatCounter()
+
+        with counter.patch():
+            workspace = Workspace(self.test_dir, use_index=True)
+            workspace.listing()
+
+        self.assertEqual(1, counter.file_stats)
+        self.assertEqual([os.path.join(self.test_dir, 'new')], workspace.list(TestBackupRoll._dt2d(dt2)))
+        self.assertEqual(5, len(workspace.list(TestBackupRoll._dt2d(dt1))))
+
+    def test_index_notices_deleted_and_replaced_files(self):
+        dt1 = datetime.datetime(2000, 12, 30)
+        dt2 = datetime.datetime(2000, 12, 31)
+        self._file('deleted', dt1)
+        self._file('replaced', dt1)
+        self._save_index()
+        os.remove(os.path.join(self.test_dir, 'deleted'))
+        os.remove(os.path.join(self.test_dir, 'replaced'))
+        self._file('replaced', dt2)
+
+        workspace = Workspace(self.test_dir, use_index=True)
+
+        self.assertSetEqual(set([TestBackupRoll._dt2d(dt2)]), set(workspace.all_days()))
+
+    def test_index_is_rebuilt_for_different_offset(self):
+        dt = datetime.datetime(2000, 12, 30, 23, 0, 0)
+        self._file('test', dt)
+        self._save_index()
+        self._age_directory()
+
+        workspace = Workspace(self.test_dir, offset_hours=1, use_index=True)
+
+        self.assertSetEqual(set([datetime.date(2000, 12, 31)]), set(workspace.all_days()))
+
+    def test_index_follows_collect_and_cleanup(self):
+        midnight = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        self._file('today', midnight + datetime.timedelta(seconds=1))
+        self._file('old', midnight - datetime.timedelta(days=5))
+        workspace = Workspace(self.test_dir)
+        DailyRetention(self.retention_dir, keep_days=10, use_index=True).collect(workspace)
+
+        daily = DailyRetention(self.retention_dir, keep_days=1, use_index=True)
+        daily.cleanup()
+        result = DailyRetention(self.retention_dir, use_index=True).listing()
+
+        self.assertEqual([[os.path.join(self.retention_dir, 'today')]], list(result.values()))
+        self.assertEqual(daily.listing(), result)
+
+    def test_index_is_loaded_without_building_rows(self):
+        dt = datetime.datetime(2000, 12, 31)
+        for name in ('test', u'z\u00f3\u0142w', 'with space'):
+            self._file(name, dt)
+        self._save_index()
+        self._age_directory()
+        self._save_index()
+        expected = dict(Workspace(self.test_dir).listing())
+
+        with mock.patch.object(backup_roll.Listing, 'extend', side_effect=AssertionError('rows built one by one')):
+            workspace = Workspace(self.test_dir, use_index=True)
+            result = dict(workspace.listing())
+
+        self.assertEqual(expected, result)
+        self.assertEqual(4, workspace.stat(os.path.join(self.test_dir, u'z\u00f3\u0142w')).st_size)
+
+    def test_dry_run_and_plan_out_dont_write_index(self):
+        today = datetime.datetime.now().replace(hour=12, minute=0, second=0, microsecond=0)
+        workspace_dir = os.path.join(self.test_dir, 'workspace')
+        daily_dir = os.path.join(workspace_dir, 'daily')
+        os.makedirs(daily_dir)
+        self._file('backup', today, basedir=workspace_dir)
+        args = ['-q', '-o', '0', '-s', workspace_dir, '--weekdays', '--monthdays', '--index']
+
+        main(args + ['-n'])
+        main(args + ['--plan-out', os.path.join(self.test_dir, 'plan.json')])
+
+        for directory in (workspace_dir, daily_dir):
+            self.assertNotIn(backup_roll.INDEX_FILENAME, os.listdir(directory))
+        main(args + ['-K'])
+        for directory in (workspace_dir, daily_dir):
+            self.assertIn(backup_roll.INDEX_FILENAME, os.listdir(directory))
+
+
+class TestCopyFile(TestBackupRoll):
+
+    def _copy(self, **patches):
+        contents = ''.join(random.choice(string.ascii_letters) for _ in range(10000))
+        self._file('src', datetime.datetime(2000, 12, 31), contents=contents)
+        src = os.path.join(self.test_dir, 'src')
+        dest = os.path.join(self.test_dir, 'dest')
+        os.chmod(src, 0o640)
+        with contextlib.ExitStack() as stack:
+            for name, function in patches.items():
+                stack.enter_context(mock.patch.object(backup_roll.os, name, function))
+            method = backup_roll.copy_file(src, dest, bufsize=1000)
+        with open(dest) as f:
+            self.assertEqual(contents, f.read())
+        self.assertEqual(0o640, os.stat(dest).st_mode & 0o777)
+        return method
+
+    @staticmethod
+    def _unsupported(*args):
+        raise OSError(errno.ENOSYS, 'test')
+
+    @unittest.skipUnless(hasattr(os, 'copy_file_range'), 'copy_file_range not available')
+    def test_copy_file_uses_copy_file_range(self):
+        self.assertEqual('copy_file_range', self._copy())
+
+    @unittest.skipUnless(hasattr(os, 'sendfile'), 'sendfile not available')
+    def test_copy_file_falls_back_to_sendfile(self):
+        patches = {'copy_file_range': self._unsupported} if hasattr(os, 'copy_file_range') else {}
+
+        self.assertEqual('sendfile', self._copy(**patches))
+
+    def test_copy_file_falls_back_to_read_write(self):
+        patches = dict((name, self._unsupported) for name in ('copy_file_range', 'sendfile') if hasattr(os, name))
+
+        self.assertEqual('readinto', self._copy(**patches))
+
+    def test_copy_file_restarts_after_partial_copy(self):
+        copy_file_range = getattr(os, 'copy_file_range', None)
+        calls = []
+
+        def failing_after_first_chunk(*args):
+            calls.append(args)
+            if len(calls) > 1:
+                raise OSError(errno.EXDEV, 'test')
+            return copy_file_range(*args)
+
+        patches = dict((name, self._unsupported) for name in ('sendfile',) if hasattr(os, name))
+        if copy_file_range is not None:
+            patches['copy_file_range'] = failing_after_first_chunk
+
+        self.assertEqual('readinto', self._copy(**patches))
+
+    @unittest.skipUnless(hasattr(os, 'copy_file_range'), 'copy_file_range not available')
+    def test_copy_file_raises_io_errors(self):
+        def failing(*args):
+            raise OSError(errno.EIO, 'test')
+
+        with self.assertRaises(OSError) as e:
+            self._copy(copy_file_range=failing)
+        self.assertEqual(errno.EIO, e.exception.errno)
+
+    def test_copy_file_to_many_writes_all_destinations(self):
+        contents = ''.join(random.choice(string.ascii_letters) for _ in range(10000))
+        self._file('src', datetime.datetime(2000, 12, 31), contents=contents)
+        src = os.path.join(self.test_dir, 'src')
+        os.chmod(src, 0o640)
+        dests = [os.path.join(self.test_dir, 'dest{i}'.format(i=i)) for i in range(3)]
+
+        backup_roll.copy_file_to_many(src, dests, bufsize=1000)
+
+        for dest in dests:
+            with open(dest) as f:
+                self.assertEqual(contents, f.read())
+            self.assertEqual(0o640, os.stat(dest).st_mode & 0o777)
+
+    def _sparse_file(self):
+        src = os.path.join(self.test_dir, 'src')
+        with open(src, 'wb') as f:
+            f.truncate(16 * 1024 * 1024)
+            f.seek(1024 * 1024)
+            f.write(b'data' * 1000)
+            f.seek(8 * 1024 * 1024)
+            f.write(b'more' * 1000)
+        if not hasattr(os, 'SEEK_DATA') or not backup_roll.is_sparse(os.stat(src)):
+            self.skipTest('sparse files not supported')
+        with open(src, 'rb') as f:
+            return src, f.read()
+
+    def _assert_sparse_copy(self, dest, contents):
+        with open(dest, 'rb') as f:
+            self.assertEqual(contents, f.read())
+        self.assertTrue(backup_roll.is_sparse(os.stat(dest)))
+
+    def test_copy_file_keeps_holes(self):
+        src, contents = self._sparse_file()
+        dest = os.path.join(self.test_dir, 'dest')
+        checksum = hashlib.sha256()
+
+        self.assertEqual('sparse', backup_roll.copy_file(src, dest, bufsize=1000, checksum=checksum))
+
+        self._assert_sparse_copy(dest, contents)
+        self.assertEqual(hashlib.sha256(contents).hexdigest(), checksum.hexdigest())
+
+    def test_copy_file_to_many_keeps_holes(self):
+        src, contents = self._sparse_file()
+        dests = [os.path.join(self.test_dir, 'dest{i}'.format(i=i)) for i in range(2)]
+        checksum = hashlib.sha256()
+
+        backup_roll.copy_file_to_many(src, dests, bufsize=1000, checksum=checksum)
+
+        for dest in dests:
+            self._assert_sparse_copy(dest, contents)
+        self.assertEqual(hashlib.sha256(contents).hexdigest(), checksum.hexdigest())
+
+    def test_sparse_copy_falls_back_without_seek_data(self):
+        src, contents = self._sparse_file()
+        dest = os.path.join(self.test_dir, 'dest')
+        lseek = os.lseek
+
+        def unsupported_seek_data(fd, offset, whence):
+            if whence in (os.SEEK_DATA, os.SEEK_HOLE):
+                raise OSError(errno.EINVAL, 'test')
+            return lseek(fd, offset, whence)
+
+        with mock.patch.object(backup_roll.os, 'lseek', unsupported_seek_data):
+            self.assertNotEqual('sparse', backup_roll.copy_file(src, dest, bufsize=1000))
+
+        with open(dest, 'rb') as f:
+            self.assertEqual(contents, f.read())
+
+    def test_main_reads_file_once_for_all_retentions(self):
+        today = datetime.datetime.now().replace(hour=0, minute=0, second=1, microsecond=0)
+        workspace_dir = os.path.join(self.test_dir, 'workspace')
+        os.mkdir(workspace_dir)
+        self._file('backup', today, contents='contents', basedir=workspace_dir)
+
+        with mock.patch.object(backup_roll, 'copy_file', side_effect=AssertionError('file copied separately')):
+            with mock.patch.object(backup_roll, 'copy_file_to_many',
+                                   wraps=backup_roll.copy_file_to_many) as copy_file_to_many:
+                main(['-q', '-K', '-o', '0', '-s', workspace_dir, '--weekdays', str(today.weekday()),
+                      '--monthdays', str(today.day)])
+
+        self.assertEqual(1, copy_file_to_many.call_count)
+        for retention in ('daily', 'weekly', 'monthly'):
+            dest = os.path.join(workspace_dir, retention, 'backup')
+            self.assertEqual(TestBackupRoll._dt2ts(today), os.stat(dest).st_mtime)
+            with open(dest) as f:
+                self.assertEqual('contents', f.read())
+
+
+class TestIncremental(TestBackupRoll):
+
+    def _collect_twice(self, incremental):
+        midnight = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        self._file('same', midnight, contents='same')
+        self._file('changed', midnight, contents='old')
+        self._file('touched', midnight, contents='old')
+        self._file('new', midnight, contents='new')
+        workspace = Workspace(self.test_dir)
+        daily = DailyRetention(self.retention_dir, incremental=incremental)
+        daily.collect(workspace)
+        os.remove(os.path.join(self.retention_dir, 'new'))
+        self._file('changed', midnight, contents='changed')
+        self._file('touched', midnight + datetime.timedelta(hours=1), contents='old')
+        self._file('samesize', midnight, contents='aaa', basedir=self.retention_dir)
+        self._file('samesize', midnight, contents='bbb')
+
+        with mock.patch.object(backup_roll, 'transfer', wraps=backup_roll.transfer) as transfer_mock:
+            workspace = Workspace(self.test_dir)
+            daily = DailyRetention(self.retention_dir, incremental=incremental)
+            daily.collect(workspace)
+
+        return set(os.path.basename(call[0][0]) for call in transfer_mock.call_args_list)
+
+    def test_incremental_size_mtime_collects_new_and_changed_files(self):
+        result = self._collect_twice('size-mtime')
+
+        self.assertSetEqual(set(['changed', 'touched', 'new']), result)
+
+    def test_incremental_checksum_collects_new_and_changed_files(self):
+        result = self._collect_twice('checksum')
+
+        self.assertSetEqual(set(['changed', 'new', 'samesize']), result)
+        with open(os.path.join(self.retention_dir, 'samesize')) as f:
+            self.assertEqual('bbb', f.read())
+
+    def test_not_incremental_collects_all_files(self):
+        result = self._collect_twice(None)
+
+        self.assertSetEqual(set(['same', 'changed', 'touched', 'new', 'samesize']), result)
+
+
+class TestJobs(TestBackupRoll):
+
+    def setUp(self):
+        super(TestJobs, self).setUp()
+        self.workspace_dir = os.path.join(self.test_dir, 'workspace')
+        os.mkdir(self.workspace_dir)
+        self.today = datetime.datetime.now().replace(hour=0, minute=0, second=1, microsecond=0)
+        for i in range(10):
+            self._file('file{i}'.format(i=i), self.today - datetime.timedelta(days=i), basedir=self.workspace_dir)
+        self.args = ['-q', '-o', '0', '-s', self.workspace_dir, '--weekdays', str(self.today.weekday()),
+                     '--monthdays', str(self.today.day)]
+
+    def _listdir(self, retention):
+        return sorted(os.listdir(os.path.join(self.workspace_dir, retention)))
+
+    def test_listing_stats_files_through_executor(self):
+        executor = backup_roll.ThreadPoolExecutor(max_workers=2)
+        try:
+            with mock.patch.object(backup_roll, '_entry_stat', wraps=backup_roll._entry_stat) as entry_stat:
+                workspace = Workspace(self.workspace_dir, offset_hours=0)
+                workspace.listing(executor)
+        finally:
+            executor.shutdown()
+
+        self.assertEqual(10, entry_stat.call_count)
+        self.assertEqual(sorted(self._dt2d(self.today - datetime.timedelta(days=i)) for i in range(10)),
+                         sorted(workspace.all_days()))
+
+    def test_jobs_collects_and_cleans_up_like_serial_run(self):
+        main(self.args + ['-j', '4'])
+
+        self.assertEqual(['daily', 'monthly', 'weekly'], sorted(os.listdir(self.workspace_dir)))
+        self.assertEqual(['file{i}'.format(i=i) for i in range(10)], self._listdir('daily'))
+        self.assertEqual(['file0', 'file7'], self._listdir('weekly'))
+        self.assertEqual(['file0'], self._listdir('monthly'))
+
+    def test_jobs_dry_run_doesnt_change_anything(self):
+        main(self.args + ['-j', '4', '-n'])
+
+        self.assertEqual(['file{i}'.format(i=i) for i in range(10)], sorted(os.listdir(self.workspace_dir)))
+
+    def test_jobs_failed_file_doesnt_stop_others_and_keeps_workspace(self):
+        transfer = backup_roll.transfer
+
+        def failing_transfer(src, dest, *args, **kwargs):
+            if dest == os.path.join(self.workspace_dir, 'weekly', 'file7'):
+                raise IOError('test failure')
+            return transfer(src, dest, *args, **kwargs)
+
+        with mock.patch.object(backup_roll, 'transfer', failing_transfer):
+            with self.assertRaises(SystemExit):
+                main(self.args + ['-j', '4'])
+
+        self.assertEqual(['file{i}'.format(i=i) for i in range(10)], self._listdir('daily'))
+        self.assertEqual(['file0'], self._listdir('weekly'))
+        self.assertEqual(10, len([name for name in os.listdir(self.workspace_dir) if name.startswith('file')]))
+
+    def test_run_tasks_logs_in_order_of_tasks(self):
+        def slow(value, delay):
+            time.sleep(delay)
+            return value
+
+        done = []
+        tasks = [backup_roll.Task('task {i}'.format(i=i), functools.partial(slow, i, 0.05 * (5 - i)), done.append)
+                 for i in range(5)]
+        executor = backup_roll.ThreadPoolExecutor(max_workers=5)
+
+        with mock.patch.object(backup_roll.logging, 'info') as info:
+            failures = backup_roll.run_tasks(tasks, executor)
+        executor.shutdown()
+
+        self.assertEqual(0, failures)
+        self.assertEqual(['task {i}'.format(i=i) for i in range(5)], [call[0][0] for call in info.call_args_list])
+        self.assertEqual(list(range(5)), done)
+
+
+class TestPlan(TestBackupRoll):
+
+    def setUp(self):
+        super(TestPlan, self).setUp()
+        self.workspace_dir = os.path.join(self.test_dir, 'workspace')
+        os.mkdir(self.workspace_dir)
+        self.today = datetime.datetime.now().replace(hour=0, minute=0, second=1, microsecond=0)
+        self.args = ['-q', '-o', '0', '-s', self.workspace_dir, '--weekdays', str(self.today.weekday()),
+                     '--monthdays', str(self.today.day)]
+        self.plan_path = os.path.join(self.test_dir, 'plan.json')
+
+    def test_plan_out_doesnt_change_anything(self):
+        self._file('backup', self.today, basedir=self.workspace_dir)
+
+        main(self.args + ['--plan-out', self.plan_path])
+
+        self.assertEqual(['backup'], os.listdir(self.workspace_dir))
+        with open(self.plan_path) as f:
+            plan = json.load(f)
+        self.assertEqual({'files': 2, 'bytes': 8}, plan['totals']['copy'])
+        self.assertEqual({'files': 1, 'bytes': 4}, plan['totals']['move'])
+        self.assertEqual({'files': 3, 'bytes': 0}, plan['totals']['mkdir'])
+        self.assertEqual({'files': 0, 'bytes': 0}, plan['totals']['cleanup'])
+
+    def test_apply_executes_plan_without_scanning(self):
+        self._file('backup', self.today, basedir=self.workspace_dir)
+        main(self.args + ['--plan-out', self.plan_path])
+
+        with mock.patch.object(backup_roll, 'scandir', side_effect=AssertionError('directory was scanned')):
+            main(self.args + ['--apply', self.plan_path])
+
+        self.assertEqual(['daily', 'monthly', 'weekly'], sorted(os.listdir(self.workspace_dir)))
+        for retention in ('daily', 'weekly', 'monthly'):
+            self.assertEqual(['backup'], os.listdir(os.path.join(self.workspace_dir, retention)))
+
+    def test_plan_doesnt_delete_replaced_file(self):
+        daily_dir = os.path.join(self.workspace_dir, 'daily')
+        os.mkdir(daily_dir)
+        self._file('backup', self.today - datetime.timedelta(days=100), basedir=daily_dir)
+        self._file('old', self.today - datetime.timedelta(days=100), basedir=daily_dir)
+        self._file('backup', self.today, basedir=self.workspace_dir)
+        workspace = Workspace(self.workspace_dir)
+        daily = DailyRetention(daily_dir)
+
+        plan = backup_roll.create_plan(workspace, [daily], cleanup_workspace=True)
+
+        self.assertEqual([
+            ('move', os.path.join(self.workspace_dir, 'backup'), os.path.join(daily_dir, 'backup')),
+            ('delete', os.path.join(daily_dir, 'old'), None),
+        ], [(operation.action, operation.path, operation.dest) for operation in plan])
+
+    def test_plan_moves_file_to_last_retention_collecting_it(self):
+        self._file('backup', self.today, basedir=self.workspace_dir)
+        src = os.path.join(self.workspace_dir, 'backup')
+        inode = os.stat(src).st_ino
+        workspace = Workspace(self.workspace_dir)
+        daily = DailyRetention(os.path.join(self.workspace_dir, 'daily'))
+        weekly = WeeklyRetention(os.path.join(self.workspace_dir, 'weekly'), weekdays=(self.today.weekday(),))
+        monthly = MonthlyRetention(os.path.join(self.test_dir, 'monthly'), monthdays=(self.today.day,))
+
+        plan = backup_roll.create_plan(workspace, [daily, weekly, monthly], cleanup_workspace=True)
+        backup_roll.apply_plan(plan)
+
+        self.assertEqual(['copy', 'copy', 'move'], [operation.action for operation in plan.select('copy', 'move')])
+        self.assertEqual(inode, os.stat(os.path.join(self.test_dir, 'monthly', 'backup')).st_ino)
+        self.assertTrue(os.path.isfile(os.path.join(self.workspace_dir, 'daily', 'backup')))
+        self.assertFalse(os.path.exists(src))
+
+    def test_move_across_filesystems_copies_then_deletes(self):
+        self._file('backup', self.today, contents='contents', basedir=self.workspace_dir)
+        src = os.path.join(self.workspace_dir, 'backup')
+        dest = os.path.join(self.test_dir, 'backup')
+        rename = os.rename
+
+        def cross_device_rename(a, b):
+            if a == src:
+                raise OSError(errno.EXDEV, 'test')
+            self.assertTrue(os.path.exists(src), 'source should exist until its copy is complete')
+            return rename(a, b)
+
+        with mock.patch.object(backup_roll.os, 'rename', cross_device_rename):
+            method = backup_roll.move_file(src, dest)
+
+        self.assertEqual('copy', method)
+        self.assertFalse(os.path.exists(src))
+        self.assertEqual([], [name for name in os.listdir(self.test_dir) if name.endswith(backup_roll.TEMP_SUFFIX)])
+        with open(dest) as f:
+            self.assertEqual('contents', f.read())
+        self.assertEqual(TestBackupRoll._dt2ts(self.today), os.stat(dest).st_mtime)
+
+    def test_move_removes_source_hardlinked_by_previous_run(self):
+        self._file('backup', self.today, contents='contents', basedir=self.workspace_dir)
+        src = os.path.join(self.workspace_dir, 'backup')
+        args = ['-q', '-o', '0', '-s', self.workspace_dir, '--weekdays', '--monthdays', '--link-mode', 'hardlink']
+
+        main(args + ['-K'])
+        main(args)
+
+        self.assertFalse(os.path.exists(src))
+        with open(os.path.join(self.workspace_dir, 'daily', 'backup')) as f:
+            self.assertEqual('contents', f.read())
+        main(args)
+        self.assertFalse(os.path.exists(src))
+
+    def test_plan_round_trips_through_json(self):
+        plan = backup_roll.Plan([
+            backup_roll.Operation('mkdir', '/a'),
+            backup_roll.Operation('link', '/b', '/a/b', 10, 1.5, 2.5, 'hardlink'),
+            backup_roll.Operation('delete', '/a/c', size=5),
+        ])
+        plan.save(self.plan_path)
+
+        result = backup_roll.Plan.load(self.plan_path)
+
+        self.assertEqual(plan.operations, result.operations)
+        self.assertEqual('mkdir: 1 file(s), 0 bytes, link: 1 file(s), 10 bytes, delete: 1 file(s), 5 bytes',
+                         result.summary())
+
+
+class TestMetrics(TestBackupRoll):
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        self.workspace_dir = os.path.join(self.test_dir, 'workspace')
+        os.mkdir(self.workspace_dir)
+        self.today = datetime.datetime.now().replace(hour=0, minute=0, second=1, microsecond=0)
+        self.args = ['-q', '-o', '0', '-s', self.workspace_dir, '--weekdays', '--monthdays']
+
+    def test_metrics_count_files_and_bytes_per_directory(self):
+        daily_dir = os.path.join(self.workspace_dir, 'daily')
+        os.mkdir(daily_dir)
+        self._file('old', self.today - datetime.timedelta(days=100), contents='old', basedir=daily_dir)
+        self._file('same', self.today, contents='same', basedir=daily_dir)
+        self._file('same', self.today, contents='same', basedir=self.workspace_dir)
+        self._file('new', self.today, contents='new file', basedir=self.workspace_dir)
+        metrics_path = os.path.join(self.test_dir, 'metrics.json')
+
+        main(self.args + ['--incremental', 'size-mtime', '--metrics-json', metrics_path])
+
+        with open(metrics_path) as f:
+            metrics = json.load(f)
+        self.assertEqual({'files': 1, 'bytes': 8}, dict((key, metrics['directories'][daily_dir]['move'][key])
+                                                        for key in ('files', 'bytes')))
+        self.assertEqual(1, metrics['directories'][daily_dir]['skip']['files'])
+        self.assertEqual(3, metrics['directories'][daily_dir]['delete']['bytes'])
+        self.assertEqual(1, metrics['directories'][self.workspace_dir]['cleanup']['files'])
+        self.assertEqual(['listing', 'planning', 'collect', 'move', 'cleanup', 'store_gc', 'workspace_cleanup'],
+                         list(metrics['phases'].keys()))
+        self.assertEqual(0, metrics['failures'])
+
+    def test_metrics_file_is_in_prometheus_text_format(self):
+        self._file('new', self.today, contents='new file', basedir=self.workspace_dir)
+        metrics_path = os.path.join(self.test_dir, 'backup_roll.prom')
+
+        main(self.args + ['--metrics-file', metrics_path])
+
+        with open(metrics_path) as f:
+            lines = f.read().splitlines()
+        self.assertIn('backup_roll_files{{directory="{d}",action="move"}} 1.0'.format(
+            d=os.path.join(self.workspace_dir, 'daily')), lines)
+        self.assertIn('backup_roll_bytes{{directory="{d}",action="move"}} 8.0'.format(
+            d=os.path.join(self.workspace_dir, 'daily')), lines)
+        self.assertIn('backup_roll_failures 0.0', lines)
+        self.assertIn('# TYPE backup_roll_phase_duration_seconds gauge', lines)
+        self.assertEqual(['backup_roll.prom'], [name for name in os.listdir(self.test_dir) if 'prom' in name])
+
+
+class _StatCounter(object):
+    """Counts stat calls made through os.stat and through directory entries"""
+
+    def __init__(self):
+        self.os_stats = 0
+        self.file_stats = 0
+
+    @contextlib.contextmanager
+    def patch(self):
+        counter = self
+        os_stat = os.stat
+        scandir = backup_roll.scandir
+
+        class CountingEntry(object):
+            def __init__(self, entry):
+                self._entry = entry
+                self.name = entry.name
+                self.path = entry.path
+
+            def __getattr__(self, item):
+                return getattr(self._entry, item)
+
+            def stat(self, *args, **kwargs):
+                counter.file_stats += 1
+                return self._entry.stat(*args, **kwargs)
+
+        def counting_stat(*args, **kwargs):
+            counter.os_stats += 1
+            return os_stat(*args, **kwargs)
+
+        def counting_scandir(*args, **kwargs):
+            return (CountingEntry(entry) for entry in scandir(*args, **kwargs))
+
+        with mock.patch.object(backup_roll, 'scandir', counting_scandir), mock.patch('os.stat', counting_stat):
+            yield counter
+
 
 class TestDailyRetention(TestBackupRoll):
 
@@ -485,4 +1131,1156 @@ class TestMonthlyRetention(TestBackupRoll):
         for i in expected_to_be_skipped:
             day = (midnight - datetime.timedelta(days=i)).day
             self.assertFalse(os.path.exists(os.path.join(self.retention_dir, 'minus_{i}'.format(i=i))),
-                             'file created on day {day} shoud not be copied'.format(day=day))
\ No newline at end of file
+                             'file created on day {day} shoud not be copied'.format(day=day))
+
+
+class TestLinkMode(TestBackupRoll):
+
+    def test_transfer_copy_creates_separate_file(self):
+        dt = datetime.datetime(2000, 12, 31)
+        self._file('src', dt)
+        src = os.path.join(self.test_dir, 'src')
+        dest = os.path.join(self.test_dir, 'dest')
+
+        method = transfer(src, dest, 'copy')
+
+        self.assertEqual('copy', method)
+        self.assertNotEqual(os.stat(src).st_ino, os.stat(dest).st_ino)
+        self.assertEqual(os.stat(src).st_mtime, os.stat(dest).st_mtime)
+
+    def test_transfer_hardlink_shares_inode(self):
+        dt = datetime.datetime(2000, 12, 31)
+        self._file('src', dt)
+        src = os.path.join(self.test_dir, 'src')
+        dest = os.path.join(self.test_dir, 'dest')
+
+        method = transfer(src, dest, 'hardlink')
+
+        self.assertEqual('hardlink', method)
+        self.assertEqual(os.stat(src).st_ino, os.stat(dest).st_ino)
+
+    def test_transfer_hardlink_replaces_existing_file(self):
+        dt = datetime.datetime(2000, 12, 31)
+        self._file('src', dt, contents='new')
+        self._file('dest', dt, contents='old')
+        src = os.path.join(self.test_dir, 'src')
+        dest = os.path.join(self.test_dir, 'dest')
+
+        transfer(src, dest, 'hardlink')
+
+        self.assertEqual(os.stat(src).st_ino, os.stat(dest).st_ino)
+        with open(dest) as f:
+            self.assertEqual('new', f.read())
+
+    def test_transfer_copy_over_hardlink_keeps_source(self):
+        dt = datetime.datetime(2000, 12, 31)
+        self._file('src', dt, contents='contents')
+        src = os.path.join(self.test_dir, 'src')
+        dest = os.path.join(self.test_dir, 'dest')
+        os.link(src, dest)
+
+        for link_mode in ('copy', 'reflink'):
+            transfer(src, dest, link_mode)
+
+            with open(src) as f:
+                self.assertEqual('contents', f.read())
+            with open(dest) as f:
+                self.assertEqual('contents', f.read())
+
+    def test_transfer_reflink_falls_back_to_copy_preserving_times(self):
+        dt = datetime.datetime(2000, 12, 31)
+        self._file('src', dt, contents='contents')
+        src = os.path.join(self.test_dir, 'src')
+        dest = os.path.join(self.test_dir, 'dest')
+
+        method = transfer(src, dest, 'reflink')
+
+        self.assertIn(method, ('reflink', 'copy'))
+        self.assertNotEqual(os.stat(src).st_ino, os.stat(dest).st_ino)
+        self.assertEqual(os.stat(src).st_mtime, os.stat(dest).st_mtime)
+        with open(dest) as f:
+            self.assertEqual('contents', f.read())
+
+    def test_main_hardlinks_file_into_all_retentions(self):
+        today = datetime.datetime.now().replace(hour=0, minute=0, second=1, microsecond=0)
+        workspace_dir = os.path.join(self.test_dir, 'workspace')
+        os.mkdir(workspace_dir)
+        self._file('backup', today, basedir=workspace_dir)
+        src = os.path.join(workspace_dir, 'backup')
+        inode = os.stat(src).st_ino
+
+        main(['-q', '-K', '-o', '0', '-s', workspace_dir, '--link-mode', 'hardlink',
+              '--weekdays', str(today.weekday()), '--monthdays', str(today.day)])
+
+        for retention in ('daily', 'weekly', 'monthly'):
+            dest = os.path.join(workspace_dir, retention, 'backup')
+            self.assertEqual(inode, os.stat(dest).st_ino, '{r} copy should be a hardlink'.format(r=retention))
+
+
+
+class TestStore(TestBackupRoll):
+
+    def setUp(self):
+        super(TestStore, self).setUp()
+        self.workspace_dir = os.path.join(self.test_dir, 'workspace')
+        self.store_dir = os.path.join(self.test_dir, 'store')
+        os.mkdir(self.workspace_dir)
+        self.today = datetime.datetime.now().replace(hour=0, minute=0, second=1, microsecond=0)
+
+    def _blobs(self):
+        return sorted(path for path, _ in backup_roll.BlobStore(self.store_dir).blobs())
+
+    def _retention(self, keep_days, name='daily'):
+        return DailyRetention(os.path.join(self.test_dir, name), keep_days=keep_days,
+                              store=backup_roll.BlobStore(self.store_dir))
+
+    def test_main_stores_identical_files_once(self):
+        self._file('first', self.today, contents='same', basedir=self.workspace_dir)
+        self._file('second', self.today - datetime.timedelta(days=1), contents='same', basedir=self.workspace_dir)
+        self._file('third', self.today - datetime.timedelta(days=2), contents='other', basedir=self.workspace_dir)
+
+        main(['-q', '-o', '0', '-s', self.workspace_dir, '--store', self.store_dir,
+              '--weekdays', str(self.today.weekday()), '--monthdays', str(self.today.day)])
+
+        self.assertEqual(2, len(self._blobs()))
+        for name, dt, contents in (('first', self.today, 'same'),
+                                   ('second', self.today - datetime.timedelta(days=1), 'same'),
+                                   ('third', self.today - datetime.timedelta(days=2), 'other')):
+            path = os.path.join(self.workspace_dir, 'daily', name)
+            self.assertTrue(os.path.islink(path))
+            self.assertEqual(TestBackupRoll._dt2ts(dt), os.lstat(path).st_mtime)
+            with open(path) as f:
+                self.assertEqual(contents, f.read())
+        self.assertEqual(os.path.realpath(os.path.join(self.workspace_dir, 'daily', 'first')),
+                         os.path.realpath(os.path.join(self.workspace_dir, 'monthly', 'first')))
+        days = DailyRetention(os.path.join(self.workspace_dir, 'daily'),
+                              store=backup_roll.BlobStore(self.store_dir)).all_days()
+        self.assertEqual(3, len(days))
+        self.assertEqual([], [name for name in os.listdir(self.workspace_dir) if name not in ('daily', 'weekly',
+                                                                                              'monthly')])
+
+    def test_cleanup_deletes_only_unreferenced_blobs(self):
+        self._file('old', self.today - datetime.timedelta(days=40), contents='old', basedir=self.workspace_dir)
+        self._file('shared', self.today - datetime.timedelta(days=40), contents='shared', basedir=self.workspace_dir)
+        self._file('new', self.today, contents='new', basedir=self.workspace_dir)
+        workspace = Workspace(self.workspace_dir)
+        self._retention(60).collect(workspace)
+        weekly = self._retention(60, 'weekly')
+        weekly.collect(Workspace(self.workspace_dir))
+        os.remove(os.path.join(self.test_dir, 'weekly', 'old'))
+        self.assertEqual(3, len(self._blobs()))
+
+        self._retention(30).cleanup()
+
+        self.assertEqual(['new'], os.listdir(os.path.join(self.test_dir, 'daily')))
+        blobs = self._blobs()
+        self.assertEqual(2, len(blobs))
+        self.assertNotIn(backup_roll.BlobStore(self.store_dir).blob_path(backup_roll.file_checksum(
+            os.path.join(self.workspace_dir, 'old'))), blobs)
+
+    def test_garbage_isnt_collected_with_registered_directory_missing(self):
+        self._file('backup', self.today, basedir=self.workspace_dir)
+        self._retention(30).collect(Workspace(self.workspace_dir))
+        weekly = self._retention(30, 'weekly')
+        weekly.collect(Workspace(self.workspace_dir))
+        os.remove(os.path.join(self.test_dir, 'daily', 'backup'))
+        # e.g. unmounted
+        os.rename(os.path.join(self.test_dir, 'weekly'), os.path.join(self.test_dir, 'unmounted'))
+
+        self.assertRaises(IOError, backup_roll.BlobStore(self.store_dir).collect_garbage)
+        self.assertEqual(1, len(self._blobs()))
+
+    @unittest.skipIf(backup_roll.fcntl is None, 'requires fcntl')
+    def test_garbage_collection_waits_for_file_being_stored(self):
+        self._file('backup', self.today, basedir=self.workspace_dir)
+        store = backup_roll.BlobStore(self.store_dir)
+        src = os.path.join(self.workspace_dir, 'backup')
+        dest_dir = os.path.join(self.test_dir, 'daily')
+        os.mkdir(dest_dir)
+        collector = threading.Thread(target=backup_roll.BlobStore(self.store_dir).collect_garbage)
+        symlink = os.symlink
+
+        def symlink_while_collecting(*args):
+            # the blob is written, but not linked yet
+            collector.start()
+            collector.join(0.2)
+            self.assertTrue(collector.is_alive())
+            return symlink(*args)
+
+        with mock.patch.object(backup_roll.os, 'symlink', symlink_while_collecting):
+            store.add(src, os.path.join(dest_dir, 'backup'))
+        collector.join()
+
+        self.assertEqual(1, len(self._blobs()))
+        with open(os.path.join(dest_dir, 'backup')) as f:
+            self.assertEqual('test', f.read())
+
+    def test_incremental_skips_stored_file(self):
+        self._file('backup', self.today, basedir=self.workspace_dir)
+        retention = self._retention(30)
+        retention.collect(Workspace(self.workspace_dir))
+        retention = DailyRetention(os.path.join(self.test_dir, 'daily'), incremental='size-mtime',
+                                   store=backup_roll.BlobStore(self.store_dir))
+
+        plan = backup_roll.create_plan(Workspace(self.workspace_dir), [retention])
+
+        self.assertEqual(['skip', 'gc'], [operation.action for operation in plan])
+
+
+class TestCompression(TestBackupRoll):
+
+    def setUp(self):
+        super(TestCompression, self).setUp()
+        self.workspace_dir = os.path.join(self.test_dir, 'workspace')
+        os.mkdir(self.workspace_dir)
+        self.today = datetime.datetime.now().replace(hour=0, minute=0, second=1, microsecond=0)
+
+    def _compress_in_chunks(self, compression):
+        contents = ''.join(random.choice(string.ascii_letters) for _ in range(10000))
+        self._file('src', self.today, contents=contents)
+        src = os.path.join(self.test_dir, 'src')
+        dest = os.path.join(self.test_dir, 'dest')
+
+        backup_roll.compress_file(src, dest, compression, 1, threads=4, chunk_size=1000)
+
+        with backup_roll.CODECS[compression].open(dest, 'rb') as f:
+            self.assertEqual(contents.encode(), f.read())
+
+    def test_main_compresses_files_keeping_modification_time(self):
+        self._file('backup', self.today, contents='contents', basedir=self.workspace_dir)
+
+        main(['-q', '-o', '0', '-s', self.workspace_dir, '--compress', 'gzip', '--weekdays', str(self.today.weekday()),
+              '--monthdays', str(self.today.day)])
+
+        for retention in ('daily', 'weekly', 'monthly'):
+            dest = os.path.join(self.workspace_dir, retention, 'backup.gz')
+            self.assertEqual(TestBackupRoll._dt2ts(self.today), os.stat(dest).st_mtime)
+            with gzip.open(dest, 'rb') as f:
+                self.assertEqual(b'contents', f.read())
+        daily = DailyRetention(os.path.join(self.workspace_dir, 'daily'))
+        self.assertEqual([self._dt2d(self.today)], list(daily.all_days()))
+
+    def test_retentions_use_their_compression_presets(self):
+        self._file('backup', self.today, basedir=self.workspace_dir)
+        workspace = Workspace(self.workspace_dir)
+        retentions = [MonthlyRetention(os.path.join(self.test_dir, 'monthly'), monthdays=(self.today.day,),
+                                       compression='gzip'),
+                      DailyRetention(os.path.join(self.test_dir, 'daily'), compression='gzip'),
+                      DailyRetention(os.path.join(self.test_dir, 'other'), compression='gzip', compress_level=5)]
+
+        plan = backup_roll.create_plan(workspace, retentions)
+
+        self.assertEqual([9, 1, 5], [operation.level for operation in plan.select('compress')])
+
+    def test_colliding_destination_leaves_other_source_in_workspace(self):
+        self._file('a', self.today, contents='plain', basedir=self.workspace_dir)
+        with gzip.open(os.path.join(self.workspace_dir, 'a.gz'), 'wb') as f:
+            f.write(b'compressed')
+        os.utime(os.path.join(self.workspace_dir, 'a.gz'), (self._now(), self._dt2ts(self.today)))
+
+        main(['-q', '-o', '0', '-s', self.workspace_dir, '--compress', 'gzip', '--weekdays', '--monthdays'])
+
+        self.assertEqual(['a.gz'], os.listdir(os.path.join(self.workspace_dir, 'daily')))
+        # one of the sources is collected and moved, the other one is kept
+        self.assertEqual(1, len([name for name in os.listdir(self.workspace_dir) if name in ('a', 'a.gz')]))
+
+    def test_compressed_file_is_collected_as_it_is(self):
+        with gzip.open(os.path.join(self.workspace_dir, 'backup.gz'), 'wb') as f:
+            f.write(b'contents')
+        daily = DailyRetention(self.retention_dir, compression='gzip')
+
+        daily.collect(Workspace(self.workspace_dir))
+
+        self.assertEqual(['backup.gz'], os.listdir(self.retention_dir))
+        with open(os.path.join(self.workspace_dir, 'backup.gz'), 'rb') as f:
+            with open(os.path.join(self.retention_dir, 'backup.gz'), 'rb') as g:
+                self.assertEqual(f.read(), g.read())
+
+    def test_incremental_skips_compressed_file(self):
+        self._file('backup', self.today, basedir=self.workspace_dir)
+        DailyRetention(self.retention_dir, compression='gzip').collect(Workspace(self.workspace_dir))
+
+        for incremental in backup_roll.INCREMENTAL_MODES:
+            daily = DailyRetention(self.retention_dir, compression='gzip', incremental=incremental)
+            plan = backup_roll.create_plan(Workspace(self.workspace_dir), [daily])
+
+            self.assertEqual(['skip'], [operation.action for operation in plan])
+
+    def test_gzip_compresses_chunks_in_parallel(self):
+        self._compress_in_chunks('gzip')
+
+    @unittest.skipUnless(backup_roll.CODECS['zstd'].available, 'zstandard not installed')
+    def test_zstd_compresses_chunks_in_parallel(self):
+        self._compress_in_chunks('zstd')
+
+    @unittest.skipUnless(backup_roll.CODECS['lz4'].available, 'lz4 not installed')
+    def test_lz4_compresses_chunks_in_parallel(self):
+        self._compress_in_chunks('lz4')
+
+
+class TestChecksums(TestBackupRoll):
+
+    def setUp(self):
+        super(TestChecksums, self).setUp()
+        self.workspace_dir = os.path.join(self.test_dir, 'workspace')
+        os.mkdir(self.workspace_dir)
+        self.today = datetime.datetime.now().replace(hour=0, minute=0, second=1, microsecond=0)
+        self.args = ['-q', '-o', '0', '-s', self.workspace_dir, '--checksums', '--weekdays',
+                     str(self.today.weekday()), '--monthdays', str(self.today.day)]
+
+    def _manifest(self, retention):
+        with open(os.path.join(self.workspace_dir, retention, backup_roll.MANIFEST_FILENAME)) as f:
+            return f.read()
+
+    def test_main_writes_manifest_of_every_retention(self):
+        self._file('backup', self.today, contents='contents', basedir=self.workspace_dir)
+        self._file('older', self.today - datetime.timedelta(days=1), contents='older', basedir=self.workspace_dir)
+
+        main(self.args)
+
+        checksums = dict((name, hashlib.sha256(contents).hexdigest())
+                         for name, contents in (('backup', b'contents'), ('older', b'older')))
+        self.assertEqual('{backup}  backup\n{older}  older\n'.format(**checksums), self._manifest('daily'))
+        for retention in ('weekly', 'monthly'):
+            self.assertEqual('{backup}  backup\n'.format(**checksums), self._manifest(retention))
+        self.assertEqual(2, len(list(DailyRetention(os.path.join(self.workspace_dir, 'daily')).all_days())))
+
+    def test_file_not_matching_checksum_after_write_fails(self):
+        self._file('backup', self.today, basedir=self.workspace_dir)
+
+        with mock.patch.object(backup_roll, 'file_checksum', return_value='0' * 64):
+            with self.assertRaises(SystemExit):
+                main(self.args)
+
+        self.assertTrue(os.path.isfile(os.path.join(self.workspace_dir, 'backup')))
+
+    def test_verify_detects_modified_file(self):
+        self._file('backup', self.today, basedir=self.workspace_dir)
+        main(self.args)
+        main(self.args + ['--verify', '-j', '2'])
+
+        with open(os.path.join(self.workspace_dir, 'weekly', 'backup'), 'a') as f:
+            f.write('modified')
+
+        with self.assertRaises(SystemExit):
+            main(self.args + ['--verify', '-j', '2'])
+
+    def test_deleted_file_is_removed_from_manifest(self):
+        self._file('old', self.today - datetime.timedelta(days=40), basedir=self.workspace_dir)
+        self._file('new', self.today, basedir=self.workspace_dir)
+        DailyRetention(self.retention_dir, keep_days=60, checksums=True).collect(Workspace(self.workspace_dir))
+
+        DailyRetention(self.retention_dir, keep_days=30, checksums=True).cleanup()
+
+        self.assertEqual(['new'], list(DailyRetention(self.retention_dir, checksums=True).manifest().keys()))
+
+
+class TestJournal(TestBackupRoll):
+
+    class Crash(BaseException):
+        pass
+
+    def setUp(self):
+        super(TestJournal, self).setUp()
+        self.workspace_dir = os.path.join(self.test_dir, 'workspace')
+        os.mkdir(self.workspace_dir)
+        self.today = datetime.datetime.now().replace(hour=0, minute=0, second=1, microsecond=0)
+        for i in range(5):
+            self._file('file{i}'.format(i=i), self.today - datetime.timedelta(days=i), basedir=self.workspace_dir)
+        self.args = ['-q', '-o', '0', '-s', self.workspace_dir, '--weekdays', str(self.today.weekday()),
+                     '--monthdays', str(self.today.day)]
+        self.journal_path = os.path.join(self.workspace_dir, backup_roll.JOURNAL_FILENAME)
+
+    def _run(self, args, crash_after=None):
+        transfer = backup_roll.transfer
+        calls = []
+
+        def crashing_transfer(*args, **kwargs):
+            if crash_after is not None and len(calls) == crash_after:
+                raise TestJournal.Crash()
+            calls.append(args[1])
+            return transfer(*args, **kwargs)
+
+        def crashing_transfer_to_many(src, dests, *args):
+            for dest in dests:
+                crashing_transfer(src, dest, 'copy', *args)
+            return 'copy'
+
+        with mock.patch.object(backup_roll, 'transfer', crashing_transfer):
+            with mock.patch.object(backup_roll, 'transfer_to_many', crashing_transfer_to_many):
+                main(self.args + args)
+        return calls
+
+    def test_resume_executes_only_unfinished_operations(self):
+        with self.assertRaises(TestJournal.Crash):
+            self._run(['-K'], crash_after=4)
+        self.assertTrue(os.path.exists(self.journal_path))
+
+        calls = self._run(['-K', '--resume'])
+
+        self.assertEqual([os.path.join(self.workspace_dir, 'daily', 'file{i}'.format(i=i)) for i in (3, 2, 1)], calls)
+        self.assertFalse(os.path.exists(self.journal_path))
+        self.assertEqual(['file{i}'.format(i=i) for i in range(5)],
+                         sorted(os.listdir(os.path.join(self.workspace_dir, 'daily'))))
+        self.assertEqual(['file0'], os.listdir(os.path.join(self.workspace_dir, 'weekly')))
+        self.assertEqual(['file0'], os.listdir(os.path.join(self.workspace_dir, 'monthly')))
+
+    def test_journal_skips_operations_completed_before_crash(self):
+        src = os.path.join(self.workspace_dir, 'file1')
+        plan = backup_roll.Plan([backup_roll.Operation('cleanup', src),
+                                 backup_roll.Operation('cleanup', os.path.join(self.workspace_dir, 'file2'))])
+        journal = backup_roll.Journal(self.journal_path)
+        journal.start(plan)
+        journal.finish(remove=False)
+        os.remove(src)
+        with open(self.journal_path, 'a') as f:
+            f.write('{"done": [["cleanup", ')
+
+        remaining = journal.load()
+        journal.finish(remove=False)
+
+        self.assertEqual([os.path.join(self.workspace_dir, 'file2')], [operation.path for operation in remaining])
+
+    def test_interrupted_copy_leaves_no_destination(self):
+        src = os.path.join(self.workspace_dir, 'file0')
+        dest = os.path.join(self.test_dir, 'dest')
+
+        def crashing_copy(src, dest, **kwargs):
+            with open(dest, 'w') as f:
+                f.write('partial')
+            raise TestJournal.Crash()
+
+        with mock.patch.object(backup_roll, 'copy_file', crashing_copy):
+            with self.assertRaises(TestJournal.Crash):
+                transfer(src, dest)
+
+        self.assertEqual([], [name for name in os.listdir(self.test_dir) if name not in ('workspace',)])
+
+    def test_temporary_files_left_by_crash_are_deleted(self):
+        daily_dir = os.path.join(self.workspace_dir, 'daily')
+        os.mkdir(daily_dir)
+        self._file(os.path.basename(backup_roll.temp_path('file0')), self.today, basedir=daily_dir)
+
+        main(self.args)
+
+        self.assertEqual(['file{i}'.format(i=i) for i in range(5)], sorted(os.listdir(daily_dir)))
+
+
+class TestDurability(TestBackupRoll):
+
+    def setUp(self):
+        super(TestDurability, self).setUp()
+        self.workspace_dir = os.path.join(self.test_dir, 'workspace')
+        os.mkdir(self.workspace_dir)
+        self.today = datetime.datetime.now().replace(hour=0, minute=0, second=1, microsecond=0)
+        for i in range(5):
+            self._file('file{i}'.format(i=i), self.today - datetime.timedelta(days=i), basedir=self.workspace_dir)
+        self.args = ['-q', '-K', '-o', '0', '-s', self.workspace_dir, '--weekdays', str(self.today.weekday()),
+                     '--monthdays', str(self.today.day), '-j', '2']
+        self.retention_dirs = [os.path.join(self.workspace_dir, name) for name in ('daily', 'monthly', 'weekly')]
+
+    def _run(self, durability):
+        with mock.patch.object(backup_roll, 'sync_file', wraps=backup_roll.sync_file) as sync_file:
+            with mock.patch.object(backup_roll, 'sync_directory', wraps=backup_roll.sync_directory) as sync_directory:
+                with mock.patch.object(backup_roll, 'syncfs', wraps=backup_roll.syncfs) as syncfs:
+                    main(self.args + ['--durability', durability])
+        return [call[0][0] for call in sync_file.call_args_list], \
+            [call[0][0] for call in sync_directory.call_args_list], [call[0][0] for call in syncfs.call_args_list]
+
+    def test_batch_syncs_each_directory_once(self):
+        files, directories, filesystems = self._run('batch')
+
+        self.assertEqual(7, len([path for path in files if os.path.isfile(path)]))
+        self.assertEqual(sorted([self.workspace_dir] + self.retention_dirs), sorted(directories))
+        self.assertEqual([], filesystems)
+
+    def test_syncfs_syncs_filesystem_once_per_phase(self):
+        files, directories, filesystems = self._run('syncfs')
+
+        self.assertEqual([], files)
+        self.assertEqual([], directories)
+        self.assertEqual(1, len(filesystems))
+
+    def test_file_syncs_directory_of_each_file(self):
+        files, directories, filesystems = self._run('file')
+
+        self.assertEqual(7, len([path for path in files if os.path.isfile(path)]))
+        self.assertEqual(10, len(directories))
+
+    def test_store_syncs_directories_of_blobs(self):
+        store_dir = os.path.join(self.test_dir, 'store')
+        self.args += ['--store', store_dir]
+
+        for durability in ('batch', 'file'):
+            files, directories, filesystems = self._run(durability)
+
+            blob_directories = set(os.path.dirname(os.path.realpath(os.path.join(self.workspace_dir, 'daily', name)))
+                                   for name in os.listdir(os.path.join(self.workspace_dir, 'daily')))
+            self.assertTrue(blob_directories)
+            self.assertLessEqual(blob_directories | set([os.path.realpath(store_dir)]), set(directories))
+
+    def test_collected_files_are_synced_before_workspace_is_cleaned_up(self):
+        workspace_files = []
+
+        def sync_directories(directories, durability):
+            workspace_files.append(len([name for name in os.listdir(self.workspace_dir) if name.startswith('file')]))
+
+        with mock.patch.object(backup_roll, 'sync_directories', sync_directories):
+            main([arg for arg in self.args if arg != '-K'] + ['--durability', 'batch'])
+
+        self.assertEqual([5, 0], workspace_files)
+        self.assertEqual([], [name for name in os.listdir(self.workspace_dir) if name.startswith('file')])
+
+
+class FakeClientError(Exception):
+    """Stand-in for botocore ClientError"""
+
+    def __init__(self, code):
+        super(FakeClientError, self).__init__('An error occurred ({code})'.format(code=code))
+        self.response = {'Error': {'Code': code}}
+
+
+class FakeS3Client(object):
+    """In-memory stand-in for boto3 S3 client, implementing only calls made by S3Storage"""
+
+    def __init__(self, page_size=1000, buckets=('backups',)):
+        self.objects = {}
+        self.page_size = page_size
+        self.buckets = set(buckets)
+        self.calls = []
+
+    def _object(self, bucket, key):
+        if bucket not in self.buckets:
+            raise FakeClientError('NoSuchBucket')
+        if (bucket, key) not in self.objects:
+            raise FakeClientError('404')
+        return self.objects[(bucket, key)]
+
+    def _put(self, bucket, key, data, metadata):
+        self.objects[(bucket, key)] = (data, dict(metadata), datetime.datetime.now(datetime.timezone.utc))
+
+    def get_paginator(self, operation):
+        assert operation == 'list_objects_v2'
+        client = self
+
+        class Paginator(object):
+            def paginate(self, Bucket, Prefix='', Delimiter=None):
+                client.calls.append('list_objects_v2')
+                if Bucket not in client.buckets:
+                    raise FakeClientError('NoSuchBucket')
+                keys = sorted(key for bucket, key in client.objects if bucket == Bucket and key.startswith(Prefix)
+                              and (Delimiter is None or Delimiter not in key[len(Prefix):]))
+                for i in range(0, len(keys), client.page_size):
+                    yield {'Contents': [{'Key': key} for key in keys[i:i + client.page_size]]}
+
+        return Paginator()
+
+    def head_bucket(self, Bucket):
+        if Bucket not in self.buckets:
+            raise FakeClientError('404')
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix='', MaxKeys=1000):
+        if Bucket not in self.buckets:
+            raise FakeClientError('NoSuchBucket')
+        keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))[:MaxKeys]
+        return {'Contents': [{'Key': key} for key in keys]} if keys else {}
+
+    def head_object(self, Bucket, Key):
+        data, metadata, last_modified = self._object(Bucket, Key)
+        return {'ContentLength': len(data), 'Metadata': metadata, 'LastModified': last_modified}
+
+    def copy(self, CopySource, Bucket, Key, ExtraArgs=None):
+        self.calls.append('copy')
+        data, metadata, _ = self._object(CopySource['Bucket'], CopySource['Key'])
+        if ExtraArgs and ExtraArgs.get('MetadataDirective') == 'REPLACE':
+            metadata = ExtraArgs['Metadata']
+        self._put(Bucket, Key, data, metadata)
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None):
+        self.calls.append('upload_file')
+        if Bucket not in self.buckets:
+            raise FakeClientError('NoSuchBucket')
+        with open(Filename, 'rb') as f:
+            self._put(Bucket, Key, f.read(), (ExtraArgs or {}).get('Metadata', {}))
+
+    def download_file(self, Bucket, Key, Filename):
+        self.calls.append('download_file')
+        data = self._object(Bucket, Key)[0]
+        with open(Filename, 'wb') as f:
+            f.write(data)
+
+    def delete_object(self, Bucket, Key):
+        self.calls.append('delete_object')
+        self.objects.pop((Bucket, Key), None)
+
+
+class TestStorage(TestBackupRoll):
+
+    def setUp(self):
+        super(TestStorage, self).setUp()
+        self.client = FakeS3Client(page_size=2)
+        self.storages = dict(backup_roll.STORAGES)
+        backup_roll.STORAGES['s3'] = backup_roll.S3Storage(client=self.client)
+        s3_errors = mock.patch.object(backup_roll, 'S3_ERRORS', (FakeClientError,))
+        s3_errors.start()
+        self.addCleanup(s3_errors.stop)
+        self.today = datetime.datetime.now().replace(hour=0, minute=0, second=1, microsecond=0)
+        self.args = ['-q', '-o', '0', '--weekdays', str(self.today.weekday()), '--monthdays', str(self.today.day),
+                     '-d', 's3://backups/daily', '-w', 's3://backups/weekly', '-m', 's3://backups/monthly']
+
+    def tearDown(self):
+        backup_roll.STORAGES.clear()
+        backup_roll.STORAGES.update(self.storages)
+        super(TestStorage, self).tearDown()
+
+    def _put(self, key, mtime, data=b'test'):
+        self.client._put('backups', key, data, {'mtime': repr(float(self._dt2ts(mtime)))})
+
+    def _keys(self, prefix):
+        return sorted(key[len(prefix):] for bucket, key in self.client.objects if key.startswith(prefix))
+
+    def test_main_uploads_files_keeping_modification_times(self):
+        workspace_dir = os.path.join(self.test_dir, 'workspace')
+        os.mkdir(workspace_dir)
+        for i in range(3):
+            self._file('file{i}'.format(i=i), self.today - datetime.timedelta(days=i), basedir=workspace_dir)
+
+        main(self.args + ['-K', '-s', workspace_dir])
+
+        self.assertEqual(['file0', 'file1', 'file2'], self._keys('daily/'))
+        self.assertEqual(['file0'], self._keys('weekly/'))
+        daily = DailyRetention('s3://backups/daily', offset_hours=0)
+        self.assertEqual(sorted(self._dt2d(self.today - datetime.timedelta(days=i)) for i in range(3)),
+                         sorted(daily.all_days()))
+        self.assertEqual(b'test', self.client.objects[('backups', 'daily/file1')][0])
+        self.assertEqual(3, len(os.listdir(workspace_dir)))
+
+    @unittest.skipUnless(hasattr(time, 'tzset'), 'requires time.tzset')
+    def test_objects_without_metadata_take_modification_time_in_utc(self):
+        last_modified = datetime.datetime(2021, 6, 1, 23, 30, tzinfo=datetime.timezone.utc)
+        self.client.objects[('backups', 'daily/upload')] = (b'test', {}, last_modified)
+        timezone = os.environ.get('TZ')
+        os.environ['TZ'] = 'America/New_York'
+        time.tzset()
+        try:
+            stat = backup_roll.STORAGES['s3'].stat('s3://backups/daily/upload')
+            days = list(DailyRetention('s3://backups/daily', offset_hours=0).all_days())
+        finally:
+            if timezone is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = timezone
+            time.tzset()
+
+        self.assertEqual(1622590200, stat.st_mtime)
+        # 19:30 in New York
+        self.assertEqual([datetime.date(2021, 6, 1)], days)
+
+    def test_errors_of_objects_are_reported_per_file(self):
+        workspace_dir = os.path.join(self.test_dir, 'workspace')
+        os.mkdir(workspace_dir)
+        for i in range(2):
+            self._file('file{i}'.format(i=i), self.today - datetime.timedelta(days=i), basedir=workspace_dir)
+        args = [arg if arg != 's3://backups/weekly' else 's3://missing/weekly' for arg in self.args]
+
+        with self.assertRaises(SystemExit) as raised:
+            main(args + ['-K', '-s', workspace_dir])
+
+        self.assertEqual(1, raised.exception.code)
+        self.assertEqual(['file0', 'file1'], self._keys('daily/'))
+        self.assertEqual(['file0'], self._keys('monthly/'))
+
+    def test_isdir_tells_missing_buckets_and_empty_prefixes(self):
+        self._put('daily/file', self.today)
+        storage = backup_roll.STORAGES['s3']
+
+        self.assertTrue(storage.isdir('s3://backups/daily'))
+        self.assertFalse(storage.isdir('s3://backups/dialy'))
+        self.assertFalse(storage.isdir('s3://missing/daily'))
+        storage.makedirs('s3://backups/weekly')
+        self.assertRaises(IOError, storage.makedirs, 's3://missing/daily')
+        self.assertRaises(IOError, storage.stat, 's3://backups/daily/other')
+
+    def test_listing_with_name_dates_skips_head_requests(self):
+        for i in range(3):
+            day = self.today - datetime.timedelta(days=i)
+            self._put(day.strftime('daily/db-%Y%m%d.sql'), self.today)
+        self._put('daily/db-latest.sql', self.today - datetime.timedelta(days=5))
+        daily = DailyRetention('s3://backups/daily', offset_hours=0, name_date='db-%Y%m%d')
+
+        with mock.patch.object(self.client, 'head_object', wraps=self.client.head_object) as head_object:
+            days = sorted(daily.all_days())
+
+        self.assertEqual(sorted(self._dt2d(self.today - datetime.timedelta(days=i)) for i in (0, 1, 2, 5)), days)
+        self.assertEqual(1, head_object.call_count)
+
+    def test_main_copies_between_prefixes_without_downloading(self):
+        for i in range(3):
+            self._put('workspace/file{i}'.format(i=i), self.today - datetime.timedelta(days=i))
+
+        main(self.args + ['-s', 's3://backups/workspace'])
+
+        self.assertEqual(['file0', 'file1', 'file2'], self._keys('daily/'))
+        self.assertEqual(['file0'], self._keys('monthly/'))
+        self.assertEqual([], self._keys('workspace/'))
+        self.assertNotIn('download_file', self.client.calls)
+        self.assertNotIn('upload_file', self.client.calls)
+        self.assertEqual(self.client.objects[('backups', 'daily/file2')][1]['mtime'],
+                         repr(float(self._dt2ts(self.today - datetime.timedelta(days=2)))))
+
+    def test_listing_reads_all_pages(self):
+        for i in range(5):
+            self._put('workspace/file{i}'.format(i=i), self.today - datetime.timedelta(days=i))
+        self._put('workspace/nested/file', self.today)
+
+        workspace = Workspace('s3://backups/workspace', offset_hours=0)
+
+        self.assertEqual(5, sum(len(workspace.list(day)) for day in workspace.all_days()))
+        self.assertEqual(['s3://backups/workspace/file3'],
+                         workspace.list(self._dt2d(self.today - datetime.timedelta(days=3))))
+
+    def test_cleanup_deletes_old_objects(self):
+        for i in (0, 10, 40, 50):
+            self._put('daily/file{i}'.format(i=i), self.today - datetime.timedelta(days=i))
+
+        DailyRetention('s3://backups/daily', offset_hours=0, keep_days=30).cleanup()
+
+        self.assertEqual(['file0', 'file10'], self._keys('daily/'))
+
+    def test_store_is_not_supported_by_remote_retention(self):
+        with self.assertRaises(ValueError):
+            DailyRetention('s3://backups/daily', store=backup_roll.BlobStore(self.test_dir))
+
+
+class TestConfig(TestBackupRoll):
+
+    def setUp(self):
+        super(TestConfig, self).setUp()
+        self.today = datetime.datetime.now().replace(hour=0, minute=0, second=1, microsecond=0)
+        self.workspace_dirs = []
+        for name in ('db1', 'db2'):
+            workspace_dir = os.path.join(self.test_dir, name)
+            os.mkdir(workspace_dir)
+            for i in range(3):
+                self._file('file{i}'.format(i=i), self.today - datetime.timedelta(days=i), basedir=workspace_dir)
+            self.workspace_dirs.append(workspace_dir)
+
+    def _json_config(self, jobs, defaults=None):
+        path = os.path.join(self.test_dir, 'config.json')
+        with open(path, 'w') as f:
+            json.dump({'defaults': defaults or {}, 'jobs': jobs}, f)
+        return path
+
+    def test_load_json_config_merges_defaults(self):
+        path = self._json_config({'db1': {'workspace-dir': '/backups/db1', 'weekdays': [5, 6], 'index': False},
+                                  'db2': {'workspace-dir': '/backups/db2', 'daily-retention': 7}},
+                                 defaults={'daily-retention': 14, 'keep-workspace': True})
+
+        self.assertEqual({
+            'db1': ['--daily-retention', '14', '--keep-workspace', '--workspace-dir', '/backups/db1',
+                    '--weekdays', '5', '6'],
+            'db2': ['--daily-retention', '7', '--keep-workspace', '--workspace-dir', '/backups/db2'],
+        }, dict(backup_roll.load_config(path)))
+
+    def test_load_ini_config_splits_values(self):
+        path = os.path.join(self.test_dir, 'config.ini')
+        with open(path, 'w') as f:
+            f.write('[DEFAULT]\nkeep-workspace = yes\n\n[db1]\nworkspace-dir = "/backups/db 1"\nweekdays =\n'
+                    'monthdays = 1 -1\nindex = off\n')
+
+        self.assertEqual({'db1': ['--keep-workspace', '--workspace-dir', '/backups/db 1', '--weekdays', '--monthdays',
+                                  '1', '-1']},
+                         dict(backup_roll.load_config(path)))
+
+    def test_main_runs_all_jobs(self):
+        path = self._json_config(dict((os.path.basename(workspace_dir), {'workspace-dir': workspace_dir})
+                                      for workspace_dir in self.workspace_dirs))
+
+        main(['-q', '-o', '0', '--weekdays', '--monthdays', '--config', path])
+
+        for workspace_dir in self.workspace_dirs:
+            self.assertEqual(['file0', 'file1', 'file2'], sorted(os.listdir(os.path.join(workspace_dir, 'daily'))))
+            self.assertEqual(['daily'], os.listdir(workspace_dir))
+
+    def test_numbers_of_jobs_have_to_be_positive(self):
+        parser = backup_roll.create_parser()
+        for args in (['--processes', '0'], ['--per-device', '0'], ['--per-device', '-1'], ['-j', '0']):
+            with mock.patch('sys.stderr'), self.assertRaises(SystemExit):
+                parser.parse_args(args)
+        self.assertEqual(2, parser.parse_args(['--per-device', '2']).per_device)
+
+    def test_failed_job_fails_run_without_stopping_others(self):
+        self._file('daily', self.today, basedir=self.workspace_dirs[0])
+        path = self._json_config(dict((os.path.basename(workspace_dir), {'workspace-dir': workspace_dir})
+                                      for workspace_dir in self.workspace_dirs))
+
+        with self.assertRaises(SystemExit):
+            main(['-q', '-o', '0', '--weekdays', '--monthdays', '--config', path])
+
+        self.assertEqual(['file0', 'file1', 'file2'], sorted(os.listdir(os.path.join(self.workspace_dirs[1], 'daily'))))
+
+    def test_jobs_on_same_device_are_limited(self):
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def run_job(args_, defaults):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return 0, 'done'
+
+        path = self._json_config(dict(('job{i}'.format(i=i), {'workspace-dir': self.workspace_dirs[i % 2]})
+                                      for i in range(4)))
+        args = backup_roll.create_parser().parse_args(['-q'])
+        for per_device in (1, 2):
+            running[1] = 0
+            with mock.patch.object(backup_roll, 'ProcessPoolExecutor', backup_roll.ThreadPoolExecutor):
+                with mock.patch.object(backup_roll, '_run_job', run_job):
+                    self.assertEqual(0, backup_roll.run_config(path, args, processes=4, per_device=per_device))
+            self.assertEqual(per_device, running[1])
+
+
+class TestWatch(TestBackupRoll):
+
+    def setUp(self):
+        super(TestWatch, self).setUp()
+        self.workspace_dir = os.path.join(self.test_dir, 'workspace')
+        os.mkdir(self.workspace_dir)
+        self.today = datetime.datetime.now().replace(hour=0, minute=0, second=1, microsecond=0)
+
+    def test_polling_reports_files_once_they_stop_changing(self):
+        self._file('old', self.today, basedir=self.workspace_dir)
+        watcher = backup_roll.PollingWatcher(self.workspace_dir, interval=0)
+        self._file('new', self.today, basedir=self.workspace_dir)
+        self._file(os.path.basename(backup_roll.temp_path('partial')), self.today, basedir=self.workspace_dir)
+
+        self.assertEqual([], watcher.wait(0))
+        self.assertEqual([os.path.join(self.workspace_dir, 'new')], watcher.wait(0))
+        self.assertEqual([], watcher.wait(0))
+
+    @unittest.skipIf(backup_roll._inotify_init1 is None, 'requires inotify')
+    def test_inotify_reports_files_closed_after_writing(self):
+        watcher = backup_roll.InotifyWatcher(self.workspace_dir)
+        try:
+            self.assertEqual([], watcher.wait(0))
+            self._file('new', self.today, basedir=self.workspace_dir)
+            self._file(os.path.basename(backup_roll.temp_path('partial')), self.today, basedir=self.workspace_dir)
+
+            self.assertEqual([os.path.join(self.workspace_dir, 'new')], watcher.wait(1))
+        finally:
+            watcher.close()
+
+    def test_watch_collects_landed_files_and_cleans_up(self):
+        daily_dir = os.path.join(self.workspace_dir, 'daily')
+        os.mkdir(daily_dir)
+        self._file('old', self.today - datetime.timedelta(days=60), basedir=daily_dir)
+        self._file('left', self.today, basedir=self.workspace_dir)
+        batches = [['new1'], ['new2', 'gone']]
+
+        class Watcher(object):
+            def wait(watcher, timeout):
+                if not batches:
+                    raise KeyboardInterrupt()
+                names = batches.pop(0)
+                for name in names:
+                    if name != 'gone':
+                        self._file(name, self.today, basedir=self.workspace_dir)
+                return [os.path.join(self.workspace_dir, name) for name in names]
+
+            def close(watcher):
+                pass
+
+        args = backup_roll.create_parser().parse_args(['-q', '-o', '0', '-s', self.workspace_dir, '--weekdays',
+                                                       '--monthdays', '--watch', '--cleanup-interval', '0'])
+
+        self.assertEqual(0, backup_roll.watch(args, Watcher()))
+
+        self.assertEqual(['new1', 'new2'], sorted(os.listdir(daily_dir)))
+        self.assertEqual(['daily', 'left'], sorted(os.listdir(self.workspace_dir)))
+
+
+    def test_main_arms_watcher_before_first_roll(self):
+        self._file('left', self.today, basedir=self.workspace_dir)
+        events = []
+        roll = backup_roll.roll
+
+        class Watcher(object):
+            def wait(watcher, timeout):
+                raise KeyboardInterrupt()
+
+            def close(watcher):
+                events.append('close')
+
+        def create_watcher(args):
+            events.append('watch')
+            return Watcher()
+
+        def rolling(args):
+            events.append('roll')
+            return roll(args)
+
+        with mock.patch.object(backup_roll, 'create_watcher', create_watcher), \
+                mock.patch.object(backup_roll, 'roll', rolling):
+            main(['-q', '-o', '0', '-s', self.workspace_dir, '--weekdays', '--monthdays', '--watch'])
+
+        self.assertEqual(['watch', 'roll', 'close'], events)
+        self.assertEqual(['daily'], os.listdir(self.workspace_dir))
+
+class TestListing(TestBackupRoll):
+
+    @unittest.skipUnless(hasattr(time, 'tzset'), 'requires time.tzset')
+    def test_local_days_match_local_time_across_dst_changes(self):
+        timezone = os.environ.get('TZ')
+        os.environ['TZ'] = 'Europe/Warsaw'
+        time.tzset()
+        try:
+            # around the change to summer time at 2021-03-28 01:00 UTC and back at 2021-10-31 01:00 UTC
+            timestamps = [start + seconds for start in (1616889600, 1635638400) for seconds in range(0, 4 * 3600, 599)]
+            for offset_hours in (0, 6, -3):
+                expected = [(datetime.datetime.fromtimestamp(timestamp) +
+                             datetime.timedelta(hours=offset_hours)).date().toordinal() for timestamp in timestamps]
+
+                self.assertEqual(expected, list(backup_roll.local_days(timestamps, offset_hours)))
+        finally:
+            if timezone is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = timezone
+            time.tzset()
+
+    def test_listing_follows_added_replaced_and_removed_files(self):
+        today = datetime.datetime.now().replace(hour=12, minute=0, second=0, microsecond=0)
+        yesterday = today - datetime.timedelta(days=1)
+        listing = backup_roll.Listing(self.test_dir)
+        listing.extend([('a', backup_roll.FileStat(1, 10, 0, self._dt2ts(today)), None),
+                        ('b', backup_roll.FileStat(2, 20, 0, self._dt2ts(yesterday)), None),
+                        ('c', backup_roll.FileStat(3, 30, 0, self._dt2ts(today)), None)])
+        listing.add('b', backup_roll.FileStat(None, 21, 0, self._dt2ts(today)))
+        listing.remove('a')
+
+        self.assertEqual({self._dt2d(today): [os.path.join(self.test_dir, 'c'), os.path.join(self.test_dir, 'b')]},
+                         dict(listing))
+        self.assertEqual(backup_roll.FileStat(None, 21, 0, self._dt2ts(today)), listing.stat('b'))
+        self.assertIsNone(listing.stat('a'))
+        self.assertNotIn(self._dt2d(yesterday), listing)
+
+
+class TestRetentionRules(TestBackupRoll):
+    """Compares calendars of retentions with straightforward per-date rules on random policies and dates"""
+
+    ITERATIONS = 200
+
+    def setUp(self):
+        super(TestRetentionRules, self).setUp()
+        self.random = random.Random(0)
+        self.today = datetime.datetime.now().date()
+
+    def _dates(self):
+        return set(self.today + datetime.timedelta(days=self.random.randint(-3 * 366, 3))
+                   for _ in range(self.random.randint(0, 300)))
+
+    def test_daily_keeps_dates_younger_than_retention(self):
+        for _ in range(self.ITERATIONS):
+            keep_days = self.random.randint(0, 400)
+            dates = self._dates()
+            min_date = self.today - datetime.timedelta(days=keep_days)
+
+            self.assertEqual(set(date for date in dates if date > min_date),
+                             set(DailyRetention(self.retention_dir, keep_days=keep_days).filter_for_collect(dates)))
+
+    def test_weekly_keeps_weekdays_younger_than_retention(self):
+        for _ in range(self.ITERATIONS):
+            keep_weeks = self.random.randint(0, 60)
+            weekdays = self.random.sample(range(8), self.random.randint(0, 4))
+            dates = self._dates()
+            min_date = self.today - datetime.timedelta(days=keep_weeks * 7)
+            retention = WeeklyRetention(self.retention_dir, keep_weeks=keep_weeks, weekdays=weekdays)
+
+            self.assertEqual(set(date for date in dates if date > min_date and date.weekday() in weekdays),
+                             set(retention.filter_for_collect(dates)))
+
+    def test_monthly_keeps_monthdays_younger_than_retention(self):
+        for _ in range(self.ITERATIONS):
+            keep_months = self.random.randint(0, 30)
+            monthdays = self.random.sample(list(range(-32, 33)), self.random.randint(0, 5))
+            dates = self._dates()
+            first = self.today.replace(day=1)
+            n_months_ago = first.replace(year=first.year - ((keep_months + 12 - first.month) // 12),
+                                         month=(first.month - keep_months - 1) % 12 + 1)
+            min_date = self.today - (first - n_months_ago)
+            retention = MonthlyRetention(self.retention_dir, keep_months=keep_months, monthdays=monthdays)
+
+            self.assertEqual(set(date for date in dates if date > min_date and (
+                date.day in monthdays or date.day - self._month_length(date) - 1 in monthdays)),
+                set(retention.filter_for_collect(dates)))
+
+    def test_keep_last_keeps_most_recent_matching_dates(self):
+        for _ in range(self.ITERATIONS):
+            keep_last = self.random.randint(0, 10)
+            weekdays = self.random.sample(range(7), self.random.randint(1, 3))
+            dates = self._dates()
+            retention = WeeklyRetention(self.retention_dir, keep_weeks=1, weekdays=weekdays, keep_last=keep_last)
+
+            matching = set(date for date in dates if date.weekday() in weekdays)
+            self.assertEqual(set(sorted(matching, reverse=True)[:keep_last]), set(retention.filter_for_collect(dates)))
+
+    def test_keep_last_keeps_all_matching_dates_when_there_are_fewer(self):
+        dates = [self.today - datetime.timedelta(days=days) for days in (0, 3, 40)]
+        retention = DailyRetention(self.retention_dir, keep_days=1, keep_last=5)
+
+        self.assertEqual(set(dates), set(retention.filter_for_collect(dates)))
+        self.assertEqual(set(), retention.filter_for_cleanup(dates))
+        retention._listing = backup_roll.Listing(self.retention_dir)
+        retention._listing.extend(('file{i}'.format(i=i), backup_roll.FileStat(None, 0, 0, 0), date)
+                                  for i, date in enumerate(dates))
+        self.assertEqual([], list(retention.expired_days()))
+
+    def test_yearly_keeps_days_of_year(self):
+        retention = backup_roll.YearlyRetention(self.retention_dir, keep_years=10, yeardays=[(1, 1), (2, 29)])
+        dates = [datetime.date(year, 1, 1) for year in range(self.today.year - 12, self.today.year + 1)] + \
+            [datetime.date(2020, 2, 29), datetime.date(2021, 2, 28), datetime.date(2021, 3, 1)]
+        min_date = backup_roll.YearlyRetention(self.retention_dir, keep_years=10).min_date(self.today)
+
+        self.assertEqual(set(date for date in dates if date > min_date and date.month == 1 or
+                             date == datetime.date(2020, 2, 29) and date > min_date),
+                         set(retention.filter_for_collect(dates)))
+
+    def test_main_collects_yearly_backups(self):
+        workspace_dir = os.path.join(self.test_dir, 'workspace')
+        os.mkdir(workspace_dir)
+        noon = datetime.datetime.now().replace(hour=12, minute=0, second=0, microsecond=0)
+        self._file('today', noon, basedir=workspace_dir)
+        self._file('yesterday', noon - datetime.timedelta(days=1), basedir=workspace_dir)
+
+        main(['-q', '-K', '-o', '0', '-s', workspace_dir, '--weekdays', '--monthdays',
+              '--yeardays', noon.strftime('%m-%d')])
+
+        self.assertEqual(['today'], os.listdir(os.path.join(workspace_dir, 'yearly')))
+
+
+class TestDateIndex(TestBackupRoll):
+
+    def setUp(self):
+        super(TestDateIndex, self).setUp()
+        self.random = random.Random(0)
+        self.today = datetime.datetime.now().date()
+
+    def _listing(self, days):
+        listing = backup_roll.Listing(self.retention_dir)
+        listing.extend(('file{i}'.format(i=i), backup_roll.FileStat(None, 0, 0, 0), day) for i, day in enumerate(days))
+        return listing
+
+    def test_range_returns_days_between_bounds_in_order(self):
+        days = [datetime.date(2020, 1, day) for day in (20, 3, 9, 9, 14)]
+        listing = self._listing(days)
+
+        self.assertEqual([datetime.date(2020, 1, day) for day in (3, 9, 14, 20)], list(listing))
+        self.assertEqual([datetime.date(2020, 1, day) for day in (9, 14)],
+                         list(listing.range(datetime.date(2020, 1, 4), datetime.date(2020, 1, 14))))
+        self.assertEqual([datetime.date(2020, 1, 3)], list(listing.range(end=datetime.date(2020, 1, 8))))
+        self.assertEqual([], list(listing.range(start=datetime.date(2020, 1, 21))))
+
+    def test_expired_days_match_cleanup_filter(self):
+        for _ in range(100):
+            days = [self.today - datetime.timedelta(days=self.random.randint(-2, 5 * 366))
+                    for _ in range(self.random.randint(0, 200))]
+            keep_last = self.random.choice([None, 0, 3])
+            for retention in (DailyRetention(self.retention_dir, keep_days=self.random.randint(0, 60),
+                                             keep_last=keep_last),
+                              WeeklyRetention(self.retention_dir, keep_weeks=self.random.randint(0, 20),
+                                              keep_last=keep_last),
+                              MonthlyRetention(self.retention_dir, keep_months=self.random.randint(0, 24),
+                                               monthdays=[1, -1], keep_last=keep_last)):
+                retention._listing = self._listing(days)
+
+                self.assertEqual(sorted(retention.filter_for_cleanup(set(days))), list(retention.expired_days()))
+
+    def test_expired_days_look_up_calendar_only_within_age(self):
+        days = [self.today - datetime.timedelta(days=day) for day in range(0, 10 * 366, 3)]
+        retention = MonthlyRetention(self.retention_dir, keep_months=2)
+        retention._listing = self._listing(days)
+
+        with mock.patch.object(retention, 'kept_days', wraps=retention.kept_days) as kept_days:
+            expired = list(retention.expired_days())
+
+        self.assertEqual(1, kept_days.call_count)
+        self.assertGreater(kept_days.call_args[0][0], self.today - datetime.timedelta(days=93))
+        self.assertEqual(len(days) - len(retention.filter_for_collect(days)), len(expired))
+
+
+class TestFilters(TestBackupRoll):
+
+    def setUp(self):
+        super(TestFilters, self).setUp()
+        self.workspace_dir = os.path.join(self.test_dir, 'workspace')
+        os.mkdir(self.workspace_dir)
+        self.now = datetime.datetime.now().replace(hour=12, minute=0, second=0, microsecond=0)
+
+    def test_excluded_files_are_not_stated(self):
+        for i in range(5):
+            self._file('db{i}.dump'.format(i=i), self.now, basedir=self.workspace_dir)
+            self._file('db{i}.log'.format(i=i), self.now, basedir=self.workspace_dir)
+        self._file('db0.dump.part', self.now, basedir=self.workspace_dir)
+        workspace = Workspace(self.workspace_dir, include=['*.dump', '*.sql'], exclude=['db4*'])
+
+        with _StatCounter().patch() as counter:
+            files = sorted(os.path.basename(path) for paths in workspace.listing().values() for path in paths)
+
+        self.assertEqual(['db0.dump', 'db1.dump', 'db2.dump', 'db3.dump'], files)
+        self.assertEqual(4, counter.file_stats)
+
+    def test_name_date_formats(self):
+        name_date = backup_roll.NameDate('db-%Y%m%d-%H%M')
+        self.assertEqual(datetime.datetime(2021, 3, 4, 23, 50), name_date.datetime('db-20210304-2350.sql.gz'))
+        self.assertIsNone(name_date.datetime('db-20211304-2350.sql'))
+        self.assertIsNone(name_date.datetime('db-latest.sql'))
+        name_date = backup_roll.NameDate(r'(?P<day>\d\d)\.(?P<month>\d\d)\.(?P<year>\d{4})')
+        self.assertEqual(datetime.datetime(2021, 3, 4), name_date.datetime('dump_04.03.2021'))
+        self.assertRaises(ValueError, backup_roll.NameDate, '%Y-%j')
+        self.assertRaises(ValueError, backup_roll.NameDate, 'db-%Y%m')
+
+    def test_days_are_taken_from_names_without_stat(self):
+        yesterday = self.now - datetime.timedelta(days=1)
+        # modification times differ from dates in names
+        self._file(yesterday.strftime('db-%Y%m%d-2330.sql'), self.now, basedir=self.workspace_dir)
+        self._file('db-latest.sql', yesterday, basedir=self.workspace_dir)
+        workspace = Workspace(self.workspace_dir, offset_hours=1, name_date='db-%Y%m%d-%H%M')
+
+        with _StatCounter().patch() as counter:
+            days = dict(workspace.listing())
+
+        self.assertEqual({self._dt2d(self.now): [os.path.join(self.workspace_dir, yesterday.strftime(
+                              'db-%Y%m%d-2330.sql'))],
+                          self._dt2d(yesterday): [os.path.join(self.workspace_dir, 'db-latest.sql')]}, days)
+        self.assertEqual(1, counter.file_stats)
+        stat = workspace.stat(yesterday.strftime(os.path.join(self.workspace_dir, 'db-%Y%m%d-2330.sql')))
+        self.assertEqual(4, stat.st_size)
+        self.assertEqual(self._dt2ts(self.now), stat.st_mtime)
+
+    def test_names_out_of_date_range_fall_back_to_modification_times(self):
+        self._file('db-99991231-2330.sql', self.now, basedir=self.workspace_dir)
+        workspace = Workspace(self.workspace_dir, offset_hours=1, name_date='db-%Y%m%d-%H%M')
+
+        self.assertEqual({self._dt2d(self.now): [os.path.join(self.workspace_dir, 'db-99991231-2330.sql')]},
+                         dict(workspace.listing()))
+
+    def test_roll_with_name_dates_and_filters(self):
+        for days in range(3):
+            self._file((self.now - datetime.timedelta(days=days)).strftime('db-%Y-%m-%d.sql'), self.now,
+                       basedir=self.workspace_dir)
+        self._file('notes.txt', self.now - datetime.timedelta(days=5), basedir=self.workspace_dir)
+
+        main(['-q', '-K', '-o', '0', '-s', self.workspace_dir, '--weekdays', '--monthdays', '--index',
+              '--include', '*.sql', '--name-date', 'db-%Y-%m-%d'])
+
+        daily = sorted(os.listdir(os.path.join(self.workspace_dir, 'daily')))
+        self.assertEqual([(self.now - datetime.timedelta(days=days)).strftime('db-%Y-%m-%d.sql')
+                          for days in (2, 1, 0)], [name for name in daily if name != backup_roll.INDEX_FILENAME])
+        retention = DailyRetention(os.path.join(self.workspace_dir, 'daily'), use_index=True,
+                                   name_date='db-%Y-%m-%d')
+        self.assertEqual(set(self._dt2d(self.now - datetime.timedelta(days=days)) for days in range(3)),
+                         set(retention.listing()))